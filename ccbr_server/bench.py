@@ -0,0 +1,1090 @@
+""" Benchmark of the RAID CLI parsers on synthetic output of large controllers.
+
+Fixture generators write output of megacli, omreport, storcli and mdadm and md's sysfs attributes for a given number of
+adapters and drives into a capture directory, which is then replayed through the reports exactly like
+`ccbr_report all --replay`.
+Parse time, connect time and peak memory of each report are compared with a stored baseline.
+"""
+import gc
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+from functools import partial
+from timeit import default_timer as timer
+
+from ccbr_server.common import Capture, capture, project_root, atomic_write
+from ccbr_server.raid_md import MdReport
+from ccbr_server.raid_megacli import MegaCliReport, PHYSICAL_DRIVES
+from ccbr_server.raid_omreport import OmreportReport
+from ccbr_server.raid_storcli import StorCliReport
+
+try:
+    import tracemalloc
+except ImportError:  # python 2, peak memory is not measured
+    tracemalloc = None
+
+log = logging.getLogger(__file__)
+
+DEFAULT_BASELINE = os.path.join(project_root, 'etc/bench_baseline.json')
+DEFAULT_SIZES = '1x8,1x24,2x100,4x240,4x500'
+
+VD_WIDTH = 8  # Drives in each virtual disk, leftovers become hot spares
+SHELF_SLOTS = 24  # Slots per enclosure
+TIME_SLACK = 0.002  # Seconds, timings this close to the baseline are noise
+MEMORY_SLACK = 128  # KiB, peaks this close to the baseline are noise
+MEMORY_SLACK_FRACTION = 0.25  # of the baseline peak, small fixtures get less slack so they are still guarded
+
+
+class Fixture(object):
+    """ Writes synthetic command output into a capture directory
+    """
+
+    def __init__(self, directory):
+        self.capture = Capture()
+        self.capture.configure(directory, Capture.RECORD)
+
+    def command(self, cmd, out, returncode=0, timed_out=False):
+        self.capture.save('cmd', Capture.command_key(cmd), out.encode(), returncode=returncode, duration=0.,
+                          timed_out=timed_out)
+
+    def file(self, path, data):
+        self.capture.save('file', path, data.encode())
+
+    def exists(self, path, exists=True):
+        self.capture.save('exists', path, b'', exists=exists)
+
+
+class MemoryFixture(object):
+    """ Keeps synthetic command output in memory, for benchmarks of parsers alone
+    """
+
+    def __init__(self):
+        self.outputs = {}
+
+    def command(self, cmd, out, returncode=0, timed_out=False):
+        self.outputs[tuple(cmd)] = out
+
+    def file(self, path, data):
+        pass
+
+    def exists(self, path, exists=True):
+        pass
+
+
+def layout(adapters, drives):
+    """ Spread drives evenly over adapters and group them into virtual disks
+
+    :param int adapters: Number of adapters
+    :param int drives: Number of drives on all adapters
+    :return: Virtual disks (lists of slot numbers) and hot spare slots for each adapter
+    :rtype: list[tuple[list[list[int]], list[int]]]
+    """
+    result = []
+
+    for a in range(adapters):
+        count = drives // adapters + (1 if a < drives % adapters else 0)
+        used = count - count % VD_WIDTH
+        vds = [list(range(i, i + VD_WIDTH)) for i in range(0, used, VD_WIDTH)]
+        result.append((vds, list(range(used, count))))
+
+    return result
+
+
+def is_failing(adapter, slot):
+    return (adapter * 7 + slot) % 37 == 5
+
+
+def megacli_fixture(fixture, adapters, drives):
+    adp, pds, lds = [], [], []
+
+    for a, (vds, spares) in enumerate(layout(adapters, drives)):
+        adp.append(MEGACLI_ADAPTER.format(a=a))
+        pds.append('\nAdapter #%d\n' % a)
+        lds.append('\nAdapter #%d\n\nNumber of Virtual Disks: %d' % (a, len(vds)))
+
+        for vd, slots in enumerate(vds):
+            lds.append(MEGACLI_VD.format(vd=vd, size=len(slots) * 3.637 - 2 * 3.637, drives=len(slots)))
+            for i, slot in enumerate(slots):
+                lds.append(MEGACLI_LD_PD.format(i=i, enc=32 + slot // SHELF_SLOTS, slot=slot % SHELF_SLOTS,
+                                                did=slot + 10))
+
+        for slot in sorted(sum(vds, spares)):
+            spare = slot in spares
+            pds.append(MEGACLI_PD.format(
+                enc=32 + slot // SHELF_SLOTS, slot=slot % SHELF_SLOTS, did=slot + 10, temp=30 + slot % 10,
+                pfc=int(is_failing(a, slot)), state='Hotspare, Spun Up' if spare else 'Online, Spun Up',
+                hotspare=MEGACLI_HOTSPARE if spare else ''))
+
+    fixture.command(['megacli', 'adpallinfo', 'aall', 'nolog'], '\n'.join(adp) + '\nExit Code: 0x00\n')
+    fixture.command(['megacli', 'pdlist', 'aall', 'nolog'], '\n'.join(pds) + '\nExit Code: 0x00\n')
+    fixture.command(['megacli', 'ldpdinfo', 'aall', 'nolog'], '\n'.join(lds) + '\nExit Code: 0x00\n')
+
+
+def omreport_fixture(fixture, adapters, drives):
+    ctrls = []
+
+    for a, (vds, spares) in enumerate(layout(adapters, drives)):
+        ctrls.append(OMREPORT_CONTROLLER.format(a=a))
+
+        pdisks = {}
+        for vd, slots in enumerate(vds):
+            for slot in slots:
+                pdisks[slot] = OMREPORT_PDISK.format(
+                    a=a, enc=slot // SHELF_SLOTS, slot=slot % SHELF_SLOTS, serial=a * 1000 + slot,
+                    status='Non-Critical' if is_failing(a, slot) else 'Ok', hotspare='No')
+        for slot in spares:
+            pdisks[slot] = OMREPORT_PDISK.format(
+                a=a, enc=slot // SHELF_SLOTS, slot=slot % SHELF_SLOTS, serial=a * 1000 + slot, status='Ok',
+                hotspare='Global')
+
+        title = OMREPORT_TITLE.format(a=a)
+        fixture.command(['omreport', 'storage', 'pdisk', 'controller=%d' % a],
+                        title % 'Physical' + ''.join(pdisks[s] for s in sorted(pdisks)))
+        fixture.command(['omreport', 'storage', 'vdisk', 'controller=%d' % a],
+                        title % 'Virtual' + ''.join(OMREPORT_VDISK.format(vd=vd, size=len(slots) * 3725.5)
+                                                    for vd, slots in enumerate(vds)))
+
+        for vd, slots in enumerate(vds):
+            fixture.command(['omreport', 'storage', 'pdisk', 'controller=%d' % a, 'vdisk=%d' % vd],
+                            title % 'Physical' + ''.join(pdisks[s] for s in slots))
+
+    fixture.command(['omreport', 'storage', 'controller'], OMREPORT_CONTROLLERS + ''.join(ctrls))
+
+
+def storcli_fixture(fixture, adapters, drives):
+    ctrls, pds, lds = [], [], []
+
+    for a, (vds, spares) in enumerate(layout(adapters, drives)):
+        status = {'Controller': a, 'Status': 'Success', 'Description': 'None'}
+        ctrls.append({'Command Status': status, 'Response Data': storcli_adapter(a)})
+
+        drive_data = {}
+        for slot in sorted(sum(vds, spares)):
+            drive_data.update(storcli_drive(a, slot, slot in spares))
+        pds.append({'Command Status': status, 'Response Data': drive_data})
+
+        vd_data = {}
+        for vd, slots in enumerate(vds):
+            vd_data['/c%d/v%d' % (a, vd)] = [{
+                'DG/VD': '%d/%d' % (vd, vd), 'TYPE': 'RAID6', 'State': 'Optl', 'Access': 'RW', 'Consist': 'Yes',
+                'Cache': 'RWBD', 'Cac': '-', 'sCC': 'ON', 'Size': '%.3f TB' % ((len(slots) - 2) * 3.637), 'Name': ''
+            }]
+            vd_data['PDs for VD %d' % vd] = [storcli_drive(a, slot, False)['Drive /c%d/e%d/s%d' % (
+                a, storcli_enclosure(a, slot), slot % SHELF_SLOTS)][0] for slot in slots]
+            vd_data['VD%d Properties' % vd] = {
+                'Strip Size': '256 KB', 'Number of Blocks': 46874732544, 'VD has Emulated PD': 'No',
+                'Span Depth': 1, 'Number of Drives Per Span': len(slots), 'Write Cache(initial setting)': 'WriteBack',
+                'Disk Cache Policy': 'Disk\'s Default', 'Encryption': 'None', 'Data Protection': 'Disabled',
+                'Active Operations': 'None', 'Exposed to OS': 'Yes', 'Creation Date': '03-03-2020',
+                'Creation Time': '10:24:13 AM', 'Emulation type': 'default', 'Is LD Ready for OS Requests': 'Yes',
+                'SCSI NAA Id': '600605b00d1a2b30%016x' % (a * 1000 + vd)
+            }
+        lds.append({'Command Status': status, 'Response Data': vd_data})
+
+    for cmd, controllers in ((['storcli', '/call', 'show', 'all', 'j', 'nolog'], ctrls),
+                             (['storcli', '/call/eall/sall', 'show', 'all', 'j', 'nolog'], pds),
+                             (['storcli', '/call/vall', 'show', 'all', 'j', 'nolog'], lds)):
+        fixture.command(cmd, json.dumps({'Controllers': controllers}, indent=4))
+
+
+def storcli_enclosure(adapter, slot):
+    return 8 + adapter * 30 + slot // SHELF_SLOTS  # storcli keys drives by EID:Slt only, keep them unique
+
+
+def storcli_adapter(a):
+    return {
+        'Basics': {'Controller': a, 'Model': 'LSI MegaRAID SAS 9361-8i', 'Serial Number': 'SK%08d' % a,
+                   'Current Controller Date/Time': '10/05/2020, 09:13:44', 'SAS Address': '500605b00d1a2b%02x' % a,
+                   'PCI Address': '00:%02x:00:00' % (a + 2), 'Mfg Date': '04/22/17', 'Revision No': '04A'},
+        'Version': {'Firmware Package Build': '24.21.0-0097', 'Firmware Version': '4.680.00-8527',
+                    'CPLD Version': '26868-01A', 'Bios Version': '6.36.00.3_4.19.08.00_0x06180203',
+                    'Driver Name': 'megaraid_sas', 'Driver Version': '07.714.04.00-rc1'},
+        'Bus': {'Vendor Id': 4096, 'Device Id': 93, 'SubVendor Id': 4096, 'SubDevice Id': 37648,
+                'Host Interface': 'PCI-E', 'Device Interface': 'SAS-12G', 'Bus Number': a + 2, 'Device Number': 0,
+                'Function Number': 0},
+        'Status': {'Controller Status': 'Optimal', 'Memory Correctable Errors': 0,
+                   'Memory Uncorrectable Errors': 0, 'ECC Bucket Count': 0, 'Any Offline VD Cache Preserved': 'No',
+                   'BBU Status': 0, 'Support PD Firmware Download': 'Yes', 'Lock Key Assigned': 'No'},
+        'Supported Adapter Operations': dict(('Operation %d' % i, 'Yes') for i in range(40)),
+        'Supported PD Operations': dict(('PD Operation %d' % i, 'Yes') for i in range(12)),
+        'Supported VD Operations': dict(('VD Operation %d' % i, 'Yes') for i in range(16)),
+        'HwCfg': {'ChipRevision': ' C0', 'BatteryFRU': 'N/A', 'Front End Port Count': 0,
+                  'Backend Port Count': 8, 'BBU': 'Present', 'NVRAM Size': '32KB', 'Flash Size': '16MB',
+                  'On Board Memory Size': '1024MB', 'CacheVault Flash Size': '4.0 GB', 'TPM': 'Absent',
+                  'Temperature Sensor for ROC': 'Present', 'Temperature Sensor for Controller': 'Absent',
+                  'ROC temperature(Degree Celsius)': 55 + a},
+        'Policies': dict(('Policy %d' % i, 'Enabled') for i in range(30)),
+        'Defaults': dict(('Default %d' % i, 'No') for i in range(40)),
+    }
+
+
+def storcli_drive(a, slot, spare):
+    enc = storcli_enclosure(a, slot)
+    name = 'Drive /c%d/e%d/s%d' % (a, enc, slot % SHELF_SLOTS)
+    failing = is_failing(a, slot)
+
+    return {
+        name: [{
+            'EID:Slt': '%d:%d' % (enc, slot % SHELF_SLOTS), 'DID': slot + 10, 'State': 'GHS' if spare else 'Onln',
+            'DG': '-' if spare else slot // VD_WIDTH, 'Size': '3.637 TB', 'Intf': 'SAS', 'Med': 'HDD', 'SED': 'N',
+            'PI': 'N', 'SeSz': '512B', 'Model': 'ST4000NM0023    ', 'Sp': 'U', 'Type': '-'
+        }],
+        name + ' - Detailed Information': {
+            name + ' State': {
+                'Shield Counter': 0, 'Media Error Count': int(failing), 'Other Error Count': 0,
+                'Drive Temperature': ' %dC (%.2f F)' % (30 + slot % 10, (30 + slot % 10) * 1.8 + 32),
+                'Predictive Failure Count': 0, 'S.M.A.R.T alert flagged by drive': 'No'
+            },
+            name + ' Device attributes': {
+                'SN': 'Z1Z3%05d' % (a * 1000 + slot), 'Manufacturer Id': 'SEAGATE ', 'Model Number': 'ST4000NM0023',
+                'NAND Vendor': 'NA', 'WWN': '5000C500%08X' % (a * 1000 + slot), 'Firmware Revision': 'GS0F',
+                'Raw size': '3.638 TB [0x1d1c0beb0 Sectors]', 'Coerced size': '3.637 TB [0x1d1a94800 Sectors]',
+                'Non Coerced size': '3.637 TB [0x1d1b0beb0 Sectors]', 'Device Speed': '6.0Gb/s',
+                'Link Speed': '12.0Gb/s', 'Write cache': 'N/A', 'Logical Sector Size': '512B',
+                'Physical Sector Size': '512B', 'Connector Name': 'C0.0 & C0.1 ', 'FRU/CRU': ' '
+            },
+            name + ' Policies/Settings': {
+                'Drive position': 'DriveGroup:%d, Span:0, Row:%d' % (slot // VD_WIDTH, slot % VD_WIDTH),
+                'Enclosure position': 1, 'Connected Port Number': '0(path0) ', 'Sequence Number': 2,
+                'Commissioned Spare': 'Yes' if spare else 'No', 'Emergency Spare': 'No',
+                'Last Predictive Failure Event Sequence Number': 0, 'Successful diagnostics completion on': 'N/A',
+                'SED Capable': 'No', 'SED Enabled': 'No', 'Secured': 'No', 'Cryptographic Erase Capable': 'No',
+                'Locked': 'No', 'Needs EKM Attention': 'No', 'PI Eligible': 'No', 'Certified': 'No',
+                'Wide Port Capable': 'No',
+                'Port Information': [{'Port': 0, 'Status': 'Active', 'Linkspeed': '12.0Gb/s',
+                                      'SAS address': '0x5000c500%08x' % (a * 1000 + slot)},
+                                     {'Port': 1, 'Status': 'Active', 'Linkspeed': '12.0Gb/s',
+                                      'SAS address': '0x0'}]
+            },
+            'Inquiry Data': ' '.join('%02x' % ((slot * 31 + i) % 256) for i in range(512))
+        }
+    }
+
+
+def md_fixture(fixture, adapters, drives):
+    """ Software RAID has no adapters, all drives are attached directly
+    """
+    vds, spares = layout(1, drives)[0]
+    uuids = ['%08x:%08x:%08x:%08x' % (0x1a2b3c4d, vd, vd * 7, vd * 13) for vd in range(len(vds))]
+
+    fixture.file('/etc/mtab', MD_MTAB)
+    fixture.command(['mdadm', '--detail', '--scan'], ''.join(
+        'ARRAY /dev/md%d metadata=1.2 name=bench:%d UUID=%s\n' % (vd, vd, uuids[vd]) for vd in range(len(vds))))
+
+    lsblk = ['sda 8:0 INTEL\\x20SSDSC2KB48 447.1G running']
+    for slot in range(drives):
+        name = md_disk_name(slot + 1)
+        lsblk.append('%s %d:%d ST4000NM0035\\x201BV 3.7T %s' % (
+            name, 8 + slot // 16 * 57, slot % 16 * 16, 'offline' if is_failing(0, slot) else 'running'))
+        fixture.exists('/dev/%s1' % name)
+
+        vd = slot // VD_WIDTH if slot not in spares else None
+        fixture.command(['mdadm', '--examine', '/dev/%s1' % name], MD_EXAMINE.format(
+            name=name, uuid=uuids[vd] if vd is not None else uuids[0], slot=slot,
+            role='spare' if vd is None else 'Active device %d' % (slot % VD_WIDTH)))
+
+    fixture.command(['lsblk', '--ascii', '--nodeps', '--noheadings', '--raw', '--output',
+                     'NAME,MAJ:MIN,MODEL,SIZE,STATE'], '\n'.join(lsblk) + '\n')
+
+    for vd, slots in enumerate(vds):
+        fixture.command(['mdadm', '--detail', '/dev/md%d' % vd], MD_DETAIL.format(
+            vd=vd, uuid=uuids[vd], size=(len(slots) - 2) * 3907017728, count=len(slots),
+            devices=''.join('    %5d %7d %7d %8d      active sync   /dev/%s1\n' % (
+                i, 8, 17 + slot * 16, i, md_disk_name(slot + 1)) for i, slot in enumerate(slots))))
+
+    md_sysfs_fixture(fixture, vds, spares)
+
+
+def md_sysfs_fixture(fixture, vds, spares):
+    """ /proc/mdstat and the sysfs attributes of the same arrays
+    """
+    mdstat = ['Personalities : [raid6] [raid5] [raid4]']
+
+    for vd, slots in enumerate(vds):
+        members = [(slot, i) for i, slot in enumerate(slots)]
+        if vd == 0:
+            members += [(slot, None) for slot in spares]
+
+        array = '/sys/block/md%d' % vd
+        failed = [slot for slot in slots if is_failing(0, slot)]
+
+        mdstat.append('md%d : active raid6 %s' % (vd, ' '.join('%s1[%d]%s' % (
+            md_disk_name(slot + 1), n, '(S)' if i is None else '(F)' if is_failing(0, slot) else '')
+            for n, (slot, i) in enumerate(members))))
+        mdstat.append('      %d blocks super 1.2 level 6, 512k chunk, algorithm 2 [%d/%d] [%s]' % (
+            (len(slots) - 2) * 3907017728, len(slots), len(slots) - len(failed),
+            ''.join('_' if is_failing(0, slot) else 'U' for slot in slots)))
+        mdstat.append('      bitmap: 0/30 pages [0KB], 65536KB chunk')
+        mdstat.append('')
+
+        fixture.exists(array + '/md')
+        fixture.file(array + '/size', '%d\n' % ((len(slots) - 2) * 3907017728 * 2))
+        for attr, value in (('array_state', 'clean'), ('level', 'raid6'), ('raid_disks', len(slots)),
+                            ('degraded', len(failed)), ('sync_action', 'idle'), ('layout', 2)):
+            fixture.file('%s/md/%s' % (array, attr), '%s\n' % value)
+
+        for slot, i in members:
+            name = md_disk_name(slot + 1)
+            member = '%s/md/dev-%s1' % (array, name)
+
+            if is_failing(0, slot):
+                state, role = 'faulty', 'none'
+            elif i is None:
+                state, role = 'spare', 'none'
+            else:
+                state, role = 'in_sync', i
+
+            fixture.file(member + '/state', state + '\n')
+            fixture.file(member + '/slot', '%s\n' % role)
+            fixture.file(member + '/errors', '0\n')
+
+            disk = '/sys/block/%s' % name
+            fixture.file(disk + '/dev', '%d:%d\n' % (8 + slot // 16 * 57, slot % 16 * 16))
+            fixture.file(disk + '/size', '7814037168\n')
+            fixture.file(disk + '/device/model', 'ST4000NM0035-1BV\n')
+            fixture.file(disk + '/device/state', '%s\n' % ('offline' if is_failing(0, slot) else 'running'))
+
+    mdstat.append('unused devices: <none>')
+    fixture.file('/proc/mdstat', '\n'.join(mdstat) + '\n')
+
+
+def md_disk_name(i):
+    name = ''
+    i += 1
+    while i:
+        i, rem = divmod(i - 1, 26)
+        name = chr(ord('a') + rem) + name
+    return 'sd' + name
+
+
+PROP_RE = re.compile(r'(.*?)\s*:\s*(.+)')
+
+
+def regex_records(lines):
+    """ Per line regex parsing of megacli pdlist that the backends used before kvparse, kept as a reference
+
+    :param iterable[str] lines: Output lines
+    :rtype: iterator[dict[str, str]]
+    """
+    adapter = None
+    drive = {}
+    blank_count = 0
+
+    for line in lines:
+        line = line.rstrip()
+
+        if not line:
+            blank_count += 1
+        else:
+            blank_count = 0
+
+        if blank_count == 3 and drive:
+            yield drive
+            drive = {}
+
+        if line.startswith('Adapter #'):
+            adapter = line.replace('Adapter #', '')
+
+        if adapter is not None:
+            drive['adapter_id'] = adapter
+
+            m = PROP_RE.match(line)
+            if m:
+                # noinspection PyTypeChecker
+                drive.update([m.groups()])
+            elif line.startswith('Hotspare Information:'):
+                drive['hotspare'] = True
+
+
+BACKENDS = {
+    'megacli': (MegaCliReport, megacli_fixture),
+    'omreport': (OmreportReport, omreport_fixture),
+    'storcli': (StorCliReport, storcli_fixture),
+    'md': (MdReport, md_fixture),
+    'md-mdadm': (partial(MdReport, sysfs=False), md_fixture),
+}
+
+# Parsers alone, on megacli pdlist output
+PARSERS = {
+    'kv-regex': regex_records,
+    'kv-blocks': PHYSICAL_DRIVES.parse,
+}
+
+
+def parse_sizes(value):
+    """
+    :param str value: Comma separated sizes as ADAPTERSxDRIVES, e.g. 1x8,4x500
+    :rtype: list[tuple[int, int]]
+    """
+    sizes = []
+    for size in value.split(','):
+        adapters, drives = size.strip().split('x')
+        sizes.append((int(adapters), int(drives)))
+    return sizes
+
+
+def peak_memory(func, repeat=2):
+    """ Lowest peak memory of a few calls, a single call can land on the resize of an interpreter wide table
+
+    :param () -> Any func: Function to trace
+    :param int repeat: Number of calls
+    :return: Peak memory in KiB, None on python 2
+    :rtype: float
+    """
+    if tracemalloc is None:
+        return None
+
+    peaks = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1] / 1024.)
+        tracemalloc.stop()
+
+    return min(peaks)
+
+
+def measure(backend, adapters, drives, repeat=10):
+    """ Generate a fixture and replay it through the report of backend
+
+    :param str backend: One of BACKENDS
+    :param int adapters: Number of adapters
+    :param int drives: Number of drives on all adapters
+    :param int repeat: Keep the best time of this many collections
+    :return: Parse and connect time in seconds, peak memory in KiB (None on python 2) and parsed drive counts
+    :rtype: dict[str, Any]
+    """
+    report_class, generate = BACKENDS[backend]
+    directory = tempfile.mkdtemp(prefix='ccbr_bench_')
+
+    try:
+        generate(Fixture(directory), adapters, drives)
+        capture.configure(directory, Capture.REPLAY)
+
+        report = report_class()
+        report.collect_all_data()  # Warm up, the first run also pays for reading the fixture from disk
+        parse = connect = float('inf')
+
+        gc.disable()  # Collections triggered by earlier runs would land on random timings
+        try:
+            for _ in range(repeat):
+                started = timer()
+                report.collect_all_data(connect=False)
+                parsed = timer()
+                report.connect_data()
+                connected = timer()
+
+                parse = min(parse, parsed - started)
+                connect = min(connect, connected - parsed)
+                gc.collect()
+        finally:
+            gc.enable()
+
+        peak = peak_memory(report.collect_all_data)
+
+        return {
+            'parse': parse,
+            'connect': connect,
+            'peak_kb': peak,
+            'physical_drives': len(report.phy_drives),
+            'logical_drives': len(report.log_drives),
+        }
+    finally:
+        capture.configure()
+        shutil.rmtree(directory)
+
+
+def measure_parser(parser, adapters, drives, repeat=10):
+    """ Parse megacli pdlist output of the given size without running a report
+
+    :param str parser: One of PARSERS
+    :param int adapters: Number of adapters
+    :param int drives: Number of drives on all adapters
+    :param int repeat: Keep the best time of this many runs
+    :return: Parse time in seconds, peak memory in KiB (None on python 2) and number of records
+    :rtype: dict[str, Any]
+    """
+    parse = PARSERS[parser]
+
+    fixture = MemoryFixture()
+    megacli_fixture(fixture, adapters, drives)
+    lines = fixture.outputs[('megacli', 'pdlist', 'aall', 'nolog')].splitlines()
+
+    records = sum(1 for _ in parse(lines))
+    best = float('inf')
+
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = timer()
+            for _record in parse(lines):
+                pass
+            best = min(best, timer() - started)
+            gc.collect()
+    finally:
+        gc.enable()
+
+    peak = peak_memory(lambda: list(parse(lines)))
+
+    return {
+        'parse': best,
+        'connect': 0.,
+        'peak_kb': peak,
+        'physical_drives': records,
+        'logical_drives': 0,
+    }
+
+
+def run(backends, sizes, repeat=10):
+    """
+    :param list[str] backends: Backends to benchmark
+    :param list[tuple[int, int]] sizes: Adapters and drives of each fixture
+    :param int repeat: Keep the best time of this many collections
+    :return: Results by name, backend:ADAPTERSxDRIVES
+    :rtype: dict[str, dict[str, Any]]
+    """
+    results = {}
+
+    for backend in backends:
+        for adapters, drives in sizes:
+            name = '%s:%dx%d' % (backend, adapters, drives)
+            if backend in PARSERS:
+                results[name] = measure_parser(backend, adapters, drives, repeat)
+            else:
+                results[name] = measure(backend, adapters, drives, repeat)
+            log.info("%s: %s", name, results[name])
+
+    return results
+
+
+def memory_slack(peak_kb):
+    """ Peak memory within this much of the baseline is noise. An interpreter table resize adds the same amount to
+    any fixture, but a fixed slack would be larger than the whole peak of the small ones
+
+    :param float peak_kb: Baseline peak memory in KiB
+    :rtype: float
+    """
+    return min(MEMORY_SLACK, peak_kb * MEMORY_SLACK_FRACTION)
+
+
+def compare(results, baseline, tolerance=1.0, memory_tolerance=0.2):
+    """ Find results that are worse than the baseline
+
+    :param dict[str, dict[str, Any]] results: Results returned by run
+    :param dict[str, dict[str, Any]] baseline: Stored results
+    :param float tolerance: Allowed relative slowdown
+    :param float memory_tolerance: Allowed relative growth of peak memory
+    :return: Description of every regression
+    :rtype: list[str]
+    """
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        for key in ('parse', 'connect'):
+            if result[key] > base[key] * (1 + tolerance) + TIME_SLACK:
+                regressions.append('%s %s: %.2fms, baseline %.2fms' % (name, key, result[key] * 1000,
+                                                                      base[key] * 1000))
+
+        if result['peak_kb'] is not None and base.get('peak_kb') and \
+                result['peak_kb'] > base['peak_kb'] * (1 + memory_tolerance) + memory_slack(base['peak_kb']):
+            regressions.append('%s peak memory: %.0fKiB, baseline %.0fKiB' % (name, result['peak_kb'],
+                                                                            base['peak_kb']))
+
+    return regressions
+
+
+def load_baseline(path):
+    """
+    :param str path: Baseline file
+    :return: Baseline results, empty if there is no baseline yet
+    :rtype: dict[str, dict[str, Any]]
+    """
+    try:
+        with open(path) as fio:
+            baseline = json.load(fio)
+    except (IOError, OSError):
+        return {}
+
+    if baseline.get('python') != platform.python_version():
+        log.warning("Baseline was recorded on python %s, running on %s", baseline.get('python'),
+                    platform.python_version())
+
+    return baseline['results']
+
+
+def save_baseline(path, results):
+    data = {'python': platform.python_version(), 'results': results}
+    atomic_write(path, json.dumps(data, indent=2, sort_keys=True).encode())
+
+
+def print_results(results, baseline):
+    print('%-22s %10s %10s %10s %10s %6s %6s' % ('fixture', 'parse ms', 'base ms', 'connect ms', 'peak KiB',
+                                                'pds', 'lds'))
+    for name, result in sorted(results.items(), key=lambda r: (r[0].split(':')[0], parse_sizes(r[0].split(':')[1]))):
+        base = baseline.get(name, {})
+        print('%-22s %10.2f %10s %10.2f %10s %6d %6d' % (
+            name, result['parse'] * 1000, '%.2f' % (base['parse'] * 1000) if base else '-', result['connect'] * 1000,
+            '%.0f' % result['peak_kb'] if result['peak_kb'] is not None else '-', result['physical_drives'],
+            result['logical_drives']))
+
+
+def main():
+    # noinspection PyCompatibility
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark RAID CLI parsers on synthetic controller output')
+    parser.add_argument('-b', '--backends', default=','.join(sorted(BACKENDS) + sorted(PARSERS)),
+                        help='Comma separated backends or parsers to benchmark.')
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES,
+                        help='Comma separated fixture sizes as ADAPTERSxDRIVES.')
+    parser.add_argument('-r', '--repeat', type=int, default=10,
+                        help='Keep the best time of this many collections.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Stored results to compare with.')
+    parser.add_argument('--save', default=False, action='store_true',
+                        help='Store the results as the new baseline instead of comparing.')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='Allowed relative slowdown before failing.')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2,
+                        help='Allowed relative growth of peak memory before failing.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(args.backends.split(','), parse_sizes(args.sizes), args.repeat)
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print_results(results, results)
+        print("Saved baseline to %s" % args.baseline)
+        return
+
+    baseline = load_baseline(args.baseline)
+    print_results(results, baseline)
+
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print("REGRESSION %s" % regression)
+
+    if regressions:
+        sys.exit(1)
+
+
+MEGACLI_ADAPTER = '''
+Adapter #{a}
+
+==============================================================================
+                    Versions
+                ================
+Product Name    : PERC H730P Adapter
+Serial No       : 5C{a:08d}
+FW Package Build: 25.5.6.0009
+
+                    Mfg. Data
+                ================
+Mfg. Date       : 04/22/17
+Rework Date     : 04/22/17
+Revision No     : A04
+Battery FRU     : N/A
+
+                Image Versions in Flash:
+                ================
+BIOS Version       : 6.33.01.0_4.19.08.00_0x06120304
+Ctrl-R Version     : 5.18-0701
+FW Version         : 4.300.00-8366
+NVDATA Version     : 3.1511.00-0028
+Boot Block Version : 3.07.00.00-0003
+
+                Pending Images in Flash
+                ================
+None
+
+                PCI Info
+                ================
+Controller Id   : 0000
+Vendor Id       : 1000
+Device Id       : 005d
+SubVendorId     : 1028
+SubDeviceId     : 1f47
+
+Host Interface  : PCIE
+
+ChipRevision    : C0
+
+Link Speed     : 0
+Number of Frontend Port: 0
+Device Interface  : PCIE
+
+Number of Backend Port: 8
+Port  :  Address
+0        500056b3{a:08x}ff
+1        0000000000000000
+
+                HW Configuration
+                ================
+SAS Address      : 5d4ae520{a:08x}
+BBU              : Present
+Alarm            : Absent
+NVRAM            : Present
+Serial Debugger  : Present
+Memory           : Present
+Flash            : Present
+Memory Size      : 2048MB
+TPM              : Absent
+On board Expander: Absent
+Upgrade Key      : Absent
+Temperature sensor for ROC    : Present
+Temperature sensor for controller    : Absent
+
+ROC temperature : 6{a}  degree Celsius
+
+                Settings
+                ================
+Current Time                     : 9:13:44 10/5, 2020
+Predictive Fail Poll Interval    : 300sec
+Interrupt Throttle Active Count  : 16
+Interrupt Throttle Completion    : 50us
+Rebuild Rate                     : 30%
+PR Rate                          : 30%
+BGI Rate                         : 30%
+Check Consistency Rate           : 30%
+Reconstruction Rate              : 30%
+Cache Flush Interval             : 4s
+Max Drives to Spinup at One Time : 2
+Delay Among Spinup Groups        : 12s
+Physical Drive Coercion Mode     : 128MB
+Cluster Mode                     : Disabled
+Alarm                            : Disabled
+Auto Rebuild                     : Enabled
+Battery Warning                  : Enabled
+Ecc Bucket Size                  : 255
+Ecc Bucket Leak Rate             : 240 Minutes
+Restore HotSpare on Insertion    : Disabled
+Expose Enclosure Devices         : Disabled
+Maintain PD Fail History         : Disabled
+Host Request Reordering          : Enabled
+Auto Detect BackPlane Enabled    : SGPIO/i2c SEP
+Load Balance Mode                : Auto
+Use FDE Only                     : Yes
+Security Key Assigned            : No
+Security Key Failed              : No
+Security Key Not Backedup        : No
+Default LD PowerSave Policy      : Controller Defined
+Maximum number of direct attached drives to spin up in 1 min : 20
+Auto Enhanced Import             : Yes
+Any Offline VD Cache Preserved   : No
+Allow Boot with Preserved Cache  : No
+Disable Online Controller Reset  : No
+PFK in NVRAM                     : No
+Use disk activity for locate     : No
+POST delay                       : 90 seconds
+BIOS Error Handling              : Stop On Errors
+Current boot mode                 :Normal
+'''
+
+MEGACLI_PD = '''
+Enclosure Device ID: {enc}
+Slot Number: {slot}
+Drive's position: DiskGroup: 0, Span: 0, Arm: {slot}
+Enclosure position: 1
+Device Id: {did}
+WWN: 5000C500{did:08X}
+Sequence Number: 2
+Media Error Count: 0
+Other Error Count: 0
+Predictive Failure Count: {pfc}
+Last Predictive Failure Event Seq Number: 0
+PD Type: SAS
+
+Raw Size: 3.638 TB [0x1d1c0beb0 Sectors]
+Non Coerced Size: 3.637 TB [0x1d1b0beb0 Sectors]
+Coerced Size: 3.637 TB [0x1d1a94800 Sectors]
+Sector Size:  512
+Logical Sector Size:  512
+Physical Sector Size:  512
+Firmware state: {state}
+{hotspare}Device Firmware Level: GS0F
+Shield Counter: 0
+Successful diagnostics completion on :  N/A
+SAS Address(0): 0x5000c500{did:08x}
+SAS Address(1): 0x0
+Connected Port Number: 0(path0)
+Inquiry Data: SEAGATE ST4000NM0023    GS0FZ1Z3{did:05d}
+FDE Capable: Not Capable
+FDE Enable: Disable
+Secured: Unsecured
+Locked: Unlocked
+Needs EKM Attention: No
+Foreign State: None
+Device Speed: 6.0Gb/s
+Link Speed: 12.0Gb/s
+Media Type: Hard Disk Device
+Drive Temperature :{temp}C (89.60 F)
+PI Eligibility:  No
+Drive is formatted for PI information:  No
+PI: No PI
+Port-0 :
+Port status: Active
+Port's Linkspeed: 12.0Gb/s
+Port-1 :
+Port status: Active
+Port's Linkspeed: 12.0Gb/s
+Drive has flagged a S.M.A.R.T alert : No
+
+
+'''
+
+MEGACLI_HOTSPARE = '''Hotspare Information:
+Type: Global, is revertible
+'''
+
+MEGACLI_VD = '''Virtual Drive: {vd} (Target Id: {vd})
+Name                :
+RAID Level          : Primary-6, Secondary-0, RAID Level Qualifier-3
+Size                : {size:.3f} TB
+Sector Size         : 512
+Is VD emulated      : No
+Parity Size         : 7.275 TB
+State               : Optimal
+Strip Size          : 256 KB
+Number Of Drives    : {drives}
+Span Depth          : 1
+Default Cache Policy: WriteBack, ReadAdaptive, Direct, No Write Cache if Bad BBU
+Current Cache Policy: WriteBack, ReadAdaptive, Direct, No Write Cache if Bad BBU
+Default Access Policy: Read/Write
+Current Access Policy: Read/Write
+Disk Cache Policy   : Disk's Default
+Encryption Type     : None
+Is VD Cached: No
+Number of Spans: 1
+Span: 0 - Number of PDs: {drives}
+'''
+
+MEGACLI_LD_PD = '''PD: {i} Information
+Enclosure Device ID: {enc}
+Slot Number: {slot}
+Drive's position: DiskGroup: 0, Span: 0, Arm: {i}
+Enclosure position: 1
+Device Id: {did}
+WWN: 5000C500{did:08X}
+Sequence Number: 2
+Media Error Count: 0
+Other Error Count: 0
+Predictive Failure Count: 0
+Last Predictive Failure Event Seq Number: 0
+PD Type: SAS
+
+Raw Size: 3.638 TB [0x1d1c0beb0 Sectors]
+Non Coerced Size: 3.637 TB [0x1d1b0beb0 Sectors]
+Coerced Size: 3.637 TB [0x1d1a94800 Sectors]
+Firmware state: Online, Spun Up
+Inquiry Data: SEAGATE ST4000NM0023    GS0FZ1Z3{did:05d}
+Drive Temperature :33C (91.40 F)
+Drive has flagged a S.M.A.R.T alert : No
+
+'''
+
+OMREPORT_CONTROLLERS = ''' Controller  PERC H730P Adapter (Slot 2)
+
+'''
+
+OMREPORT_CONTROLLER = '''Controller
+ID                                            : {a}
+Status                                        : Ok
+Name                                          : PERC H730P Adapter
+Slot ID                                       : PCI Slot {a}
+State                                         : Ready
+Firmware Version                              : 25.5.6.0009
+Minimum Required Firmware Version             : Not Applicable
+Driver Version                                : 07.714.04.00-rc1
+Minimum Required Driver Version               : Not Applicable
+Storport Driver Version                       : Not Applicable
+Minimum Required Storport Driver Version      : Not Applicable
+Number of Connectors                          : 2
+Rebuild Rate                                  : 30%
+BGI Rate                                      : 30%
+Check Consistency Rate                        : 30%
+Reconstruct Rate                              : 30%
+Alarm State                                   : Not Applicable
+Cluster Mode                                  : Not Applicable
+SCSI Initiator ID                             : Not Applicable
+Cache Memory Size                             : 2048 MB
+Patrol Read Mode                              : Auto
+Patrol Read State                             : Stopped
+Patrol Read Rate                              : 30%
+Patrol Read Iterations                        : 132
+Abort Check Consistency on Error              : Disabled
+Allow Revertible Hot Spare and Replace Member : Enabled
+Load Balance                                  : Not Applicable
+Auto Replace Member on Predictive Failure     : Disabled
+Redundant Path view                           : Not Applicable
+CacheCade Capable                             : Not Applicable
+Persistent Hot Spare                          : Disabled
+Encryption Capable                            : Yes
+Encryption Key Present                        : No
+Encryption Mode                               : None
+Preserved Cache                               : Not Applicable
+Spin Down Unconfigured Drives                 : Disabled
+Spin Down Hot Spares                          : Disabled
+Spin Down Configured Drives                   : Disabled
+Automatic Disk Power Saving (Idle C)          : Disabled
+Start Time (HH:MM)                            : Not Applicable
+Time Interval for Spin Up (in Hours)          : Not Applicable
+T10 Protection Information Capable            : No
+Non-RAID HDD Disk Cache Policy                : Unchanged
+Current Controller Mode                       : RAID
+
+'''
+
+OMREPORT_TITLE = '''List of %s Disks on Controller PERC H730P Adapter (Slot {a})
+
+Controller PERC H730P Adapter (Slot {a})
+'''
+
+OMREPORT_PDISK = '''ID                              : 0:{enc}:{slot}
+Status                          : {status}
+Name                            : Physical Disk 0:{enc}:{slot}
+State                           : Online
+Power Status                    : Spun Up
+Bus Protocol                    : SAS
+Media                           : HDD
+Part of Cache Pool              : Not Applicable
+Remaining Rated Write Endurance : Not Applicable
+Failure Predicted               : No
+Revision                        : GS0F
+Driver Version                  : Not Applicable
+Model Number                    : Not Applicable
+T10 PI Capable                  : No
+Certified                       : Yes
+Encryption Capable              : No
+Encrypted                       : Not Applicable
+Progress                        : Not Applicable
+Mirror Set ID                   : Not Applicable
+Capacity                        : 3,725.50 GB (4000225165312 bytes)
+Used RAID Disk Space            : 3,725.50 GB (4000225165312 bytes)
+Available RAID Disk Space       : 0.00 GB (0 bytes)
+Hot Spare                       : {hotspare}
+Vendor ID                       : DELL(tm)
+Product ID                      : ST4000NM0023
+Serial No.                      : Z1Z3{serial:05d}
+Part Number                     : TH0XKPK0SGW0076S07MUA00
+Negotiated Speed                : 6.00 Gbps
+Capable Speed                   : 6.00 Gbps
+PCIe Negotiated Link Width      : Not Applicable
+PCIe Maximum Link Width         : Not Applicable
+Sector Size                     : 512B
+Device Write Cache              : Not Applicable
+Manufacture Day                 : 02
+Manufacture Week                : 32
+Manufacture Year                : 2016
+SAS Address                     : 5000C500{serial:08X}
+Non-RAID HDD Disk Cache Policy  : Not Applicable
+Disk Cache Policy               : Not Applicable
+Sub Vendor                      : Not Available
+Cryptographic Erase Capable     : Yes
+
+'''
+
+OMREPORT_VDISK = '''ID                                : {vd}
+Status                            : Ok
+Name                              : data{vd}
+State                             : Ready
+Hot Spare Policy violated         : Not Assigned
+Encrypted                         : No
+Layout                            : RAID-6
+Size                              : {size:.2f} GB (29801801318400 bytes)
+T10 Protection Information Status : No
+Associated Fluid Cache State      : Not Applicable
+Device Name                       : /dev/sd{vd}
+Bus Protocol                      : SAS
+Media                             : HDD
+Read Policy                       : Adaptive Read Ahead
+Write Policy                      : Write Back
+Cache Policy                      : Not Applicable
+Stripe Element Size               : 256 KB
+Disk Cache Policy                 : Unchanged
+
+'''
+
+MD_MTAB = '''/dev/sda1 / xfs rw,relatime,attr2,inode64,noquota 0 0
+proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0
+sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0
+devtmpfs /dev devtmpfs rw,nosuid,size=65859732k,nr_inodes=16464933,mode=755 0 0
+tmpfs /dev/shm tmpfs rw,nosuid,nodev 0 0
+/dev/md0 /data xfs rw,relatime,attr2,inode64,sunit=1024,swidth=6144,noquota 0 0
+'''
+
+MD_EXAMINE = '''/dev/{name}1:
+          Magic : a92b4efc
+        Version : 1.2
+    Feature Map : 0x1
+     Array UUID : {uuid}
+           Name : bench:0
+  Creation Time : Tue Mar  3 10:24:13 2020
+     Raid Level : raid6
+   Raid Devices : 8
+
+ Avail Dev Size : 7813772976 (3725.90 GiB 4000.65 GB)
+     Array Size : 23441317888 (22355.38 GiB 24003.91 GB)
+  Used Dev Size : 7813772629 (3725.90 GiB 4000.65 GB)
+    Data Offset : 264192 sectors
+   Super Offset : 8 sectors
+   Unused Space : before=264112 sectors, after=347 sectors
+          State : clean
+    Device UUID : 5e0c{slot:04x}:8d1e2f30:41526374:8596a7b8
+
+Internal Bitmap : 8 sectors from superblock
+    Update Time : Mon Oct  5 09:13:44 2020
+  Bad Block Log : 512 entries available at offset 24 sectors
+       Checksum : 5a4c1d2e - correct
+         Events : 41256
+
+         Layout : left-symmetric
+     Chunk Size : 512K
+
+   Device Role : {role}
+   Array State : AAAAAAAA ('A' == active, '.' == missing, 'R' == replacing)
+'''
+
+MD_DETAIL = '''/dev/md{vd}:
+           Version : 1.2
+     Creation Time : Tue Mar  3 10:24:13 2020
+        Raid Level : raid6
+        Array Size : {size} (22355.38 GiB 24003.91 GB)
+     Used Dev Size : 3906886314 (3725.90 GiB 4000.65 GB)
+      Raid Devices : {count}
+     Total Devices : {count}
+       Persistence : Superblock is persistent
+
+     Intent Bitmap : Internal
+
+       Update Time : Mon Oct  5 09:13:44 2020
+             State : clean
+    Active Devices : {count}
+   Working Devices : {count}
+    Failed Devices : 0
+     Spare Devices : 0
+
+            Layout : left-symmetric
+        Chunk Size : 512K
+
+Consistency Policy : bitmap
+
+              Name : bench:{vd}
+              UUID : {uuid}
+            Events : 41256
+
+    Number   Major   Minor   RaidDevice State
+{devices}'''
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,14 @@
 import json
 import logging
 import os
-import socket
+import time
 
-from ccbr_server.common import get_config
+from ccbr_server.collector import collect_reports, Collector
+from ccbr_server.common import get_config, Report, budget, parse_fields, capture, Capture
 from ccbr_server.disk_hdsentinel import HDSentinelReport
 from ccbr_server.disk_smartctl import SmartReport
 from ccbr_server.disk_usage import UsageReport
+from ccbr_server.outbox import get_outbox
 from ccbr_server.raid import RaidReport, RaidReportException
 from ccbr_server.raid_md import MdReport
 from ccbr_server.raid_megacli import MegaCliReport
@@ -16,27 +18,40 @@ from ccbr_server.stale_nfs import StaleNFSReport
 
 log = logging.getLogger(__file__)
 
-try:
-    # noinspection PyCompatibility
-    from urllib.request import urlopen, Request
-except ImportError:
-    # noinspection PyCompatibility
-    from urllib2 import urlopen, Request
-
 
-def all_reports(parser, args, config):
-    """
+def build_reports(parser, enabled_checks, config):
+    """ Initialize a report for each enabled check
 
     :param ArgumentParser parser:
-    :param Namespace args:
+    :param str enabled_checks: Comma separated list of checks
     :param configparser.ConfigParser config:
+    :return: Check name, which is also its config section, paired with its report
+    :rtype: list[tuple[str, Report]]
     """
     reports = []
 
-    # Print by default if we're in offline mode
-    stdout = args.print_reports or args.offline
+    raid_fields = parse_fields(config.get('raid', 'fields'))
+
+    # Options of each RAID manager, also used when it is detected automatically
+    raid_options = {
+        'omreport': {
+            'concurrency': config.get('raid_omreport', 'concurrency'),
+        },
+        'md': {
+            'timeout': config.get('raid_md', 'timeout'),
+            'concurrency': config.get('raid_md', 'concurrency'),
+            'sysfs': config.getboolean('raid_md', 'sysfs'),
+            'watch': config.getboolean('raid_md', 'watch'),
+            'slow_sync': config.get('raid_md', 'slow_sync'),
+            'state_path': os.path.join(config.get('DEFAULT', 'state_dir'), 'md_sync.json'),
+            'adaptive_timeout': config.getboolean('raid_md', 'adaptive_timeout'),
+            'min_timeout': config.get('raid_md', 'min_timeout'),
+            'max_timeout': config.get('raid_md', 'max_timeout'),
+            'latency_path': os.path.join(config.get('DEFAULT', 'state_dir'), 'md_latency.json'),
+        },
+    }
 
-    for check in args.enabled_checks.split(','):
+    for check in enabled_checks.split(','):
         if check == 'raid':
             log.debug("Initializing RAID report")
             report = None
@@ -44,59 +59,278 @@ def all_reports(parser, args, config):
             if config.has_option('raid', 'type'):
                 raid_type = config.get('raid', 'type')
                 if raid_type == 'megacli':
-                    report = MegaCliReport()
+                    report = MegaCliReport(fields=raid_fields)
                 elif raid_type == 'storcli':
-                    report = StorCliReport()
+                    report = StorCliReport(fields=raid_fields)
                 elif raid_type == 'omreport':
-                    report = OmreportReport()
+                    report = OmreportReport(fields=raid_fields, **raid_options['omreport'])
                 elif raid_type == 'md':
-                    report = MdReport(timeout=config.get('raid_md', 'timeout'),
-                                      concurrency=config.get('raid_md', 'concurrency'))
+                    report = MdReport(fields=raid_fields, **raid_options['md'])
 
             if report is None:
                 try:
-                    report = RaidReport.automatic_cli()
+                    report = RaidReport.automatic_cli(
+                        fields=raid_fields,
+                        options=raid_options,
+                        cache_path=os.path.join(config.get('DEFAULT', 'state_dir'), 'raid_manager.json'))
                 except RaidReportException:
                     parser.error("Can't find a supported RAID manager")
 
             log.info("Adding %s to reports", report.__class__.__name__)
 
-            reports.append(report)
+            reports.append((check, report))
         elif check == 'nfs':
             log.info("Adding StaleNFSReport to reports")
-            reports.append(StaleNFSReport(timeout=config.get('nfs', 'stale_timeout'),
-                                          concurrency=config.get('nfs', 'concurrency')))
+            reports.append((check, StaleNFSReport(
+                timeout=config.get('nfs', 'stale_timeout'),
+                concurrency=config.get('nfs', 'concurrency'),
+                adaptive_timeout=config.getboolean('nfs', 'adaptive_timeout'),
+                min_timeout=config.get('nfs', 'min_timeout'),
+                max_timeout=config.get('nfs', 'max_timeout'),
+                latency_path=os.path.join(config.get('DEFAULT', 'state_dir'), 'nfs_latency.json'))))
         elif check == 'disk_usage':
             log.info("Adding UsageReport to reports")
-            reports.append(UsageReport())
+            reports.append((check, UsageReport()))
         elif check == 'hdsentinel':
             log.info("Adding HDSentinelReport to reports")
-            reports.append(HDSentinelReport())
+            reports.append((check, HDSentinelReport()))
         elif check == 'smart':
             log.info("Adding SmartReport to reports")
-            reports.append(SmartReport(timeout=config.get('smart', 'timeout'),
-                                       concurrency=config.get('smart', 'concurrency')))
+            reports.append((check, SmartReport(
+                timeout=config.get('smart', 'timeout'),
+                concurrency=config.get('smart', 'concurrency'),
+                controller_concurrency=config.get('smart', 'controller_concurrency'),
+                fields=parse_fields(config.get('smart', 'fields')),
+                cache_ttl=config.get('smart', 'cache_ttl'),
+                standby=config.getboolean('smart', 'standby'),
+                incremental_logs=config.getboolean('smart', 'incremental_logs'),
+                state_path=os.path.join(config.get('DEFAULT', 'state_dir'), 'smart_cache.json'),
+                adaptive_timeout=config.getboolean('smart', 'adaptive_timeout'),
+                min_timeout=config.get('smart', 'min_timeout'),
+                max_timeout=config.get('smart', 'max_timeout'),
+                latency_path=os.path.join(config.get('DEFAULT', 'state_dir'), 'smart_latency.json'),
+                logs_path=os.path.join(config.get('DEFAULT', 'state_dir'), 'smart_logs.json'))))
+
+    return reports
+
+
+def print_report(report, data, done):
+    """ Print a collected report, or its stub if collection didn't succeed
+
+    :param Report report:
+    :param dict[str, Any] data: Dictionary representation of this report
+    :param bool done: Report collected successfully
+    """
+    if done:
+        report.stdout()
+    else:
+        print("%s: %s" % (report.name, json.dumps(without_meta(data), sort_keys=True)))
+
+
+def acknowledge_reports(reports):
+    """ Hand each report its data from payloads the monitoring site accepted
+
+    :param list[tuple[str, Report]] reports: Reports returned by build_reports
+    :return: Callback for the outbox
+    :rtype: (dict[str, Any]) -> None
+    """
+    def acknowledged(payload):
+        for _check, report in reports:
+            if report.name in payload['reports']:
+                report.acknowledged(payload['reports'][report.name])
+
+    return acknowledged
+
+
+def without_meta(data):
+    """ Report data without its collection timing, which is different every time
+
+    :param dict[str, Any] data: Dictionary representation of a report
+    :rtype: dict[str, Any]
+    """
+    return dict((k, v) for k, v in data.items() if k != '_meta')
+
+
+def print_profile(reports, width=40):
+    """ Print a waterfall of external commands run by each report on a shared time axis
+
+    :param list[Report] reports: Collected reports
+    :param int width: Width of the time axis in characters
+    """
+    metas = [(r, r.meta) for r in reports if r.meta is not None]
+    if not metas:
+        return
+
+    origin = min(m.started for _r, m in metas)
+    end = max([m.started + (m.wall_time or 0) for _r, m in metas] +
+              [c.started + c.duration for _r, m in metas for c in m.commands])
+    scale = width / max(end - origin, 1e-6)
+
+    def bar(start, duration, queued=0.):
+        begin = int((start - queued - origin) * scale)
+        run = int((start - origin) * scale)
+        stop = max(int((start + duration - origin) * scale), run + 1)
+        return (' ' * begin + '.' * (run - begin) + '=' * (stop - run)).ljust(width)[:width]
+
+    print("Total %.2fs, '.' waiting for command budget, '=' running" % (end - origin))
+
+    for report, meta in metas:
+        print("%-12s |%s| wall %.2fs cpu %.2fs, %d commands" % (
+            report.name, bar(meta.started, meta.wall_time or 0), meta.wall_time or 0, meta.cpu_time,
+            len(meta.commands)))
+
+        for c in sorted(meta.commands, key=lambda x: x.started):
+            print("%-12s |%s| %.2fs rc %s %dB%s %s" % (
+                '', bar(c.started, c.duration, c.queued), c.duration, c.returncode, c.size,
+                ' TIMEOUT' if c.timed_out else '', ' '.join(c.cmd)))
+
+
+def all_reports(parser, args, config):
+    """
+
+    :param ArgumentParser parser:
+    :param Namespace args:
+    :param configparser.ConfigParser config:
+    """
+    reports = build_reports(parser, args.enabled_checks, config)
+
+    # Print by default if we're in offline mode
+    stdout = args.print_reports or args.offline
 
     post = {
+        'timestamp': int(time.time()),
         'reports': {}
     }
 
-    for report in reports:
-        report.collect_data()
-        post['reports'][report.name] = report.to_dict()
+    # Reports are collected concurrently, one that misses its deadline is sent as a stub
+    for report, data, done in collect_reports([(r, config.getfloat(c, 'deadline')) for c, r in reports]):
+        post['reports'][report.name] = data
 
         if stdout:
-            report.stdout()
+            print_report(report, data, done)
+
+    if args.profile:
+        print_profile([r for _c, r in reports])
+
+    if not args.offline:  # POST here, anything that can't be sent now waits in the spool for the next run
+        outbox = get_outbox(config, on_ack=acknowledge_reports(reports))
+        outbox.put(post)
+        outbox.drain()
+
+
+class Daemon(object):
+    """ Collect each report on its own interval, or as soon as it reports a change, and POST only the reports whose
+    data changed since they were last spooled
+
+    :type reports: list[Report]
+    :type outbox: ccbr_server.outbox.Outbox
+    :type last_sent: dict[str, str]
+    :type overdue: set[str]
+    """
+
+    def __init__(self, reports, intervals, deadlines, outbox=None, stdout=False):
+        """
+        :param list[Report] reports: Reports to collect
+        :param dict[str, float] intervals: Seconds between two collections of each report by name
+        :param dict[str, float] deadlines: Seconds each report by name has to finish collecting
+        :param ccbr_server.outbox.Outbox outbox: Outbox to send changed reports with, nothing is sent if None
+        :param bool stdout: Print each report when it is collected
+        """
+        self.reports = reports
+        self.intervals = intervals
+        self.deadlines = deadlines
+        self.outbox = outbox
+        self.stdout = stdout
+
+        self.collector = Collector()
+        self.next_runs = dict((r.name, 0.) for r in reports)
+        self.last_sent = {}  # report name -> json of the last data spooled
+        self.overdue = set()  # Reports that were due while still being collected, collected again once that finishes
+
+        if outbox is not None:
+            outbox.on_drop = self.dropped
+
+    def dropped(self, payload):
+        """ The outbox dropped a payload without sending it, its reports are sent again even if they didn't change
+
+        :param dict[str, Any] payload: Dropped payload
+        """
+        for name in payload['reports']:
+            self.last_sent.pop(name, None)
+
+    def run(self):
+        # Reports that can watch the system, e.g. md arrays, are collected as soon as they see a change
+        for report in self.reports:
+            self.collector.watch(report)
+
+        while True:
+            self.tick()
+
+    def tick(self):
+        """ Start the reports that are due, wait for the next one to finish or come due and send what changed
+        """
+        for name in self.collector.take_requests():
+            log.info("%s changed, collecting it now", name)
+            self.next_runs[name] = 0.
 
-    if not args.offline:  # POST here
-        if not config.get('DEFAULT', 'hostname'):
-            config.set('DEFAULT', 'hostname', socket.gethostname().split('.')[0])
+        now = time.time()
 
-        log.info("Sending reports to %s", config.get('DEFAULT', 'post_url'))
+        for report in self.reports:
+            if self.next_runs[report.name] <= now:
+                self.next_runs[report.name] = now + self.intervals[report.name]
+                if not self.collector.start(report, self.deadlines[report.name]):
+                    self.overdue.add(report.name)
 
-        req = Request(config.get('DEFAULT', 'post_url'))
-        req.add_header('Content-Type', 'application/json')
-        _ = urlopen(req, json.dumps(post, separators=(',', ':')).encode())  # Ignore response for now
+        post = {
+            'timestamp': int(time.time()),
+            'reports': {}
+        }
+        changed = {}
+
+        for report, data, done in self.collector.poll(max(0., min(self.next_runs.values()) - time.time())):
+            if self.stdout:
+                print_report(report, data, done)
+
+            data_json = json.dumps(without_meta(data), sort_keys=True)
+            if self.last_sent.get(report.name) != data_json:
+                changed[report.name] = data_json
+                post['reports'][report.name] = data
+
+        for name in list(self.overdue):
+            if name not in self.collector.threads:
+                self.overdue.discard(name)
+                self.next_runs[name] = 0.
+
+        if self.outbox is None:
+            self.last_sent.update(changed)
+            return
+
+        try:
+            if post['reports']:
+                self.outbox.put(post)
+                self.last_sent.update(changed)
+            self.outbox.drain()  # Also retries anything left over from earlier ticks
+        except (IOError, OSError) as e:  # e.g. a full disk, the reports that weren't spooled are sent next time
+            log.error("Spooling reports failed: %s", e)
+
+
+def daemon_reports(parser, args, config):
+    """ Keep reports alive and collect each one on its own interval, POST only the reports that changed
+
+    :param ArgumentParser parser:
+    :param Namespace args:
+    :param configparser.ConfigParser config:
+    """
+    reports = build_reports(parser, args.enabled_checks, config)
+
+    # Print by default if we're in offline mode
+    stdout = args.print_reports or args.offline
+
+    Daemon([r for _c, r in reports],
+           intervals=dict((r.name, config.getfloat(c, 'interval')) for c, r in reports),
+           deadlines=dict((r.name, config.getfloat(c, 'deadline')) for c, r in reports),
+           outbox=None if args.offline else get_outbox(config, on_ack=acknowledge_reports(reports)),
+           stdout=stdout).run()
 
 
 def main():
@@ -124,15 +358,43 @@ def main():
                             help='Do not POST to URL, just print the report to stdout.')
     parser_all.add_argument('-p', '--print-reports', default=False, action='store_true',
                             help='Print each report to stdout.')
+    parser_all.add_argument('--profile', default=False, action='store_true',
+                            help='Print a waterfall of external commands run by each report.')
+    parser_capture = parser_all.add_mutually_exclusive_group()
+    parser_capture.add_argument('--record', metavar='DIR',
+                                help='Save raw output and exit code of every external command into DIR.')
+    parser_capture.add_argument('--replay', metavar='DIR',
+                                help='Run the reports on output recorded with --record instead of the system, '
+                                     'implies --offline.')
     parser_all.set_defaults(func=all_reports)
 
+    parser_daemon = subparsers.add_parser('daemon', help='Keep running and report each check on its own interval')
+    parser_daemon.add_argument('-c', '--enabled-checks',
+                               default=config.get('DEFAULT', 'enabled_checks'))
+    parser_daemon.add_argument('-o', '--offline', default=False, action='store_true',
+                               help='Do not POST to URL, just print the reports to stdout.')
+    parser_daemon.add_argument('-p', '--print-reports', default=False, action='store_true',
+                               help='Print each report to stdout when it is collected.')
+    parser_daemon.set_defaults(func=daemon_reports)
+
     args = parser.parse_args()
 
+    if getattr(args, 'record', None):
+        capture.configure(args.record, Capture.RECORD)
+    elif getattr(args, 'replay', None):
+        capture.configure(args.replay, Capture.REPLAY)
+        args.offline = True  # Replayed reports describe another machine, never send them
+
     # Logging
     log_fmt = "[%(asctime)-15s] %(name)s %(levelname)s %(message)s"
     log.setLevel(max(5 - args.verbose_count, 0) * 10)
     logging.basicConfig(format=log_fmt, level=log.level)
 
+    # All reports draw from the same budget of concurrent external commands
+    budget.configure(commands=config.get('budget', 'commands'),
+                     io_probes=config.get('budget', 'io_probes'),
+                     group_limit=config.get('budget', 'controller'))
+
     # noinspection PyStatementEffect
     args.func(parser, args, config)
 
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__file__)
+
+
+class CollectThread(threading.Thread):
+    """ Run collect_data of a single report in the background
+
+    :type report: ccbr_server.common.Report
+    :type error: Exception
+    """
+
+    def __init__(self, report, deadline, finished):
+        """
+        :param ccbr_server.common.Report report: Report to collect
+        :param float deadline: Seconds this report has to finish collecting
+        :param threading.Condition finished: Notified when collection is done
+        """
+        super(CollectThread, self).__init__(name='collect-%s' % report.name)
+        self.daemon = True  # Don't let a hung report keep the interpreter alive
+
+        self.report = report
+        self.deadline = deadline
+        self.expires = time.time() + deadline
+        self.expired = False
+        self.done = False
+        self.error = None
+
+        self._finished = finished
+
+    def run(self):
+        try:
+            self.report.collect()
+        except Exception as e:
+            log.exception("Collecting %s failed", self.report.name)
+            self.error = e
+        finally:
+            with self._finished:
+                self.done = True
+                self._finished.notify_all()
+
+    def result(self):
+        """ Dictionary representation of a report that is done collecting, with collection timing under _meta
+
+        :return: Report, its dictionary representation and whether it collected successfully
+        :rtype: tuple[ccbr_server.common.Report, dict[str, Any], bool]
+        """
+        if self.error is not None:
+            data, done = self.report.error_dict(self.error), False
+        else:
+            data, done = self.report.to_dict(), True
+
+        data['_meta'] = self.report.meta.to_dict()
+
+        return self.report, data, done
+
+
+class WatchThread(threading.Thread):
+    """ Wait for the system to report a change of what a report describes and ask for the report to be collected
+
+    :type report: ccbr_server.common.Report
+    """
+
+    def __init__(self, report, changed):
+        """
+        :param ccbr_server.common.Report report: Report to watch
+        :param (ccbr_server.common.Report) -> None changed: Called with the report when it should be collected
+        """
+        super(WatchThread, self).__init__(name='watch-%s' % report.name)
+        self.daemon = True
+
+        self.report = report
+        self._changed = changed
+
+    def run(self):
+        while True:
+            try:
+                changed = self.report.wait_for_change()
+            except Exception:
+                log.exception("Watching %s failed", self.report.name)
+                return
+
+            if changed is None:  # Can't be watched, it's only collected on its interval
+                return
+
+            if changed:
+                self._changed(self.report)
+
+
+class Collector(object):
+    """ Collect reports in background threads, each one has to finish before its own deadline. A report that is still
+    running past its deadline is reported once as timed out and is not started again until it finishes.
+
+    :type threads: dict[str, CollectThread]
+    :type requested: set[str]
+    """
+
+    def __init__(self):
+        self.threads = {}
+        self.requested = set()
+        self._finished = threading.Condition()
+
+    def watch(self, report):
+        """ Request a collection of the report whenever it reports a change, see take_requests
+
+        :param ccbr_server.common.Report report: Report to watch
+        """
+        WatchThread(report, self.request).start()
+
+    def request(self, report):
+        """ Ask for a report to be collected as soon as possible, wakes up poll
+
+        :param ccbr_server.common.Report report: Report to collect
+        """
+        with self._finished:
+            self.requested.add(report.name)
+            self._finished.notify_all()
+
+    def take_requests(self):
+        """
+        :return: Names of reports requested since the last call
+        :rtype: set[str]
+        """
+        with self._finished:
+            requested, self.requested = self.requested, set()
+        return requested
+
+    def start(self, report, deadline):
+        """ Start collecting a report in the background
+
+        :param ccbr_server.common.Report report: Report to collect
+        :param float deadline: Seconds this report has to finish collecting
+        :return: False if this report is still being collected from a previous start
+        :rtype: bool
+        """
+        if report.name in self.threads:
+            log.warning("%s is still being collected, not starting it again", report.name)
+            return False
+
+        log.debug("Collecting %s with a deadline of %ss", report.name, deadline)
+        thread = CollectThread(report, deadline, self._finished)
+        self.threads[report.name] = thread
+        thread.start()
+
+        return True
+
+    def poll(self, timeout=None):
+        """ Wait for running reports to finish or miss their deadline
+
+        :param float timeout: Return after this many seconds even if nothing happened, wait indefinitely if None. A
+            requested collection also returns right away
+        :return: Report, its dictionary representation and whether it collected successfully
+        :rtype: list[tuple[ccbr_server.common.Report, dict[str, Any], bool]]
+        """
+        end = None if timeout is None else time.time() + timeout
+        results = []
+
+        with self._finished:
+            while True:
+                now = time.time()
+
+                for name, thread in list(self.threads.items()):
+                    if thread.done:
+                        del self.threads[name]
+                        results.append(thread.result())
+                    elif not thread.expired and now >= thread.expires:
+                        log.warning("%s did not finish in %ss", name, thread.deadline)
+                        thread.expired = True
+                        results.append((thread.report, thread.report.timeout_dict(thread.deadline), False))
+
+                if results or self.requested or (end is None and not self.threads) or (end is not None and now >= end):
+                    return results
+
+                # Sleep until a report finishes, the next deadline or our own timeout
+                wakeups = [t.expires for t in self.threads.values() if not t.expired]
+                if end is not None:
+                    wakeups.append(end)
+
+                self._finished.wait(max(0., min(wakeups) - now) if wakeups else None)
+
+
+def collect_reports(reports):
+    """ Collect all reports concurrently, each one has to finish before its own deadline
+
+    :param list[tuple[ccbr_server.common.Report, float]] reports: Reports paired with their deadlines in seconds
+    :return: Report, its dictionary representation and whether it collected successfully
+    :rtype: list[tuple[ccbr_server.common.Report, dict[str, Any], bool]]
+    """
+    collector = Collector()
+
+    for report, deadline in reports:
+        collector.start(report, deadline)
+
+    results = {}
+
+    while collector.threads and len(results) < len(reports):
+        for report, data, done in collector.poll():
+            results.setdefault(report.name, (report, data, done))
+
+    return [results[report.name] for report, _deadline in reports]
@@ -1,5 +1,15 @@
+import hashlib
+import json
+import logging
 import os
+import signal
+import subprocess
 import sys
+import threading
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import chain
 
 try:
     import configparser as configparser
@@ -7,6 +17,22 @@ except ImportError:
     # noinspection PyPep8Naming
     import ConfigParser as configparser
 
+try:
+    # noinspection PyCompatibility
+    from shutil import which as _which
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from distutils.spawn import find_executable as _which
+
+log = logging.getLogger(__file__)
+
+# Commands are started in a new session, so we can kill the whole process group. preexec_fn is not safe with threads,
+# use it only where start_new_session is not available
+if sys.version_info[0] >= 3:
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': os.setsid}
+
 
 def project_root():
     return os.path.dirname(__file__)
@@ -29,6 +55,105 @@ def get_config():
     return config
 
 
+def atomic_write(path, data):
+    """ Write data to a temporary file next to path and rename it into place, readers never see a partial file
+
+    :param str path: Destination file
+    :param bytes data: File contents
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fio:
+            fio.write(data)
+            fio.flush()
+            os.fsync(fio.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_state(path):
+    """ Load state kept between runs
+
+    :param str path: State file
+    :return: Saved state, None if there is none or it can't be read
+    :rtype: Any
+    """
+    try:
+        with open(path, 'rb') as fio:
+            return json.loads(fio.read().decode())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_state(path, state):
+    """ Save state kept between runs. State only saves work, so failing to write it is logged and ignored
+
+    :param str path: State file
+    :param Any state: JSON serializable state
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        atomic_write(path, json.dumps(state, sort_keys=True).encode())
+    except (IOError, OSError) as e:
+        log.warning("Could not save state to %s: %s", path, e)
+
+
+def parse_fields(value):
+    """ Parse a comma or newline separated list of JSON paths from config, keys may contain spaces
+
+    :param str value: Config value
+    :return: Paths, empty if everything should be kept
+    :rtype: list[str]
+    """
+    paths = value.replace('\n', ',').split(',') if value else []
+    return [path.strip() for path in paths if path.strip()]
+
+
+def compile_fields(paths):
+    """ Turn dotted JSON paths into a tree used by project, None marks a subtree that is kept whole
+
+    :param list[str] paths: Dotted paths, e.g. ata_smart_attributes.table
+    :rtype: dict[str, Any]
+    """
+    tree = {}
+
+    for path in paths:
+        node = tree
+        keys = path.split('.')
+
+        for key in keys[:-1]:
+            if key in node and node[key] is None:  # Parent is already kept whole
+                break
+            node = node.setdefault(key, {})
+        else:
+            node[keys[-1]] = None
+
+    return tree
+
+
+def project(data, fields):
+    """ Keep only whitelisted paths of a parsed JSON document, lists are projected item by item
+
+    :param Any data: Parsed JSON
+    :param dict[str, Any] fields: Tree returned by compile_fields, everything is kept if empty
+    :return: Projected data
+    """
+    if not fields:
+        return data
+
+    if isinstance(data, list):
+        return [project(item, fields) for item in data]
+
+    if isinstance(data, dict):
+        return dict((key, data[key] if sub is None else project(data[key], sub))
+                    for key, sub in fields.items() if key in data)
+
+    return data
+
+
 def format_msg(msg, color=None):
     """ Wrap msg in bash escape characters
 
@@ -66,7 +191,26 @@ class ReportException(Exception):
 
 
 class Report(object):
+    """
+    :type meta: ReportMeta
+    """
     name = ''
+    meta = None
+
+    def collect(self):
+        """ Run collect_data and record its wall time, CPU time and every external command it ran in self.meta
+
+        :rtype: Report
+        """
+        self.meta = ReportMeta()
+
+        with recording(self.meta):
+            try:
+                self.collect_data()
+            finally:
+                self.meta.finish()
+
+        return self
 
     def collect_data(self):
         """ Run data collection for this report
@@ -83,6 +227,51 @@ class Report(object):
         """
         raise NotImplementedError()
 
+    # noinspection PyMethodMayBeStatic
+    def timeout_dict(self, deadline):
+        """ Stub sent in place of a report that did not finish collecting in time
+
+        :param float deadline: Deadline in seconds that was missed
+        :return: dictionary representation of a timed out report
+        :rtype: dict[str, Any]
+        """
+        return {
+            'ver': 1,
+            'timed_out': True,
+            'deadline': deadline
+        }
+
+    # noinspection PyMethodMayBeStatic
+    def error_dict(self, error):
+        """ Stub sent in place of a report that failed to collect
+
+        :param Exception error: Exception raised during collection
+        :return: dictionary representation of a failed report
+        :rtype: dict[str, Any]
+        """
+        return {
+            'ver': 1,
+            'error': '%s: %s' % (error.__class__.__name__, error)
+        }
+
+    def acknowledged(self, data):
+        """ The monitoring site accepted an earlier collection of this report, possibly one spooled by another run
+
+        :param dict[str, Any] data: Dictionary representation of that collection as it was sent
+        """
+        pass
+
+    # noinspection PyMethodMayBeStatic
+    def wait_for_change(self, timeout=None):
+        """ Block until the system reports a change of what this report describes, so daemon mode can collect it right
+        away instead of on its next interval
+
+        :param float timeout: Seconds to wait, indefinitely if None
+        :return: True if something changed, False on timeout, None if this report can't watch the system
+        :rtype: bool
+        """
+        return None
+
     def stdout(self):
         """ Print report to stdout
         """
@@ -98,17 +287,759 @@ class Report(object):
         return Report().collect_data().to_dict()
 
 
-def get_pool():
+def thread_cpu_time():
+    """ CPU time of the current thread, falls back to CPU time of the whole process on python < 3.7
+
+    :rtype: float
+    """
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+
+    times = os.times()
+    return times[0] + times[1]
+
+
+class ReportMeta(object):
+    """ Timing of a single report collection, the external commands it ran and how long they took compared to the
+    latency history of their targets
+
+    :type commands: list[CommandResult]
+    :type latencies: dict[str, dict[str, Any]]
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.wall_time = None
+        self.cpu_time = 0.
+        self.commands = []
+        self.latencies = {}
+
+        self._cpu_started = thread_cpu_time()
+        self._lock = threading.Lock()
+
+    def add_command(self, result):
+        """
+        :param CommandResult result: Command run for this report
+        """
+        with self._lock:
+            self.commands.append(result)
+
+    def add_latency(self, target, latency):
+        """
+        :param str target: Disk, mount point or anything else a command was run against
+        :param dict[str, Any] latency: Latency returned by LatencyHistory.observe
+        """
+        with self._lock:
+            self.latencies[target] = latency
+
+    def add_cpu_time(self, cpu_time):
+        """
+        :param float cpu_time: CPU time spent in a worker thread of this report
+        """
+        with self._lock:
+            self.cpu_time += cpu_time
+
+    def finish(self):
+        """ Collection is done, stop the clocks
+        """
+        self.wall_time = time.time() - self.started
+        self.add_cpu_time(thread_cpu_time() - self._cpu_started)
+
+    def to_dict(self):
+        """
+        :return: dictionary representation of collection timing, sent as _meta with each report
+        :rtype: dict[str, Any]
+        """
+        with self._lock:
+            commands = sorted(self.commands, key=lambda c: c.started)
+            latencies = dict(self.latencies)
+
+        return {
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'commands': [{
+                'argv': c.cmd,
+                'start': c.started - self.started,
+                'queued': c.queued,
+                'duration': c.duration,
+                'returncode': c.returncode,
+                'bytes': c.size,
+                'timed_out': c.timed_out
+            } for c in commands],
+            'latencies': latencies,
+        }
+
+
+_context = threading.local()
+
+
+@contextmanager
+def recording(meta):
+    """ Record commands run by the current thread into meta
+
+    :param ReportMeta meta: Report timing to record into, None to stop recording
+    """
+    previous = getattr(_context, 'meta', None)
+    _context.meta = meta
+    try:
+        yield meta
+    finally:
+        _context.meta = previous
+
+
+class CommandResult(object):
+    """ Outcome of an external command run with run_command
+
+    :type cmd: list[str]
+    :type returncode: int
+    :type stdout: bytes
+    :type started: float
+    :type duration: float
+    :type timed_out: bool
+    :type queued: float
+    """
+
+    def __init__(self, cmd, returncode, stdout, started, duration, timed_out):
+        """
+        :param list[str] cmd: Command with arguments
+        :param int returncode: Exit code, negative signal number if the command was killed
+        :param bytes stdout: Captured output, empty if output was not captured
+        :param float started: Unix time the command started at
+        :param float duration: Wall time in seconds
+        :param bool timed_out: Command was killed because it ran past its timeout
+        """
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.started = started
+        self.duration = duration
+        self.timed_out = timed_out
+        self.queued = 0.  # Seconds spent waiting for the budget
+        self.size = len(stdout)  # Bytes of output, streamed output is not kept in stdout
+
+
+class CommandStream(object):
+    """ Output of a command started with stream_command, iterate over it to get lines as the command writes them
+
+    :type cmd: list[str]
+    :type size: int
+    :type result: CommandResult
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, cmd, read):
+        """
+        :param list[str] cmd: Command with arguments
+        :param callable read: Reads up to n bytes of output, returns b'' at the end
+        """
+        self.cmd = cmd
+        self.size = 0
+        self.result = None  # Set once the command finished
+
+        self._read = read
+
+    def __iter__(self):
+        # Lines are split and decoded a chunk at a time, chain keeps the per line cost at C speed
+        return chain.from_iterable(self._chunks())
+
+    def _chunks(self):
+        pending = b''
+
+        while True:
+            data = self._read(self.CHUNK_SIZE)
+            if not data:
+                break
+
+            self.size += len(data)
+            data = pending + data
+
+            end = data.rfind(b'\n') + 1  # Only complete lines, multibyte characters never contain a newline byte
+            pending = data[end:]
+            if end:
+                yield data[:end].decode().splitlines()
+
+        if pending:
+            yield pending.decode().splitlines()
+
+
+def _kill_process_group(process, killed):
+    """ Kill a command started by run_command together with any children it spawned
+
+    :param subprocess.Popen process: Process leading its own process group
+    :param list[bool] killed: Flag list, appended to if we sent the signal
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+        killed.append(True)
+    except OSError:  # Already gone
+        pass
+
+
+class CommandBudget(object):
+    """ Node wide limits on external commands running at the same time, shared by all reports. Every command counts
+    against the command limit, I/O heavy probes also against the I/O limit and commands querying a RAID controller
+    against the limit of their controller group. A limit of 0 means no limit.
+    """
+
+    def __init__(self):
+        self.commands = None
+        self.io_probes = None
+        self.group_limit = 0
+        self.groups = {}
+
+        self._lock = threading.Lock()
+
+    def configure(self, commands=0, io_probes=0, group_limit=0):
+        """ Set the limits, should be called before any command is run
+
+        :param int|str commands: Maximum number of concurrent commands
+        :param int|str io_probes: Maximum number of concurrent I/O heavy commands
+        :param int|str group_limit: Maximum number of concurrent commands in the same controller group
+        """
+        self.commands = threading.BoundedSemaphore(int(commands)) if int(commands) else None
+        self.io_probes = threading.BoundedSemaphore(int(io_probes)) if int(io_probes) else None
+        self.group_limit = int(group_limit)
+        self.groups = {}
+
+    def _group(self, group):
+        with self._lock:
+            if group not in self.groups:
+                self.groups[group] = threading.BoundedSemaphore(self.group_limit)
+            return self.groups[group]
+
+    @contextmanager
+    def acquire(self, io=False, group=None):
+        """ Block until the command fits into the budget
+
+        :param bool io: Command is an I/O heavy probe
+        :param str group: Controller group of this command
+        """
+        # Always acquire in the same order so two commands can't wait on each other
+        semaphores = []
+        if group is not None and self.group_limit:
+            semaphores.append(self._group(group))
+        if io and self.io_probes is not None:
+            semaphores.append(self.io_probes)
+        if self.commands is not None:
+            semaphores.append(self.commands)
+
+        acquired = []
+        try:
+            for semaphore in semaphores:
+                semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+
+budget = CommandBudget()
+
+LATENCY_SAMPLES = 50  # Latencies kept for each target
+LATENCY_MIN_SAMPLES = 5  # Targets use the fixed timeout until their history has this many latencies
+LATENCY_HEADROOM = 4  # The timeout of a target is this many times its 95th percentile latency
+LATENCY_SLOWER = 2  # Commands are slow if they take this many times their target's median latency
+LATENCY_MARGIN = 0.5  # and at least this many seconds longer, a few milliseconds more are not worth reporting
+LATENCY_EXPIRE = 30 * 86400  # Seconds until the history of a target that isn't checked anymore is dropped
+
+
+def percentile(values, fraction):
     """
-    Return platform compatible multiprocessing.Pool
+    :param list[float] values: Values, not empty
+    :param float fraction: Percentile as a fraction, e.g. 0.5 for the median
+    :rtype: float
+    """
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class LatencyHistory(object):
+    """ Latencies of the last commands run against each target, e.g. a disk or a mount point. Each target gets its
+    timeout from its own history instead of one fixed value: a few times its usual latency, within min_timeout and
+    max_timeout. A healthy disk that always answers in milliseconds is given up on quickly, a disk behind a slow
+    expander gets the time it always needs. Targets without enough history yet get the fixed timeout.
+
+    :type history: dict[str, dict[str, Any]]
+    """
+
+    def __init__(self, timeout, min_timeout, max_timeout, path=None):
+        """
+        :param int|str timeout: Fixed timeout in seconds, for targets without enough history
+        :param int|str min_timeout: Shortest timeout in seconds of a target
+        :param int|str max_timeout: Longest timeout in seconds of a target
+        :param str path: State file keeping the history between runs, only kept in memory if None
+        """
+        self.timeout = float(timeout)
+        self.min_timeout = float(min_timeout)
+        self.max_timeout = float(max_timeout)
+        self.path = None if capture.replaying else path  # Latencies describe this system
+        self.history = (load_state(self.path) if self.path else None) or {}
+
+        self._lock = threading.Lock()
+
+    def timeout_for(self, target):
+        """
+        :param str target: Disk, mount point or anything else a command is run against
+        :return: Timeout in seconds
+        :rtype: float
+        """
+        with self._lock:
+            samples = self.history.get(target, {}).get('samples', [])
+            if len(samples) < LATENCY_MIN_SAMPLES:
+                return self.timeout
+            return min(max(percentile(samples, 0.95) * LATENCY_HEADROOM, self.min_timeout), self.max_timeout)
+
+    def observe(self, target, duration):
+        """ Add the latency of a command that finished. Commands that timed out are not added, a target that hangs
+        would only raise its own timeout. The latency is also recorded in the report collecting it, it is different
+        every time so it is sent under _meta instead of with the report data.
+
+        :param str target: Disk, mount point or anything else the command was run against
+        :param float duration: Seconds the command took
+        :return: Latency, the target's median latency before it and its timeout in seconds, and whether the command
+            was slower than usual for the target
+        :rtype: dict[str, Any]
+        """
+        timeout = self.timeout_for(target)
+
+        with self._lock:
+            samples = self.history.get(target, {}).get('samples', [])
+
+            baseline = percentile(samples, 0.5) if len(samples) >= LATENCY_MIN_SAMPLES else None
+            slow = baseline is not None and duration > max(baseline * LATENCY_SLOWER, baseline + LATENCY_MARGIN)
+
+            self.history[target] = {'samples': (samples + [round(duration, 3)])[-LATENCY_SAMPLES:], 'time': time.time()}
+
+        if slow:
+            log.warning("%s took %.1fs, usually it takes %.1fs", target, duration, baseline)
+
+        latency = {
+            'duration': round(duration, 3),
+            'baseline': baseline,
+            'timeout': timeout,
+            'slow': slow,
+        }
+
+        meta = getattr(_context, 'meta', None)
+        if meta is not None:
+            meta.add_latency(target, latency)
+
+        return latency
+
+    def save(self):
+        """ Save the history to the state file, dropping targets that weren't checked for a long time
+        """
+        if not self.path:
+            return
+
+        with self._lock:
+            expired = time.time() - LATENCY_EXPIRE
+            self.history = dict((target, entry) for target, entry in self.history.items() if entry['time'] > expired)
+            save_state(self.path, self.history)
+
+
+class Capture(object):
+    """ Record raw output of every external command and every file read through read_file into a directory, or replay
+    a recorded directory through the same parsing code without touching the system. Commands are matched by their
+    arguments with the executable reduced to its name, so captures replay on machines with a different install path.
+    """
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self):
+        self.directory = None
+        self.mode = None
+
+    def configure(self, directory=None, mode=None):
+        """
+        :param str directory: Capture directory
+        :param str mode: Capture.RECORD, Capture.REPLAY or None to run normally
+        """
+        self.directory = directory
+        self.mode = mode
+
+        if mode == Capture.RECORD and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def recording(self):
+        return self.mode == Capture.RECORD
+
+    @property
+    def replaying(self):
+        return self.mode == Capture.REPLAY
+
+    @staticmethod
+    def command_key(cmd):
+        return [os.path.basename(cmd[0])] + list(cmd[1:])
+
+    def _path(self, kind, key):
+        digest = hashlib.sha1(json.dumps([kind, key]).encode()).hexdigest()
+        return os.path.join(self.directory, '%s-%s' % (kind, digest))
+
+    def save(self, kind, key, data, **meta):
+        """ Save raw data and its metadata
+
+        :param str kind: cmd, file or exists
+        :param Any key: What was captured, e.g. command arguments or a file path
+        :param bytes data: Raw output
+        """
+        path = self._path(kind, key)
+        meta.update({'kind': kind, 'key': key})
+        atomic_write(path + '.out', data)
+        atomic_write(path + '.json', json.dumps(meta, indent=1).encode())
+
+    def open(self, kind, key):
+        """ Open recorded raw data for reading and load its metadata
+
+        :param str kind: cmd, file or exists
+        :param Any key: What was captured, e.g. command arguments or a file path
+        :return: Raw output opened in binary mode and metadata
+        :rtype: tuple[file, dict[str, Any]]
+        :raises: KeyError if nothing was recorded for key
+        """
+        path = self._path(kind, key)
+        try:
+            with open(path + '.json', 'rb') as fio:
+                meta = json.loads(fio.read().decode())
+            return open(path + '.out', 'rb'), meta
+        except (IOError, OSError):
+            raise KeyError("Nothing recorded for %s %s" % (kind, key))
+
+    def read(self, kind, key):
+        """ Load recorded raw data without its metadata
+
+        :param str kind: cmd, file or exists
+        :param Any key: What was captured, e.g. command arguments or a file path
+        :rtype: bytes
+        :raises: KeyError if nothing was recorded for key
+        """
+        try:
+            with open(self._path(kind, key) + '.out', 'rb') as fio:
+                return fio.read()
+        except (IOError, OSError):
+            raise KeyError("Nothing recorded for %s %s" % (kind, key))
+
+    def load(self, kind, key):
+        """ Load recorded raw data and its metadata
+
+        :param str kind: cmd, file or exists
+        :param Any key: What was captured, e.g. command arguments or a file path
+        :return: Raw output and metadata
+        :rtype: tuple[bytes, dict[str, Any]]
+        :raises: KeyError if nothing was recorded for key
+        """
+        fio, meta = self.open(kind, key)
+        with fio:
+            return fio.read(), meta
+
+    def executables(self):
+        """ Names of all executables in this capture
+
+        :rtype: set[str]
+        """
+        names = set()
+        for f in os.listdir(self.directory):
+            if f.startswith('cmd-') and f.endswith('.json'):
+                with open(os.path.join(self.directory, f), 'rb') as fio:
+                    names.add(json.loads(fio.read().decode())['key'][0])
+        return names
+
+
+capture = Capture()
+
+
+def read_file(path):
+    """ Read a text file, recorded and replayed together with command output
+
+    :param str path: File path
+    :rtype: str
+    """
+    if capture.replaying:
+        try:
+            return capture.read('file', path).decode()
+        except KeyError:
+            raise IOError("%s was not recorded" % path)
+
+    with open(path, 'rb') as fio:
+        data = fio.read()
+
+    if capture.recording:
+        capture.save('file', path, data)
+
+    return data.decode()
+
+
+def path_exists(path):
+    """ os.path.exists, recorded and replayed together with command output
+
+    :param str path: File path
+    :rtype: bool
+    """
+    if capture.replaying:
+        try:
+            return capture.load('exists', path)[1]['exists']
+        except KeyError:
+            return False
+
+    exists = os.path.exists(path)
+
+    if capture.recording:
+        capture.save('exists', path, b'', exists=exists)
+
+    return exists
+
 
-    :return: Pool class
+def which(names):
+    """ Find the first executable on PATH, or in the replayed capture
+
+    :param list[str] names: Executable names
+    :return: Path to the executable or None if none were found
+    :rtype: str
     """
-    # There is a bug with partial() and Pool.map() for py < 2.7, fixed by using mp.dummy.Pool
-    if sys.version_info[0] == 2 and sys.version_info[1] < 7:
-        from multiprocessing.dummy import Pool
+    if capture.replaying:
+        recorded = capture.executables()
+        for name in names:
+            if os.path.basename(name) in recorded:
+                return name
+        return None
+
+    for name in names:
+        path = _which(name)
+        if path:
+            return path
+
+    return None
+
+
+def run_command(cmd, timeout=None, capture_output=True, quiet=False, io=False, group=None):
+    """ Run an external command in its own process group. If it runs past the timeout the whole group is killed, so
+    nothing the command started is left behind waiting on a hung disk.
+
+    The command waits for a free slot in the node wide budget first, the timeout only starts once it is running.
+
+    :param list[str] cmd: Command with arguments
+    :param float|int|str timeout: Seconds to wait for the command, wait indefinitely if None
+    :param bool capture_output: Capture stdout, otherwise discard it
+    :param bool quiet: Discard stderr, otherwise it is inherited from this process
+    :param bool io: Command is an I/O heavy probe of a disk
+    :param str group: Controller group, commands in the same group share the per-controller limit
+    :return: Outcome of the command
+    :rtype: CommandResult
+    """
+    queued = time.time()
+
+    if capture.replaying:
+        result = _replay_command(cmd)
     else:
-        from multiprocessing import Pool
+        with budget.acquire(io=io, group=group):
+            result = _run_command(cmd, timeout, capture_output, quiet)
+
+        if capture.recording:
+            capture.save('cmd', Capture.command_key(cmd), result.stdout, returncode=result.returncode,
+                         duration=result.duration, timed_out=result.timed_out)
+
+    _finish_command(result, queued)
+
+    return result
+
+
+@contextmanager
+def stream_command(cmd, timeout=None, quiet=False, io=False, group=None):
+    """ Run an external command like run_command, but hand out its output line by line while it is running instead
+    of buffering all of it. Parsers only hold the record they are working on, no matter how long the output is.
+
+    The outcome is in stream.result once the block exits, its stdout is empty. Output the block did not read is
+    discarded, if the block raises the command is killed.
+
+        with stream_command(cmd) as stream:
+            for line in stream:
+                ...
+
+        if stream.result.returncode != 0:
+            ...
+
+    :param list[str] cmd: Command with arguments
+    :param float|int|str timeout: Seconds to wait for the command, wait indefinitely if None
+    :param bool quiet: Discard stderr, otherwise it is inherited from this process
+    :param bool io: Command is an I/O heavy probe of a disk
+    :param str group: Controller group, commands in the same group share the per-controller limit
+    :rtype: CommandStream
+    """
+    queued = time.time()
+
+    if capture.replaying:
+        started = time.time()
+        try:
+            fio, meta = capture.open('cmd', Capture.command_key(cmd))
+        except KeyError:
+            log.warning("'%s' was not recorded", ' '.join(cmd))
+            fio, meta = open(os.devnull, 'rb'), {'returncode': 127, 'timed_out': False}
+
+        stream = CommandStream(cmd, fio.read)
+        try:
+            yield stream
+        finally:
+            fio.close()
+            stream.result = CommandResult(cmd, meta['returncode'], b'', started, time.time() - started,
+                                          meta['timed_out'])
+            stream.result.size = stream.size
+            _finish_command(stream.result, queued)
+        return
+
+    with budget.acquire(io=io, group=group):
+        with open(os.devnull, 'wb') as devnull:
+            started = time.time()
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=devnull if quiet else None,
+                                       **NEW_SESSION)
+
+            killed = []
+            timer = None
+
+            if timeout is not None:
+                timer = threading.Timer(float(timeout), _kill_process_group, (process, killed))
+                timer.daemon = True
+                timer.start()
+
+            recorded = [] if capture.recording else None  # Recording needs the whole output anyway
+
+            def read(size):
+                data = os.read(process.stdout.fileno(), size)  # Returns as soon as anything was written
+                if recorded is not None:
+                    recorded.append(data)
+                return data
+
+            stream = CommandStream(cmd, read)
+
+            try:
+                try:
+                    yield stream
+                except BaseException:
+                    _kill_process_group(process, [])
+                    raise
+
+                for _line in stream:  # Let the command finish instead of blocking on a full pipe
+                    pass
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                process.stdout.close()
+                process.wait()
+
+                if killed:
+                    log.warning("'%s' killed after %ss timeout", ' '.join(cmd), timeout)
+
+                stream.result = CommandResult(cmd, process.returncode, b'', started, time.time() - started,
+                                              bool(killed))
+                stream.result.size = stream.size
+
+                if recorded is not None:
+                    capture.save('cmd', Capture.command_key(cmd), b''.join(recorded),
+                                 returncode=stream.result.returncode, duration=stream.result.duration,
+                                 timed_out=stream.result.timed_out)
+
+                _finish_command(stream.result, queued)
+
+
+def _finish_command(result, queued):
+    """ Record a finished command in the report that ran it
+
+    :param CommandResult result: Outcome of the command
+    :param float queued: Unix time the command started waiting for the budget at
+    """
+    result.queued = result.started - queued
+
+    meta = getattr(_context, 'meta', None)
+    if meta is not None:
+        meta.add_command(result)
+
+
+def _replay_command(cmd):
+    started = time.time()
+
+    try:
+        out, meta = capture.load('cmd', Capture.command_key(cmd))
+    except KeyError:
+        log.warning("'%s' was not recorded", ' '.join(cmd))
+        return CommandResult(cmd, 127, b'', started, 0., False)
+
+    return CommandResult(cmd, meta['returncode'], out, started, time.time() - started, meta['timed_out'])
+
+
+def _run_command(cmd, timeout, capture_output, quiet):
+    started = time.time()
+
+    with open(os.devnull, 'wb') as devnull:
+        process = subprocess.Popen(cmd,
+                                   stdout=subprocess.PIPE if capture_output else devnull,
+                                   stderr=devnull if quiet else None,
+                                   **NEW_SESSION)
+
+        killed = []
+        timer = None
+
+        if timeout is not None:
+            timer = threading.Timer(float(timeout), _kill_process_group, (process, killed))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            out, _ = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    if killed:
+        log.warning("'%s' killed after %ss timeout", ' '.join(cmd), timeout)
+
+    return CommandResult(cmd, process.returncode, out or b'', started, time.time() - started, bool(killed))
+
+
+def map_concurrent(func, items, concurrency):
+    """ Thread based Pool.map, workers only wait on external commands so there is no need to fork Python processes
+
+    :param callable func: Function to apply to each item
+    :param iterable items: Items to process
+    :param int concurrency: Number of worker threads
+    :return: Results in the same order as items
+    :rtype: list
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+    meta = getattr(_context, 'meta', None)  # Workers record into the same report as their caller
+
+    def worker():
+        cpu_started = thread_cpu_time()
+
+        with recording(meta):
+            while not errors:
+                with lock:
+                    i = next(indexes, None)
+
+                if i is None:
+                    break
+
+                try:
+                    results[i] = func(items[i])
+                except Exception as e:
+                    errors.append(e)
+
+        if meta is not None and hasattr(time, 'thread_time'):  # Process wide CPU time is already counted
+            meta.add_cpu_time(thread_cpu_time() - cpu_started)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max(int(concurrency), 1), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    return Pool
+    if errors:
+        raise errors[0]
 
+    return results
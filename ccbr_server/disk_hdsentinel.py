@@ -1,9 +1,8 @@
 import logging
 import os
-import subprocess
 from xml.etree import ElementTree
 
-from ccbr_server.common import Report, get_config, project_root, ReportException
+from ccbr_server.common import Report, get_config, project_root, ReportException, run_command, which
 
 log = logging.getLogger(__file__)
 
@@ -13,12 +12,12 @@ class HDSentinelReport(Report):
     this code
     """
     name = 'hdsentinel'
-    disks = []
 
     def __init__(self):
         self.executable = self.get_executable()
+        self.disks = []
 
-        if not os.path.exists(self.executable):
+        if not which([self.executable]):
             raise ReportException()
 
     # noinspection PyMethodMayBeStatic
@@ -30,15 +29,14 @@ class HDSentinelReport(Report):
         return os.path.join(project_root, 'lib/hdsentinel/hdsentinel-018c-x64')
 
     def collect_data(self):
-        p = subprocess.Popen([self.executable, '-xml', '-dump'], stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command([self.executable, '-xml', '-dump'])
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise ReportException("Problem executing hdsentinel")
 
         self.disks = []
 
-        xml = ElementTree.fromstring(out)
+        xml = ElementTree.fromstring(res.stdout)
         for disk_el in xml:
             if disk_el.tag.startswith('Physical_Disk_Information_'):
                 disk = {}
@@ -1,11 +1,13 @@
+import hashlib
 import json
 import logging
 import os
-import subprocess
-from functools import partial
-from tempfile import TemporaryFile
+import re
+import threading
+import time
 
-from ccbr_server.common import Report, get_config, project_root, ReportException, get_pool
+from ccbr_server.common import Report, get_config, project_root, ReportException, run_command, map_concurrent, \
+    compile_fields, project, which, capture, load_state, save_state, LatencyHistory
 
 log = logging.getLogger(__file__)
 
@@ -20,75 +22,301 @@ RETURN_CODES = [
     'The device error log contains records of errors',
     'The device self-test log contains records of errors'
 ]
+LOG_ERRORS = 6  # Return code bits from here on come from the error and self-test logs
 
 
-def check_smart(device, smartctl, timeout):
-    cmd = ['timeout', str(timeout), smartctl, '--json=c', '--all', '-B',
-           '+' + os.path.join(project_root, 'lib/smart/drivedb.h')]
+STANDBY_RE = re.compile(r'Device is in [A-Z_ ()]+ mode')  # Message of smartctl -n standby skipping a drive
+
+# Identity, health and attributes, everything but the logs
+QUICK_QUERY = ['--info', '--health', '--attributes']
+
+# Logs of past errors and self-tests: their section in smartctl output, the part holding the table of entries and the
+# entry field growing with each new entry. Self-tests have no number, the power on hours they ran at are used instead,
+# several of them may share an hour. The self-tests of SCSI drives are not a table but one section per entry
+ENTRY_LOGS = (
+    ('ata_smart_error_log', 'summary', 'error_number'),
+    ('ata_smart_error_log', 'extended', 'error_number'),
+    ('ata_smart_self_test_log', 'standard', 'lifetime_hours'),
+    ('ata_smart_self_test_log', 'extended', 'lifetime_hours'),
+    ('nvme_error_information_log', None, 'error_count'),
+    ('nvme_self_test_log', None, 'power_on_hours'),
+)
+
+# Block and SCSI disk devices, the drives smartctl --scan finds only change if these do
+SCAN_SOURCES = ('/sys/block', '/sys/class/scsi_disk')
+
+
+def device_fingerprint(smartctl, sources=SCAN_SOURCES):
+    """ Cheap fingerprint of the drives attached to this system
+
+    :param str smartctl: Path to smartctl, another one may scan differently
+    :param tuple[str] sources: Directories listing the devices
+    :rtype: str
+    """
+    digest = hashlib.sha1(smartctl.encode())
+
+    for source in sources:
+        try:
+            names = sorted(os.listdir(source))
+        except OSError:
+            names = []
+        digest.update(('\0%s:%s' % (source, ','.join(names))).encode())
+
+    return digest.hexdigest()
+
+
+def drive_identity(output):
+    """ Identify the drive in smartctl output before fields are dropped
+
+    :param dict[str, Any] output: smartctl output
+    :return: Serial number, power on hours and whether smartctl skipped the drive because it is spun down
+    :rtype: dict[str, Any]
+    """
+    messages = output.get('smartctl', {}).get('messages', [])
+
+    return {
+        'serial': output.get('serial_number'),
+        'power_on_hours': output.get('power_on_time', {}).get('hours'),
+        'standby': any(STANDBY_RE.search(m.get('string', '')) for m in messages),
+    }
+
+
+def controller_group(device):
+    """ Pass-through queries to drives behind a RAID controller are served one after the other by its firmware, and
+    stall the I/O of the controller while they wait
+
+    :param dict[str, str] device: Device found by smartctl --scan
+    :return: Controller the drive is attached to, None if it is attached directly
+    :rtype: str
+    """
     if 'megaraid' in device['type']:
+        return 'megaraid:%s' % device['name']  # Every drive on the controller is addressed through its bus device
+    return None
+
+
+def check_smart(device, smartctl, timeout, fields=None, options=('--all',), latency=None):
+    """
+    :param dict[str, str] device: Device found by smartctl --scan
+    :param str smartctl: Path to smartctl
+    :param int timeout: smartctl timeout in seconds
+    :param dict[str, Any] fields: Tree returned by compile_fields, everything is kept if empty
+    :param list[str] options: What to query, e.g. --all
+    :param LatencyHistory latency: Latencies of earlier queries, the timeout comes from the device's history if given
+        and the output gets whether this query was slower than usual
+    :return: Device, its smartctl output and its drive_identity, None for both if smartctl timed out or printed
+        nothing
+    :rtype: tuple[dict[str, str], dict[str, Any], dict[str, Any]]
+    """
+    # Reading the logs takes much longer, full and quick queries have their own history
+    target = '%s %s' % (device_key(device), 'all' if '--all' in options else 'quick')
+    if latency is not None:
+        timeout = latency.timeout_for(target)
+
+    cmd = [smartctl, '--json=c'] + list(options) + ['-B', '+' + os.path.join(project_root, 'lib/smart/drivedb.h')]
+    group = controller_group(device)
+    if group:
         cmd += ['--device', device['type']]
     cmd += [device['name']]
     log.debug("Getting SMART for %s: %s", device['name'], ' '.join(cmd))
 
-    out = None
-
-    with TemporaryFile() as tmp:
-        ret = subprocess.call(cmd, stdout=tmp)
+    res = run_command(cmd, timeout=timeout, io=True, group=group)
 
-        if ret != 124:  # Not Timeout
-            tmp.seek(0)
-            out = tmp.read()
-        else:
-            log.warning("smartctl timeout for %s", device['name'])
+    if res.timed_out:
+        log.warning("smartctl timeout for %s", device['name'])
+        return device, None, None
 
     errors = []
 
-    if ret != 0:
+    if res.returncode != 0:
         for bit, error in enumerate(RETURN_CODES):
-            isbit = (ret >> bit) & 1
+            isbit = (res.returncode >> bit) & 1
             if isbit:
                 errors.append(bit)
 
-    if out:
-        device_out = json.loads(out)
+    if res.stdout:
+        output = json.loads(res.stdout.decode())
+        device_out = project(output, fields)  # Drop what we don't need right away
         device_out['errors'] = errors
-        return device, device_out
+        identity = drive_identity(output)
+        if latency is not None and not identity['standby']:  # Skipping a drive in standby takes no time at all
+            device_out['slow'] = latency.observe(target, res.duration)['slow']
+        return device, device_out, identity
+
+    return device, None, None
+
+
+def new_log_entries(output, seen):
+    """ Keep only the error and self-test log entries that the monitoring site didn't accept before. The table of each
+    log is replaced by its new entries, and the log gets the number of entries it holds, the number of new ones and
+    whether it was reset since. A log is reset if its newest entry is older than the newest one accepted, or it holds
+    fewer entries with that index than it did, all of its entries are new then.
 
-    return device, None
+    Entries with the same index as the newest one accepted, e.g. self-tests run in the same power on hour, are new if
+    there are more of them than there were. smartctl lists the newest entries first, those are the new ones.
+
+    :param dict[str, Any] output: smartctl output, left untouched as it is also cached
+    :param dict[str, list[int]] seen: Index of the newest entry accepted of each log and how many entries had it
+    :return: Output with the new log entries only, and the index of the newest entry of each log in the output with
+        the number of entries having it, to remember once the site accepted it, None if the log is empty
+    :rtype: tuple[dict[str, Any], dict[str, list[int]]]
+    """
+    trimmed = dict(output)
+    newest_entries = {}
+
+    for section, part, index in ENTRY_LOGS:
+        path = [section, part] if part else [section]
+
+        parent = trimmed  # Copy the dictionaries on the way to the log, the cached output shares them
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                break
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+        else:
+            entries = parent.get(path[-1])
+            if not isinstance(entries, dict) or 'table' not in entries:
+                continue
+
+            name = '.'.join(path)
+            table = entries['table']
+            indexes = [entry.get(index, 0) for entry in table]
+            newest = max(indexes or [None])
+            last, last_count = seen.get(name) or (None, 0)
+            reset = last is not None and (newest is None or newest < last or
+                                          newest == last and indexes.count(last) < last_count)
+
+            parent[path[-1]] = entries = dict(entries)
+            if last is not None and not reset:
+                fresh = indexes.count(last) - last_count  # Newer entries sharing the index of the last one accepted
+                entries['table'] = []
+                for entry, value in zip(table, indexes):
+                    if value == last and fresh > 0:
+                        fresh -= 1
+                        entries['table'].append(entry)
+                    elif value > last:
+                        entries['table'].append(entry)
+            entries['entries'] = len(table)
+            entries['new_entries'] = len(entries['table'])
+            entries['reset'] = reset
+
+            newest_entries[name] = None if newest is None else [newest, indexes.count(newest)]
+
+    return trimmed, newest_entries
+
+
+def device_key(device):
+    """
+    :param dict[str, str] device: Device found by smartctl --scan
+    :rtype: str
+    """
+    return '%s %s' % (device['name'], device['type'])
+
+
+def cached_output(cached, standby=False):
+    """ Cached smartctl output, marked with the time it was read
+
+    :param dict[str, Any] cached: Cache entry of a drive
+    :param bool standby: The drive is in standby and wasn't read at all
+    :rtype: dict[str, Any]
+    """
+    output = dict(cached['data'])
+    output['cached'] = int(cached['time'])
+    output.pop('slow', None)  # Latency of the query that read it back then
+    if standby:
+        output['standby'] = True
+    return output
 
 
 class SmartReport(Report):
-    """ Parses output of smartctl included with this code
+    """ Parses output of smartctl included with this code.
+
+    The full output of each drive is cached by its serial number. While a drive's power on hours and the cached output
+    are younger than cache_ttl, only identity, health and attributes are read again and the logs come from the cache.
+    Drives in standby are not spun up, their cached output is reported instead.
+
+    The state file also keeps the smartctl version check while the binary doesn't change, and the device list while
+    the devices in sysfs don't change.
+
+    With incremental_logs, only error and self-test log entries that the monitoring site didn't accept before are
+    sent, see new_log_entries. The report carries the newest entry of each log by serial number under log_marks, they
+    are remembered in their own state file only once the site accepted the report. Entries of a report that was
+    printed offline, replayed or dropped from the spool are sent again. The self-tests of SCSI drives are always sent
+    in full.
+
+    :type cache: dict[str, dict[str, Any]]
+    :type acked_logs: dict[str, dict[str, list[int]]]
+    :type log_marks: dict[str, dict[str, list[int]]]
     """
     name = 'smartctl'
-    disks = []
 
-    def __init__(self, timeout=10, concurrency=4):
+    def __init__(self, timeout=10, concurrency=4, fields=None, cache_ttl=0, standby=True, state_path=None,
+                 incremental_logs=False, controller_concurrency=1, adaptive_timeout=False, min_timeout=2,
+                 max_timeout=60, latency_path=None, logs_path=None):
         """
         :param int|str timeout: smartctl timeout in seconds
-        :param int|str concurrency: Thread pool size for concurrent checking
+        :param int|str concurrency: Thread pool size for checking directly attached drives, one thread per drive if 0
+        :param list[str] fields: JSON paths of smartctl output to keep, everything is kept if empty
+        :param int|str cache_ttl: Seconds the logs of a drive are reused from the cache, never reused if 0
+        :param bool standby: Don't spin up drives in standby
+        :param str state_path: State file keeping the cache, version and device list between runs, only kept in
+            memory if None
+        :param bool incremental_logs: Only send error and self-test log entries that weren't sent before
+        :param int|str controller_concurrency: Thread pool size for checking the drives behind each RAID controller
+        :param bool adaptive_timeout: Take the smartctl timeout of each drive from how long it took before
+        :param int|str min_timeout: Shortest adaptive smartctl timeout in seconds
+        :param int|str max_timeout: Longest adaptive smartctl timeout in seconds
+        :param str latency_path: State file keeping the latencies between runs, only kept in memory if None
+        :param str logs_path: State file keeping the newest log entries the site accepted, only kept in memory if None
         """
         self.timeout = int(timeout)
         self.concurrency = int(concurrency)
+        self.controller_concurrency = int(controller_concurrency)
+        self.latency = LatencyHistory(timeout, min_timeout, max_timeout, latency_path) if adaptive_timeout else None
+        self.fields = compile_fields(fields or [])
+        self.cache_ttl = int(cache_ttl)
+        self.standby = standby
+        self.incremental_logs = incremental_logs
+        self.state_path = None if capture.replaying else state_path  # The cache describes this system's drives
+        self.cache = (load_state(self.state_path) if self.state_path else None) or {}
+        self.cache.setdefault('devices', {})
+        self.cache.setdefault('drives', {})
+        self.cache.pop('logs', None)  # Kept in logs_path now
+        self.disks = []
+
+        self.logs_path = None if capture.replaying else logs_path
+        self.acked_logs = (load_state(self.logs_path) if self.logs_path else None) or {}
+        self.log_marks = {}
+        self._logs_lock = threading.Lock()  # The outbox acknowledges reports while the next one is collected
 
         self.executable = self.get_executable()
 
-        if not os.path.exists(self.executable):
+        if not which([self.executable]):
             raise ReportException()
 
         self._check_version()
 
     def _check_version(self):
+        mtime = None
+        if self.state_path:
+            try:
+                mtime = os.stat(self.executable).st_mtime
+            except OSError:
+                pass
+
+        checked = self.cache.get('version')
+        if mtime is not None and checked and checked['executable'] == self.executable and checked['mtime'] == mtime:
+            log.debug("smartctl version '%s' was checked before", checked['version'])
+            return
+
         cmd = [self.executable, '-V']
         log.debug("Checking smartctl version: '%s'", ' '.join(cmd))
 
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command(cmd, timeout=self.timeout)
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise ReportException("Problem executing smartctl")
 
-        first_line = out.decode().splitlines()[0]
+        first_line = res.stdout.decode().splitlines()[0]
         version = first_line.split()[1]
         major = int(version.split('.')[0])
 
@@ -97,6 +325,10 @@ class SmartReport(Report):
 
         log.debug("Found acceptable version '%s'", version)
 
+        if mtime is not None:
+            self.cache['version'] = {'executable': self.executable, 'mtime': mtime, 'version': version}
+            save_state(self.state_path, self.cache)
+
     # noinspection PyMethodMayBeStatic
     def get_executable(self):
         config = get_config()
@@ -106,39 +338,189 @@ class SmartReport(Report):
         return os.path.join(project_root, 'lib/smart/smartctl')
 
     def collect_data(self):
+        self.disks = []
+        self.log_marks = {}
+
+        with self._logs_lock:
+            acked_logs = dict(self.acked_logs)
+
+        devices = self._scan()
+
+        log.info("Found %d drives", len(devices))
+
+        res = self._check_devices(devices)
+
+        now = time.time()
+        cached_devices, cached_drives = {}, {}  # Drives that are gone are dropped
+
+        for device_in, device_out, identity in res:
+            if device_out is None:
+                device_out = {'device': device_in, 'errors': [-1]}  # We timed out
+            elif 1 in device_out['errors'] and not device_out.get('standby'):
+                self.cache.pop('scan', None)  # Device open failed, it may be gone without sysfs telling us
+
+            key = device_key(device_in)
+            serial = identity['serial'] if identity else self.cache['devices'].get(key)
+            if serial is None:
+                self.disks.append(device_out)
+                continue
+
+            if self.incremental_logs:
+                trimmed, marks = new_log_entries(device_out, acked_logs.get(serial, {}))
+                self.disks.append(trimmed)
+                if marks:  # A drive that timed out has no logs to remember
+                    self.log_marks[serial] = marks
+            else:
+                self.disks.append(device_out)
+
+            cached_devices[key] = serial
+            if identity:  # Fresh full output
+                cached_drives[serial] = {'power_on_hours': identity['power_on_hours'], 'time': now,
+                                         'data': device_out}
+            elif serial in self.cache['drives']:
+                cached_drives[serial] = self.cache['drives'][serial]
+
+        self.cache['devices'] = cached_devices
+        self.cache['drives'] = cached_drives
+        if self.state_path:
+            save_state(self.state_path, self.cache)
+
+        with self._logs_lock:
+            present = set(cached_devices.values())
+            self.acked_logs = dict((serial, logs) for serial, logs in self.acked_logs.items() if serial in present)
+            if self.logs_path:
+                save_state(self.logs_path, self.acked_logs)
+        if self.latency is not None:
+            self.latency.save()
+
+        return self
+
+    def _scan(self):
+        """ List the drives smartctl can query, the list is scanned again when devices in sysfs change
+
+        :rtype: list[dict[str, str]]
+        """
+        fingerprint = device_fingerprint(self.executable) if self.state_path else None
+
+        scan = self.cache.get('scan')
+        if fingerprint is not None and scan and scan['fingerprint'] == fingerprint:
+            log.debug("Devices didn't change, using the drives found by the last scan")
+            return scan['devices']
+
         cmd = [self.executable, '--json=c', '--scan']
         log.debug("Discover all available drives: '%s'", ' '.join(cmd))
 
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command(cmd, timeout=self.timeout)
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise ReportException("Problem executing smartctl")
 
-        self.disks = []
+        devices = json.loads(res.stdout.decode())['devices']
 
-        devices = json.loads(out)
+        if fingerprint is not None:
+            self.cache['scan'] = {'fingerprint': fingerprint, 'devices': devices}
 
-        log.info("Found %d drives", len(devices['devices']))
+        return devices
 
-        log.debug("Creating smartctl check thread pool of size %s", self.concurrency)
-        pool = get_pool()(processes=self.concurrency)
-        res = pool.map(partial(check_smart, smartctl=self.executable, timeout=self.timeout), devices['devices'])
-        for device_in, device_out in res:
-            if device_out is None:
-                device_out = {'device': device_in, 'errors': [-1]}  # We timed out
+    def _check_devices(self, devices):
+        """ Check the drives behind each RAID controller with their own thread pool of controller_concurrency threads,
+        at the same time as the directly attached drives. A busy controller doesn't hold up other drives then, while
+        it never serves more than controller_concurrency queries at once.
 
-            self.disks.append(device_out)
-        pool.close()
+        :param list[dict[str, str]] devices: Devices found by smartctl --scan
+        :return: Result of _check_device for each device, in the same order
+        :rtype: list[tuple[dict[str, str], dict[str, Any], dict[str, Any]]]
+        """
+        lanes = {}  # Indexes of the devices behind each controller, None for directly attached ones
+        for i, device in enumerate(devices):
+            lanes.setdefault(controller_group(device), []).append(i)
 
-        return self
+        def check_lane(group):
+            indexes = lanes[group]
+            concurrency = self.controller_concurrency if group else self.concurrency or len(indexes)
+            log.debug("Checking %d drives %s with %d threads", len(indexes),
+                      'behind %s' % group if group else 'attached directly', concurrency)
+            return map_concurrent(lambda i: self._check_device(devices[i]), indexes, concurrency)
+
+        groups = list(lanes)
+        results = [None] * len(devices)
+
+        for group, lane in zip(groups, map_concurrent(check_lane, groups, len(groups))):
+            for i, result in zip(lanes[group], lane):
+                results[i] = result
+
+        return results
+
+    def _check_device(self, device):
+        """ Query a drive, reading as little as the cache allows
+
+        :param dict[str, str] device: Device found by smartctl --scan
+        :return: Device, its smartctl output and its drive_identity if the output is fresh and complete
+        :rtype: tuple[dict[str, str], dict[str, Any], dict[str, Any]]
+        """
+        standby = ['-n', 'standby'] if self.standby else []
+
+        serial = self.cache['devices'].get(device_key(device))
+        cached = self.cache['drives'].get(serial)
+
+        if cached is not None and time.time() - cached['time'] < self.cache_ttl:
+            _device, device_out, identity = check_smart(device, self.executable, self.timeout, self.fields,
+                                                        standby + QUICK_QUERY, self.latency)
+            if device_out is None:  # Timed out, the full query would only wait for the same hung drive again
+                return device, None, None
+
+            if identity and identity['standby']:
+                return device, cached_output(cached, standby=True), None
+
+            if identity and identity['serial'] == serial and identity['power_on_hours'] == cached['power_on_hours']:
+                log.debug("%s didn't run since it was last read, using its cached logs", device['name'])
+                output = cached_output(cached)
+                output.update(device_out)
+                output['errors'] = sorted(set(device_out['errors']) | set(e for e in cached['data']['errors']
+                                                                          if e >= LOG_ERRORS))
+                return device, output, None
+
+        device, device_out, identity = check_smart(device, self.executable, self.timeout, self.fields,
+                                                   standby + ['--all'], self.latency)
+
+        if identity and identity['standby']:
+            log.debug("%s is in standby, not spinning it up", device['name'])
+            if cached is not None:
+                return device, cached_output(cached, standby=True), None
+            return device, {'device': device, 'standby': True, 'errors': []}, None
+
+        return device, device_out, identity
+
+    def acknowledged(self, data):
+        """ Remember the newest log entries of a report the monitoring site accepted, they are not sent again
+
+        :param dict[str, Any] data: Dictionary representation of an earlier collection of this report
+        """
+        if not data.get('log_marks'):
+            return
+
+        with self._logs_lock:
+            for serial, marks in data['log_marks'].items():
+                logs = self.acked_logs[serial] = dict(self.acked_logs.get(serial, {}))
+                for name, newest in marks.items():
+                    if newest is None:  # Emptied, entries are counted from scratch
+                        logs.pop(name, None)
+                    else:
+                        logs[name] = newest
+            if self.logs_path:
+                save_state(self.logs_path, self.acked_logs)
 
     def to_dict(self):
-        return {
+        data = {
             'ver': 1,
             'disks': self.disks
         }
 
+        if self.incremental_logs:
+            data['log_marks'] = self.log_marks
+
+        return data
+
     def stdout(self):
         import json
         print(json.dumps(self.disks, indent=4, sort_keys=True))
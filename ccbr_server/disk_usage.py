@@ -9,9 +9,13 @@ class UsageReport(Report):
     :type usages: list[Usage]
     """
     name = 'disk_usage'
-    usages = []
+
+    def __init__(self):
+        self.usages = []
 
     def collect_data(self):
+        self.usages = []
+
         with open('/etc/mtab') as fio:
             mtab = fio.read()
 
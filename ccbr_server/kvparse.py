@@ -0,0 +1,146 @@
+""" Parser for the 'key : value' text output of megacli, omreport and mdadm.
+
+Each CLI lists its adapters, drives and arrays as blocks of 'key : value' lines. The boundaries of those blocks are
+described declaratively with line prefixes, so every backend shares the same single pass over its output.
+"""
+try:
+    # noinspection PyCompatibility
+    from sys import intern
+except ImportError:  # python 2, its intern() rejects the unicode keys of decoded output
+    def intern(key):
+        return key
+
+START = 'start'
+CONTEXT = 'context'
+CHILD = 'child'
+FLAG = 'flag'
+
+
+class BlockParser(object):
+    """ Splits 'key : value' output into records, one dictionary per record.
+
+    Line prefixes mark the structure of the output:
+
+    - starts: a line starting with the prefix begins a new record. If a key is given, the first word after the prefix
+      is stored under it. The line itself is parsed as a property too, e.g. omreport records start with their 'ID'.
+    - contexts: the first word after the prefix is copied into every following record under the key, e.g. the
+      adapter all following megacli drives belong to. The line also ends the current record.
+    - children: following properties go into a new dictionary appended to the list under the key in the current
+      record, e.g. physical drives listed inside a megacli virtual drive.
+    - flags: the key is set to True in the current record if a line starts with the prefix.
+
+    Records also end after a run of blank_lines blank lines. Without start markers a record begins with the first
+    property, so output without any markers is a single record.
+
+    Keys are interned, thousands of drives share one copy of each key.
+    """
+
+    def __init__(self, starts=(), contexts=(), children=(), flags=(), blank_lines=0, require=None):
+        """
+        :param list[tuple[str, str]] starts: Prefix and key of lines starting a record, key may be None
+        :param list[tuple[str, str]] contexts: Prefix and key of lines setting a value for all following records
+        :param list[tuple[str, str]] children: Prefix and key of lines starting a nested record
+        :param list[tuple[str, str]] flags: Prefix and key of lines setting a flag in the current record
+        :param int blank_lines: End a record after this many blank lines in a row, 0 to ignore blank lines
+        :param str require: Drop records without this key, e.g. the trailer after the last record
+        """
+        self.starts = tuple(starts)
+        self.blank_lines = blank_lines
+        self.require = require
+
+        self.markers = []
+        for kind, markers in ((START, starts), (CONTEXT, contexts), (CHILD, children), (FLAG, flags)):
+            self.markers.extend((prefix, kind, key) for prefix, key in markers)
+
+        self.prefixes = tuple(prefix for prefix, _kind, _key in self.markers)  # Rejects most lines in one call
+
+    def _complete(self, record):
+        return record is not None and (self.require is None or self.require in record)
+
+    def parse(self, lines):
+        """
+        :param iterable[str] lines: Output lines
+        :return: Properties of each record
+        :rtype: iterator[dict[str, Any]]
+        """
+        context = {}
+        record = None
+        target = None  # Current record or its current child
+        blanks = 0
+
+        for line in lines:
+            line = line.rstrip()
+
+            if not line:
+                blanks += 1
+                if blanks == self.blank_lines and record is not None:
+                    if self._complete(record):
+                        yield record
+                    record = target = None
+                continue
+
+            blanks = 0
+
+            if self.prefixes and line.startswith(self.prefixes):
+                for prefix, kind, key in self.markers:
+                    if line.startswith(prefix):
+                        break
+
+                # noinspection PyUnboundLocalVariable
+                value = line[len(prefix):].split()
+                value = value[0] if value else ''
+
+                if kind == START:
+                    if self._complete(record):
+                        yield record
+                    record = target = dict(context)
+                    if key:
+                        record[key] = value
+                elif kind == CONTEXT:
+                    if self._complete(record):
+                        yield record
+                    record = target = None
+                    context[key] = value
+                    continue
+                elif kind == CHILD:
+                    if record is not None:
+                        target = {}
+                        record.setdefault(key, []).append(target)
+                    continue
+                else:
+                    if target is not None:
+                        target[key] = True
+                    continue
+
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+
+            value = value.strip()
+            if not value:
+                continue
+
+            if target is None:
+                if self.starts:  # Outside of any record
+                    continue
+                record = target = dict(context)
+
+            target[intern(key.strip())] = value
+
+        if self._complete(record):
+            yield record
+
+
+def parse_properties(lines):
+    """ Parse output describing a single object, e.g. mdadm --detail
+
+    :param iterable[str] lines: Output lines
+    :return: All properties, empty if there were none
+    :rtype: dict[str, str]
+    """
+    for record in SINGLE_RECORD.parse(lines):
+        return record
+    return {}
+
+
+SINGLE_RECORD = BlockParser()
@@ -0,0 +1,451 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import zlib
+from contextlib import contextmanager
+
+from ccbr_server.common import atomic_write
+
+try:
+    # noinspection PyCompatibility
+    from urllib.request import urlopen, Request
+    # noinspection PyCompatibility
+    from urllib.error import HTTPError
+except ImportError:
+    # noinspection PyCompatibility
+    from urllib2 import urlopen, Request, HTTPError
+
+log = logging.getLogger(__file__)
+
+BACKOFF_FILE = '.backoff'
+LAST_ACK_FILE = '.last_ack'
+LOCK_FILE = '.lock'
+REJECTED_FILE = '.rejected'
+
+RETRY_STATUSES = (408, 429)  # Client errors that may go away, other 4xx rejections are final
+
+DELETED_KEY = '__deleted__'
+ITEMS_KEY = '__items__'
+
+
+class _Unchanged(object):
+    pass
+
+
+UNCHANGED = _Unchanged()
+
+
+def make_delta(old, new):
+    """ Encode new as changes against old. Dictionaries only keep changed keys and list keys that are gone under
+    __deleted__. Lists of the same length become {'__items__': {index: change}}, anything else is sent as is.
+
+    :param Any old: Previously acknowledged value
+    :param Any new: Current value
+    :return: Changes, UNCHANGED if there are none
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        delta = {}
+
+        for key, value in new.items():
+            change = make_delta(old[key], value) if key in old else value
+            if change is not UNCHANGED:
+                delta[key] = change
+
+        deleted = [key for key in old if key not in new]
+        if deleted:
+            delta[DELETED_KEY] = deleted
+
+        return delta or UNCHANGED
+
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        items = {}
+
+        for i, (old_item, new_item) in enumerate(zip(old, new)):
+            change = make_delta(old_item, new_item)
+            if change is not UNCHANGED:
+                items[str(i)] = change
+
+        return {ITEMS_KEY: items} if items else UNCHANGED
+
+    if type(old) == type(new) and old == new:
+        return UNCHANGED
+
+    return new
+
+
+def apply_delta(old, delta):
+    """ Reverse of make_delta, rebuild the current value from the acknowledged value and the changes
+
+    :param Any old: Previously acknowledged value
+    :param Any delta: Changes returned by make_delta
+    :return: Current value
+    """
+    if delta is UNCHANGED:
+        return old
+
+    if isinstance(delta, dict) and ITEMS_KEY in delta and isinstance(old, list):
+        new = list(old)
+        for i, change in delta[ITEMS_KEY].items():
+            new[int(i)] = apply_delta(old[int(i)], change)
+        return new
+
+    if isinstance(delta, dict) and isinstance(old, dict):
+        new = dict((k, v) for k, v in old.items() if k not in delta.get(DELETED_KEY, ()))
+        for key, change in delta.items():
+            if key != DELETED_KEY:
+                new[key] = apply_delta(old[key], change) if key in old else change
+        return new
+
+    return delta
+
+
+def report_deltas(base, reports):
+    """ Encode each report as changes against the acknowledged report of the same name. Reports missing from a payload
+    are not deleted, daemon payloads only hold the reports that changed.
+
+    :param dict[str, Any] base: Acknowledged reports by name
+    :param dict[str, Any] reports: Reports to send by name
+    :return: Changed reports, new ones whole
+    :rtype: dict[str, Any]
+    """
+    deltas = {}
+
+    for name, report in reports.items():
+        change = make_delta(base[name], report) if name in base else report
+        if change is not UNCHANGED:
+            deltas[name] = change
+
+    return deltas
+
+
+def payload_hash(payload):
+    """ Stable identifier of a payload, a delta names the acknowledged reports it is based on with it
+
+    :param dict[str, Any] payload:
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def gzip_compress(data):
+    """ gzip.compress is not available on python 2
+
+    :param bytes data:
+    :rtype: bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16 + wbits writes a gzip container
+    return compressor.compress(data) + compressor.flush()
+
+
+def is_rejected(error):
+    """
+    :param Exception error: Error sending a payload
+    :return: The site will never accept the payload, sending it again is pointless
+    :rtype: bool
+    """
+    return isinstance(error, HTTPError) and 400 <= error.code < 500 and error.code not in RETRY_STATUSES
+
+
+def remove_payload(path):
+    """ Remove a spooled payload, another process may have removed it already
+
+    :param str path: Spooled payload
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class Outbox(object):
+    """ Local spool of report payloads waiting to be sent to the monitoring site. Each payload is written to its own
+    file first, a sender then POSTs the oldest payloads in batches and removes them once the site accepted them. If
+    the site is down, sending backs off exponentially and the payloads wait in the spool for the next attempt. A
+    payload the site rejects with a client error other than 408 or 429 is dropped, it would hold up all later ones.
+
+    Overlapping runs, e.g. cron and the daemon, share the spool. Only the one holding its lock sends and trims, the
+    others only add their payloads and leave them for it.
+    """
+
+    def __init__(self, spool_dir, url, timeout=10, batch_size=20, max_bytes=50 * 1024 ** 2, backoff=60,
+                 max_backoff=3600, compress=False, delta=False, on_ack=None, on_drop=None):
+        """
+        :param str spool_dir: Directory holding payloads waiting to be sent
+        :param str url: Url to POST payloads to
+        :param float|int|str timeout: Connect and read timeout in seconds for each POST
+        :param int|str batch_size: Maximum number of payloads sent in one drain
+        :param int|str max_bytes: Size cap of the spool, oldest payloads are dropped once it is exceeded
+        :param float|int|str backoff: Seconds to wait after the first failed POST, doubles with every failure
+        :param float|int|str max_backoff: Longest wait between two attempts in seconds
+        :param bool compress: Send payloads with Content-Encoding: gzip
+        :param bool delta: Send only the changes of each report since it was last acknowledged
+        :param (dict[str, Any]) -> None on_ack: Called with each payload the site accepted
+        :param (dict[str, Any]) -> None on_drop: Called with each payload dropped without sending it
+        """
+        self.spool_dir = spool_dir
+        self.url = url
+        self.timeout = float(timeout)
+        self.batch_size = int(batch_size)
+        self.max_bytes = int(max_bytes)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.compress = compress
+        self.delta = delta
+        self.on_ack = on_ack
+        self.on_drop = on_drop
+
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir, 0o700)
+
+    def put(self, payload):
+        """ Spool a payload for sending
+
+        :param dict[str, Any] payload: Reports to send
+        :return: Path of the spooled payload
+        :rtype: str
+        """
+        path = os.path.join(self.spool_dir, '%.6f-%d.json' % (time.time(), os.getpid()))
+        atomic_write(path, json.dumps(payload, separators=(',', ':')).encode())
+        log.debug("Spooled payload to %s", path)
+
+        self.trim()
+
+        return path
+
+    def pending(self):
+        """ Spooled payloads, oldest first
+
+        :rtype: list[str]
+        """
+        names = [f for f in os.listdir(self.spool_dir) if f.endswith('.json') and not f.startswith('.')]
+        return [os.path.join(self.spool_dir, f) for f in sorted(names, key=lambda f: float(f.split('-')[0]))]
+
+    @contextmanager
+    def locked(self):
+        """ Hold the lock of the spool while the block runs, without waiting for it
+
+        :return: False if another process holds the lock
+        :rtype: bool
+        """
+        fd = os.open(os.path.join(self.spool_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+            else:
+                yield True
+        finally:
+            os.close(fd)  # Releases the lock
+
+    def trim(self):
+        """ Drop the oldest payloads until the spool fits into its size cap
+        """
+        with self.locked() as locked:
+            if not locked:
+                log.debug("Spool is locked by another process, not trimming it")
+                return
+
+            pending = []
+            for path in self.pending():
+                try:
+                    pending.append((path, os.path.getsize(path)))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            total = sum(size for _path, size in pending)
+
+            for path, size in pending:
+                if total <= self.max_bytes:
+                    break
+
+                log.warning("Spool is over %d bytes, dropping %s", self.max_bytes, path)
+                self.drop(path)
+                total -= size
+
+    def drop(self, path):
+        """ Remove a payload without sending it
+
+        :param str path: Spooled payload
+        """
+        payload = None
+        if self.on_drop is not None:
+            try:
+                with open(path, 'rb') as fio:
+                    payload = json.loads(fio.read().decode())
+            except (IOError, OSError, ValueError) as e:
+                log.warning("Can't read dropped payload %s: %s", path, e)
+
+        remove_payload(path)
+
+        if payload is not None:
+            self.on_drop(payload)
+
+    def encode(self, data, base=None):
+        """ Encode a spooled payload for sending
+
+        :param bytes data: Spooled payload
+        :param dict[str, Any] base: Acknowledged reports, send only changes against them
+        :return: Request body and its headers
+        :rtype: tuple[bytes, dict[str, str]]
+        """
+        headers = {'Content-Type': 'application/json'}
+
+        if base is not None:
+            payload = json.loads(data.decode())
+            payload['reports'] = report_deltas(base['reports'], payload['reports'])
+            payload['delta_base'] = payload_hash(base)
+            data = json.dumps(payload, separators=(',', ':')).encode()
+
+        if self.compress:
+            data = gzip_compress(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        return data, headers
+
+    def send(self, data, headers):
+        """ POST a single payload, raises if the site did not accept it
+
+        :param bytes data: Encoded payload
+        :param dict[str, str] headers: Request headers
+        """
+        req = Request(self.url)
+        for key, value in headers.items():
+            req.add_header(key, value)
+        urlopen(req, data, self.timeout).close()
+
+    def send_spooled(self, data):
+        """ Send a spooled payload, as changes against the acknowledged reports in delta mode
+
+        :param bytes data: Spooled payload
+        """
+        base = self._load_last_ack() if self.delta else None
+
+        try:
+            self.send(*self.encode(data, base))
+        except HTTPError as e:
+            if base is None or e.code != 409:
+                raise
+
+            # The site does not have our base anymore, fall back to the full payload, it is all the site has then
+            log.info("Delta base rejected, sending full payload")
+            self.send(*self.encode(data))
+            base = None
+
+        if self.delta:  # Reports that weren't in this payload stay as they were acknowledged before
+            acked = base or {'reports': {}}
+            acked['reports'].update(json.loads(data.decode())['reports'])
+            atomic_write(os.path.join(self.spool_dir, LAST_ACK_FILE), json.dumps(acked, separators=(',', ':')).encode())
+
+    def drain(self):
+        """ Send a batch of the oldest spooled payloads, stop at the first failure and back off. Nothing is sent while
+        another process is draining the spool, it sends our payloads too.
+
+        :return: Number of payloads sent
+        :rtype: int
+        """
+        with self.locked() as locked:
+            if not locked:
+                log.info("Spool is being sent by another process")
+                return 0
+
+            return self._drain()
+
+    def _drain(self):
+        failures, next_attempt = self._load_backoff()
+        if time.time() < next_attempt:
+            log.info("Backing off after %d failures, next attempt in %.0fs", failures, next_attempt - time.time())
+            return 0
+
+        sent = 0
+
+        for path in self.pending()[:self.batch_size]:
+            try:
+                with open(path, 'rb') as fio:
+                    data = fio.read()
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue  # Removed since the spool was listed
+
+            try:
+                self.send_spooled(data)
+            except Exception as e:
+                if is_rejected(e):
+                    log.error("%s rejected %s (%s), dropping it, it is kept as %s until the next rejection", self.url,
+                              path, e, REJECTED_FILE)
+                    atomic_write(os.path.join(self.spool_dir, REJECTED_FILE), data)
+                    self.drop(path)
+                    continue
+
+                failures += 1
+                delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+                log.warning("Sending %s to %s failed (%s), retrying in %.0fs", path, self.url, e, delay)
+                self._save_backoff(failures, time.time() + delay)
+                return sent
+
+            remove_payload(path)
+            sent += 1
+
+            if self.on_ack is not None:
+                try:
+                    self.on_ack(json.loads(data.decode()))
+                except Exception:  # It was sent, don't send it again
+                    log.exception("Handling the acknowledgement of %s failed", path)
+
+        if failures:
+            self._save_backoff(0, 0)
+
+        if sent:
+            log.info("Sent %d payloads to %s", sent, self.url)
+
+        return sent
+
+    def _load_last_ack(self):
+        try:
+            with open(os.path.join(self.spool_dir, LAST_ACK_FILE), 'rb') as fio:
+                return json.loads(fio.read().decode())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _load_backoff(self):
+        try:
+            with open(os.path.join(self.spool_dir, BACKOFF_FILE)) as fio:
+                state = json.load(fio)
+            return state['failures'], state['next_attempt']
+        except (IOError, OSError, ValueError, KeyError):
+            return 0, 0
+
+    def _save_backoff(self, failures, next_attempt):
+        atomic_write(os.path.join(self.spool_dir, BACKOFF_FILE),
+                     json.dumps({'failures': failures, 'next_attempt': next_attempt}).encode())
+
+
+def get_outbox(config, on_ack=None):
+    """ Outbox configured from the [outbox] section
+
+    :param configparser.ConfigParser config:
+    :param (dict[str, Any]) -> None on_ack: Called with each payload the site accepted
+    :rtype: Outbox
+    """
+    if not config.get('DEFAULT', 'hostname'):
+        config.set('DEFAULT', 'hostname', socket.gethostname().split('.')[0])
+
+    return Outbox(config.get('outbox', 'spool_dir'),
+                  config.get('DEFAULT', 'post_url'),
+                  timeout=config.get('outbox', 'timeout'),
+                  batch_size=config.get('outbox', 'batch_size'),
+                  max_bytes=config.get('outbox', 'max_bytes'),
+                  backoff=config.get('outbox', 'backoff'),
+                  max_backoff=config.get('outbox', 'max_backoff'),
+                  compress=config.get('outbox', 'compress') == 'gzip',
+                  delta=config.getboolean('outbox', 'delta'),
+                  on_ack=on_ack)
@@ -1,13 +1,56 @@
 import logging
 import os
+from collections import defaultdict
 
-# noinspection PyUnresolvedReferences
-from distutils.spawn import find_executable
-
-from ccbr_server.common import Report, format_msg, ReportException
+from ccbr_server.common import Report, format_msg, ReportException, compile_fields, which, capture, load_state, \
+    save_state, map_concurrent
 
 log = logging.getLogger(__file__)
 
+PCI_DEVICES = '/sys/bus/pci/devices'
+RAID_PCI_CLASSES = ('0x0104', '0x0107')  # RAID bus and SAS controllers
+
+# RAID manager modules, probed in this order. md goes last: hosts with a hardware controller often also have an md
+# mirror of their boot disks, and the hardware arrays are the ones to report
+RAID_MANAGERS = ('raid_megacli', 'raid_omreport', 'raid_storcli', 'raid_md')
+
+
+def controller_fingerprint(root=PCI_DEVICES):
+    """ Identify the storage controllers on this system, the RAID manager only has to be detected again if they change
+
+    :param str root: PCI devices in sysfs
+    :return: PCI address, vendor and device id of each RAID and SAS controller
+    :rtype: list[str]
+    """
+    controllers = []
+
+    try:
+        devices = sorted(os.listdir(root))
+    except OSError:
+        return controllers
+
+    for dev in devices:
+        ids = {}
+        try:
+            for attr in ('class', 'vendor', 'device'):
+                with open(os.path.join(root, dev, attr)) as fio:
+                    ids[attr] = fio.read().strip()
+        except (IOError, OSError):
+            continue
+
+        if ids['class'].startswith(RAID_PCI_CLASSES):
+            controllers.append('%s %s:%s' % (dev, ids['vendor'], ids['device']))
+
+    return controllers
+
+
+def executable_mtime(path):
+    """
+    :param str path: Path to an executable, may be None for managers that don't need one
+    :rtype: float
+    """
+    return os.stat(path).st_mtime if path else None
+
 
 class RaidReportException(ReportException):
     pass
@@ -19,17 +62,39 @@ class RaidReport(Report):
     :type adapters: list[Adapter]
     :type phy_drives: dict[str, PhysicalDrive]
     :type log_drives: list[LogicalDrive]
+    :type adapter_index: dict[str, Adapter]
+    :type logical_drive_index: dict[tuple[str, str], LogicalDrive]
+    :type slot_index: dict[tuple[str, str], PhysicalDrive]
+    :type status_index: dict[tuple[str, int], list[PhysicalDrive]]
     """
     name = 'raid'
     raid_manager = ''
     executables = []
 
-    adapters = []
-    phy_drives = {}
-    log_drives = []
+    # Collection phases and the phases each of them needs to be finished first, phases that don't depend on each other
+    # run at the same time. Phase <name> is collected by parse_<name>
+    phases = (
+        ('adapters', ()),
+        ('physical_drives', ('adapters',)),
+        ('logical_drives', ('adapters', 'physical_drives')),
+    )
+
+    def __init__(self, fields=None, executable=None):
+        """
+        :param list[str] fields: JSON paths of raw controller data to keep, everything is kept if empty
+        :param str executable: Path to the RAID CLI, searched on PATH if None
+        """
+        self.executable = executable or self.find_cli_path()
+        self.fields = compile_fields(fields or [])
+
+        self.adapters = []
+        self.phy_drives = {}
+        self.log_drives = []
 
-    def __init__(self):
-        self.executable = self.find_cli_path()
+        self.adapter_index = {}
+        self.logical_drive_index = {}
+        self.slot_index = {}
+        self.status_index = {}
 
     def collect_data(self):
         self.collect_all_data()
@@ -60,10 +125,9 @@ class RaidReport(Report):
         :rtype: str
         :raises: RaidReportException if an executable could not be found
         """
-        for exe in self.executables:
-            path = find_executable(exe)
-            if path:
-                return path
+        path = which(self.executables)
+        if path:
+            return path
         raise RaidReportException("Could not find executable on PATH: %s" % ','.join(self.executables))
 
     def collect_all_data(self, connect=True):
@@ -71,38 +135,110 @@ class RaidReport(Report):
 
         :param bool connect: Connect collected data
         """
-        self.parse_adapters()
-        self.parse_physical_drives()
-        self.parse_logical_drives()
+        # Start from scratch, so the same report can be collected repeatedly
+        self.adapters = []
+        self.phy_drives = {}
+        self.log_drives = []
+
+        self.adapter_index = {}
+        self.logical_drive_index = {}
+        self.slot_index = {}
+        self.status_index = {}
+
+        self.run_phases()
 
         self.post_process()
 
         if connect:
             self.connect_data()
 
+    def run_phases(self):
+        """ Run the parse_<phase> methods in waves, each wave runs all phases whose dependencies are finished at the
+        same time
+
+        :raises: RaidReportException if phases depend on each other in a circle
+        """
+        finished = set()
+        pending = list(self.phases)
+
+        while pending:
+            ready = [name for name, needs in pending if finished.issuperset(needs)]
+            if not ready:
+                raise RaidReportException("Circular dependency between phases: %s" % ', '.join(n for n, _ in pending))
+
+            log.debug("Collecting %s", ', '.join(ready))
+            map_concurrent(lambda phase: getattr(self, 'parse_' + phase)(), ready, len(ready))
+
+            finished.update(ready)
+            pending = [(name, needs) for name, needs in pending if name not in finished]
+
     def connect_data(self):
-        """ Replace id's of collected data with object references
+        """ Replace id's of collected data with object references and index the models, so lookups like
+        "failing drives on adapter 1" or "members of logical drive 3" don't scan lists
         """
-        adapter_map = {}
+        self.adapter_index = {}
+        self.logical_drive_index = {}
+        self.slot_index = {}
+        self.status_index = defaultdict(list)
+
         for adapter in self.adapters:
             adapter.physical_drives = []
             adapter.logical_drives = []
-            adapter_map[adapter.adapter_id] = adapter
+            adapter.spare_physical_drives = []
+            self.adapter_index[adapter.adapter_id] = adapter
+
+        for drive in self.phy_drives.values():
+            drive.logical_drive = None
 
         for drive in self.log_drives:
-            drive.adapter = adapter_map[drive.adapter_id]
+            drive.adapter = self.adapter_index[drive.adapter_id]
             drive.physical_drives = [self.phy_drives[d] for d in drive.phy_drive_ids]
             for pdrive in drive.physical_drives:
                 pdrive.logical_drive = drive
 
             drive.adapter.logical_drives.append(drive)
+            self.logical_drive_index[(drive.adapter_id, drive.drive_id)] = drive
 
         for drive in self.phy_drives.values():
-            drive.adapter = adapter_map[drive.adapter_id]
+            drive.adapter = self.adapter_index[drive.adapter_id]
             drive.adapter.physical_drives.append(drive)
+            if not drive.logical_drive:
+                drive.adapter.spare_physical_drives.append(drive)
 
-        for adapter in self.adapters:
-            adapter.spare_physical_drives = [d for d in adapter.physical_drives if not d.logical_drive]
+            self.slot_index[(drive.adapter_id, drive.slot)] = drive
+            self.status_index[(drive.adapter_id, drive.status)].append(drive)
+
+    def get_adapter(self, adapter_id):
+        """
+        :param str adapter_id: Adapter ID
+        :rtype: Adapter
+        """
+        return self.adapter_index.get(adapter_id)
+
+    def get_logical_drive(self, adapter_id, drive_id):
+        """
+        :param str adapter_id: Adapter ID
+        :param str drive_id: Logical drive ID
+        :return: Logical drive, its physical_drives are its members
+        :rtype: LogicalDrive
+        """
+        return self.logical_drive_index.get((adapter_id, drive_id))
+
+    def get_physical_drive(self, adapter_id, slot):
+        """
+        :param str adapter_id: Adapter ID
+        :param str slot: Slot of the drive
+        :rtype: PhysicalDrive
+        """
+        return self.slot_index.get((adapter_id, slot))
+
+    def physical_drives_with_status(self, adapter_id, status):
+        """
+        :param str adapter_id: Adapter ID
+        :param int status: PhysicalDrive.STATUS_GOOD, STATUS_FAILING or STATUS_FAILED
+        :rtype: list[PhysicalDrive]
+        """
+        return self.status_index.get((adapter_id, status), [])
 
     def parse_adapters(self):
         """ Query RAID system to get controller info
@@ -136,29 +272,88 @@ class RaidReport(Report):
         """
 
     @staticmethod
-    def automatic_cli():
-        """ Automatically detect the RAID manager on this system
-
+    def automatic_cli(fields=None, cache_path=None, options=None):
+        """ Automatically detect the RAID manager on this system. The detected manager is cached together with the
+        storage controllers, its executable's mtime and the probe order in RAID_MANAGERS. It is only detected again if
+        any of them changed or if the cached manager fails to initialize.
+
+        :param list[str] fields: JSON paths of raw controller data to keep, everything is kept if empty
+        :param str cache_path: State file caching the detected manager, always detect if None
+        :param dict[str, dict[str, Any]] options: Keyword arguments for the report of each raid_manager
         :return: Supported RAID report instance
         :rtype: RaidReport
         """
-        for f in os.listdir(os.path.dirname(__file__)):
-            if not (f.startswith('raid_') and f.endswith('.py')):
-                continue
+        if capture.replaying:  # The cache describes this system, not the replayed one
+            cache_path = None
+
+        fingerprint = controller_fingerprint() if cache_path else None
+
+        if cache_path:
+            report = RaidReport._cached_cli(cache_path, fingerprint, fields, options or {})
+            if report is not None:
+                return report
+
+        report = RaidReport._detect_cli(fields, options or {})
+
+        if cache_path:
+            save_state(cache_path, {
+                'controllers': fingerprint,
+                'module': report.__module__,
+                'executable': report.executable,
+                'mtime': executable_mtime(report.executable),
+                'managers': list(RAID_MANAGERS),
+            })
 
-            log.info("Considering %s", f)
+        return report
+
+    @staticmethod
+    def _cached_cli(cache_path, fingerprint, fields, options):
+        """ Initialize the cached RAID manager if it is still valid
+
+        :rtype: RaidReport
+        """
+        cached = load_state(cache_path)
+        if not cached:
+            return None
+
+        try:
+            if cached['controllers'] != fingerprint or executable_mtime(cached['executable']) != cached['mtime']:
+                log.info("Storage controllers or RAID CLI changed, detecting RAID manager again")
+                return None
+
+            if cached.get('managers') != list(RAID_MANAGERS):  # Detected in a different order
+                log.info("RAID managers changed, detecting RAID manager again")
+                return None
+
+            module = __import__(cached['module'], fromlist=['report'])
+            report = module.report(fields=fields, executable=cached['executable'],
+                                   **options.get(module.report.raid_manager, {}))
+        except (KeyError, OSError, ImportError, AttributeError, RaidReportException) as e:
+            log.info("Cached RAID manager failed, detecting RAID manager again: %s", e)
+            return None
+
+        log.info("Using cached RAID manager: %s", module.report.__name__)
+        return report
+
+    @staticmethod
+    def _detect_cli(fields, options):
+        """ Probe every RAID manager module in the order of RAID_MANAGERS
+
+        :rtype: RaidReport
+        """
+        for module_name in RAID_MANAGERS:
+            log.info("Considering %s", module_name)
 
-            module_name, _py = os.path.splitext(f)
             try:
                 module = __import__('ccbr_server.%s' % module_name, fromlist=['report'])
-                log.debug("Imported %s", f)
+                log.debug("Imported %s", module_name)
             except ImportError:
                 # Should not happen
-                log.debug("Import failed for %s", f)
+                log.debug("Import failed for %s", module_name)
                 continue
 
             try:
-                report = module.report()  # run constructor
+                report = module.report(fields=fields, **options.get(module.report.raid_manager, {}))  # run constructor
                 log.info("Found supported RAID manager: %s", module.report.__name__)
                 return report
             except AttributeError:
@@ -187,7 +382,7 @@ class RaidReport(Report):
                     print('\t\t%s' % pdrive)
 
 
-class Adapter:
+class Adapter(object):
     """ Standardized Adapter model
 
     :type logical_drives: list[LogicalDrive]
@@ -195,11 +390,8 @@ class Adapter:
     :type spare_physical_drives: list[PhysicalDrive]
     :type data: dict[str, str]
     """
-    logical_drives = None
-    physical_drives = None
-    spare_physical_drives = None
-
-    data = {}
+    __slots__ = ('adapter_id', 'name', 'serial', 'temperature', 'data', 'logical_drives', 'physical_drives',
+                 'spare_physical_drives')
 
     def __init__(self, adapter_id, name, serial, temperature, data=None):
         """
@@ -213,9 +405,11 @@ class Adapter:
         self.name = name
         self.serial = serial
         self.temperature = int(temperature) if temperature else None
+        self.data = data or {}
 
-        if data:
-            self.data = data
+        self.logical_drives = []
+        self.physical_drives = []
+        self.spare_physical_drives = []
 
     def __str__(self):
         string_fmt = ['Adapter {adapter_id}: {name}']
@@ -223,7 +417,7 @@ class Adapter:
             string_fmt.append('{temperature}C')
 
         string_fmt = ' | '.join(string_fmt)
-        return string_fmt.format(**vars(self))
+        return string_fmt.format(adapter_id=self.adapter_id, name=self.name, temperature=self.temperature)
 
     def to_dict(self):
         return {
@@ -234,17 +428,15 @@ class Adapter:
         }
 
 
-class LogicalDrive:
+class LogicalDrive(object):
     """ Standardized logical drive model
 
     :type adapter: Adapter
     :type physical_drives: list[PhysicalDrive]
     :type data: dict[str, str]
     """
-    adapter = None
-    physical_drives = None
-
-    data = {}
+    __slots__ = ('drive_id', 'raid_level', 'size', 'state', 'adapter_id', 'phy_drive_ids', 'problem', 'data',
+                 'adapter', 'physical_drives')
 
     def __init__(self, drive_id, raid_level, size, state, adapter_id, pd_list, problem, data=None):
         """
@@ -262,13 +454,15 @@ class LogicalDrive:
         self.adapter_id = adapter_id
         self.phy_drive_ids = [d for d in pd_list]
         self.problem = problem
+        self.data = data or {}
 
-        if data:
-            self.data = data
+        self.adapter = None
+        self.physical_drives = []
 
     def __str__(self):
         state = format_msg(self.state, self.problem and 'red')
-        return "Logical drive {drive_id}: {raid_level}, {size}, {st}".format(st=state, **vars(self))
+        return "Logical drive {drive_id}: {raid_level}, {size}, {st}".format(
+            drive_id=self.drive_id, raid_level=self.raid_level, size=self.size, st=state)
 
     def to_dict(self):
         return {
@@ -279,7 +473,7 @@ class LogicalDrive:
         }
 
 
-class PhysicalDrive:
+class PhysicalDrive(object):
     """ Standardized physical drive model
 
     :type adapter: Adapter
@@ -290,10 +484,8 @@ class PhysicalDrive:
     STATUS_FAILING = 1
     STATUS_FAILED = 2
 
-    adapter = None
-    logical_drive = None
-
-    data = {}
+    __slots__ = ('drive_id', 'state', 'size', 'protocol', 'drive_type', 'fru', 'temperature', 'status', 'adapter_id',
+                 'slot', 'hotspare', 'data', 'adapter', 'logical_drive')
 
     def __init__(self, drive_id, state, size, protocol, drive_type, fru, temperature, status, adapter_id, slot,
                  hotspare, data=None):
@@ -321,9 +513,10 @@ class PhysicalDrive:
         self.adapter_id = adapter_id
         self.slot = slot
         self.hotspare = hotspare
+        self.data = data or {}
 
-        if data:
-            self.data = data
+        self.adapter = None
+        self.logical_drive = None
 
     def __str__(self):
         if self.status == PhysicalDrive.STATUS_GOOD:
@@ -336,8 +529,8 @@ class PhysicalDrive:
             status = format_msg(self.state, 'red')
 
         return "Drive {drive_id:>2}: {size} {protocol} {drive_type}; {temperature}; {will_fail}".format(
-            will_fail=status,
-            **vars(self))
+            drive_id=self.drive_id, size=self.size, protocol=self.protocol, drive_type=self.drive_type,
+            temperature=self.temperature, will_fail=status)
 
     def to_dict(self):
         return {
@@ -1,76 +1,658 @@
 import logging
 import os
 import re
-import subprocess
+import select
+import threading
+import time
 from collections import defaultdict
 from functools import partial
-from tempfile import TemporaryFile
 
-from ccbr_server.common import get_pool
+from ccbr_server.common import run_command, map_concurrent, read_file, path_exists, which, capture, load_state, \
+    save_state, format_msg, LatencyHistory
+from ccbr_server.kvparse import parse_properties
 from ccbr_server.raid import RaidReport, RaidReportException, Adapter, PhysicalDrive, LogicalDrive
 
 log = logging.getLogger(__file__)
 
-PROP_RE = re.compile(r'(.*?)\s*:\s*(.+)')
+MDSTAT = '/proc/mdstat'
+SYS_BLOCK = '/sys/block'
+SPEED_LIMITS = '/proc/sys/dev/raid/speed_limit_%s'  # System wide sync speed limits in KiB/s
 
+SYNC_SAMPLES = 10  # Progress samples kept for each array, throughput is measured over all of them
 
-def examine_physical_drive(device_path, mdadm, timeout):
-    cmd = ['timeout', str(timeout), mdadm, '--examine', device_path]
-    log.debug("Examining physical drive '%s'" % (' '.join(cmd),))
+MEMBER_RE = re.compile(r'^(\S+)\[\d+\]((?:\([A-Z]\))*)$')  # sdb1[3](S)
+PARTITION_RE = re.compile(r'^(.*\d)p\d+$|^(\D+)\d+$')  # nvme0n1p1, mmcblk0p1, sdb1
+
+# mdstat flags of a member device and the md state they stand for
+MEMBER_FLAGS = {
+    'F': 'faulty',
+    'S': 'spare',
+    'W': 'write_mostly',
+    'R': 'replacement',
+}
+
+# md sync_action and how mdadm --detail describes it in the array state
+SYNC_ACTIONS = {
+    'resync': 'resyncing',
+    'recover': 'recovering',
+    'check': 'checking',
+    'repair': 'repairing',
+    'reshape': 'reshaping',
+}
+
+
+def parse_mdstat(text):
+    """ List arrays and their member devices in /proc/mdstat
+
+    :param str text: Contents of /proc/mdstat
+    :return: Array names with their member devices and flags, e.g. [('md0', [('sdb1', ''), ('sdc1', 'S')])]
+    :rtype: list[tuple[str, list[tuple[str, str]]]]
+    """
+    arrays = []
+
+    for line in text.splitlines():
+        if not line.startswith('md'):
+            continue
 
-    out = None
+        name, sep, rest = line.partition(' : ')
+        if not sep:
+            continue
 
-    with TemporaryFile() as tmp:
-        ret = subprocess.call(cmd, stdout=tmp, stderr=tmp)
+        members = []
+        for token in rest.split():
+            m = MEMBER_RE.match(token)
+            if m:
+                members.append((m.group(1), m.group(2).replace('(', '').replace(')', '')))
 
-        if ret != 124:  # Not Timeout
-            tmp.seek(0)
-            out = tmp.read()
+        arrays.append((name.strip(), members))
+
+    return sorted(arrays, key=lambda array: (len(array[0]), array[0]))
+
+
+def mdstat_blocks(text):
+    """ Split /proc/mdstat into the lines describing each array
+
+    :param str text: Contents of /proc/mdstat
+    :return: Lines of each array, e.g. {'md0': 'md0 : active raid1 ...\n      1024 blocks [2/2] [UU]'}
+    :rtype: dict[str, str]
+    """
+    blocks = {}
+    name = None
+
+    for line in text.splitlines():
+        if line.startswith('md') and ' : ' in line:
+            name = line.split()[0]
+            blocks[name] = [line]
+        elif name is not None and line.startswith(' '):
+            blocks[name].append(line)
         else:
-            log.warning("mdadm timeout for %s", device_path)
+            name = None
+
+    return dict((name, '\n'.join(lines)) for name, lines in blocks.items())
+
+
+def read_attribute(path, default=''):
+    """ Read a sysfs attribute
+
+    :param str path: Attribute path
+    :param str default: Returned if the attribute can't be read
+    :rtype: str
+    """
+    try:
+        return read_file(path).strip()
+    except (IOError, OSError):
+        return default
+
+
+def member_disk(member):
+    """ Find the disk of an md member device, which is usually a partition
+
+    :param str member: Member device name, e.g. sdb1
+    :return: Disk name, e.g. sdb
+    :rtype: str
+    """
+    if path_exists(os.path.join(SYS_BLOCK, member)):  # Whole disk
+        return member
+
+    m = PARTITION_RE.match(member)
+    if m:
+        return m.group(1) or m.group(2)
+
+    return member
+
+
+def human_size(size):
+    """ Format a size like lsblk does
+
+    :param int size: Size in bytes
+    :return: Size in binary units with one decimal, e.g. 3.6T
+    :rtype: str
+    """
+    size = float(size)
+    for unit in 'BKMGTP':
+        if size < 1024:
+            break
+        size /= 1024
+
+    # noinspection PyUnboundLocalVariable
+    text = '%.1f' % size
+    if text.endswith('.0'):
+        text = text[:-2]
+
+    return text + unit
+
+
+def redundancy(level, raid_disks, layout):
+    """ Number of member devices an array can lose and keep working
+
+    :param str level: RAID level as in sysfs, e.g. raid6
+    :param int raid_disks: Number of member devices
+    :param int layout: md layout, for raid10 it encodes the number of copies
+    :rtype: int
+    """
+    if level == 'raid1':
+        return raid_disks - 1
+    if level in ('raid4', 'raid5'):
+        return 1
+    if level == 'raid6':
+        return 2
+    if level == 'raid10':
+        near, far = layout & 0xff, (layout >> 8) & 0xff
+        return max(near * far - 1, 0)
+    return 0
+
+
+class MdWatcher(object):
+    """ Sleeps until md reports a change. md wakes poll() with POLLPRI/POLLERR on /proc/mdstat when an array is
+    assembled, stopped, degraded or starts syncing, and on the sysfs attributes of an array when they change. A file
+    that woke us up is read again from the start, which also arms it for the next poll().
+
+    :type files: dict[int, tuple[str, str]]
+    :type values: dict[int, str]
+    :type mdstat: dict[str, str]
+    """
+    ATTRIBUTES = ('array_state', 'degraded', 'sync_action')
+    EVENTS = select.POLLPRI | select.POLLERR if hasattr(select, 'poll') else 0
+
+    # array_state flips between these while an array is written to, they are all a running array
+    RUNNING = ('clean', 'active', 'active-idle', 'write-pending')
+
+    def __init__(self):
+        if not hasattr(select, 'poll'):
+            raise RaidReportException("poll() is not available, can't watch md arrays")
+
+        self.poller = select.poll()
+        self.files = {}  # fd -> array and attribute, array is None for /proc/mdstat
+        self.values = {}  # fd -> last value read
+        self.mdstat = {}  # array -> its lines in /proc/mdstat
+
+        fd = self._open(MDSTAT, None, None)
+        self._update_arrays(self.values[fd])
+
+    def close(self):
+        for fd in list(self.files):
+            self._close(fd)
+
+    def _open(self, path, array, attribute):
+        fd = os.open(path, os.O_RDONLY)
+        self.files[fd] = (array, attribute)
+        self.values[fd] = self._read(fd)
+        self.poller.register(fd, self.EVENTS)
+        return fd
+
+    def _close(self, fd):
+        self.poller.unregister(fd)
+        os.close(fd)
+        del self.files[fd]
+        del self.values[fd]
+
+    @staticmethod
+    def _read(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return b''.join(chunks).decode()
+            chunks.append(chunk)
+
+    def _update_arrays(self, text):
+        """ Find arrays whose lines in /proc/mdstat changed and watch the attributes of new arrays
+
+        :param str text: Contents of /proc/mdstat
+        :return: Arrays that changed, appeared or disappeared
+        :rtype: set[str]
+        """
+        blocks = mdstat_blocks(text)
+        changed = set(name for name in set(blocks) | set(self.mdstat) if blocks.get(name) != self.mdstat.get(name))
 
-    if ret != 0:
-        return device_path, {}
+        for fd, (array, _attribute) in list(self.files.items()):
+            if array is not None and array not in blocks:
+                self._close(fd)
+
+        for array in set(blocks) - set(self.mdstat):
+            for attribute in self.ATTRIBUTES:
+                try:
+                    self._open(os.path.join(SYS_BLOCK, array, 'md', attribute), array, attribute)
+                except (IOError, OSError) as e:
+                    log.debug("Can't watch %s of %s: %s", attribute, array, e)
+
+        self.mdstat = blocks
+        return changed
+
+    def _changed(self, fd, value):
+        array, attribute = self.files[fd]
+        old, self.values[fd] = self.values[fd], value
+
+        if attribute == 'array_state' and old.strip() in self.RUNNING and value.strip() in self.RUNNING:
+            return False
+
+        return old != value
+
+    def wait(self, timeout=None):
+        """ Wait for md to report a change
+
+        :param float timeout: Seconds to wait, indefinitely if None
+        :return: Arrays that changed, empty on timeout
+        :rtype: set[str]
+        """
+        changed = set()
+
+        for fd, _event in self.poller.poll(None if timeout is None else timeout * 1000):
+            if fd not in self.files:  # Closed by an earlier event of this poll
+                continue
+
+            array, _attribute = self.files[fd]
+            value = self._read(fd)
+
+            if array is None:
+                self.values[fd] = value
+                changed.update(self._update_arrays(value))
+            elif self._changed(fd, value):
+                changed.add(array)
+
+        return changed
+
+
+def format_duration(seconds):
+    """
+    :param float seconds: Duration
+    :return: Duration in days, hours and minutes, e.g. 1d 2h 5m
+    :rtype: str
+    """
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if days:
+        return '%dd %dh %dm' % (days, hours, minutes)
+    if hours:
+        return '%dh %dm' % (hours, minutes)
+    return '%dm' % minutes
 
-    drive = {}
-    for line in out.decode().splitlines():
-        m = PROP_RE.match(line.strip())
-        if m:
-            # noinspection PyTypeChecker
-            drive.update([m.groups()])  # our regex has exactly 2 groups, ignore warning
 
-    return device_path, drive
+class SyncProgress(object):
+    """ Progress of a resync, recovery, check, repair or reshape of an md array. Speeds are in KiB/s
+
+    :type throughput: float
+    :type eta: float
+    """
+    __slots__ = ('array', 'action', 'completed', 'total', 'speed', 'speed_min', 'speed_max', 'throughput', 'eta',
+                 'slow')
+
+    def __init__(self, array, action, completed, total, speed, speed_min, speed_max):
+        """
+        :param str array: Array name, e.g. md0
+        :param str action: sync_action, e.g. recover
+        :param int completed: Sectors done
+        :param int total: Sectors to do
+        :param int speed: Current speed reported by md
+        :param int speed_min: Speed md keeps up even with competing I/O
+        :param int speed_max: Speed md doesn't go over
+        """
+        self.array = array
+        self.action = action
+        self.completed = completed
+        self.total = total
+        self.speed = speed
+        self.speed_min = speed_min
+        self.speed_max = speed_max
+
+        self.throughput = None  # Measured over the kept samples, None until there are two of them
+        self.eta = None  # Seconds
+        self.slow = False
+
+    @property
+    def percent(self):
+        return 100. * self.completed / self.total if self.total else 0.
+
+    def __str__(self):
+        string = '%s %.1f%% at %.1fMB/s' % (self.action, self.percent, (self.throughput or self.speed) / 1024.)
+        if self.eta is not None:
+            string += ', %s left' % format_duration(self.eta)
+        if self.slow:
+            string += ', ' + format_msg('slow, speed limit is %.1fMB/s' % (self.speed_max / 1024.), 'orange')
+
+        return string
+
+    def to_dict(self):
+        return {
+            'action': self.action,
+            'completed': self.completed,
+            'total': self.total,
+            'percent': round(self.percent, 2),
+            'speed': self.speed,
+            'speed_min': self.speed_min,
+            'speed_max': self.speed_max,
+            'throughput': self.throughput,
+            'eta': self.eta,
+            'slow': self.slow,
+        }
+
+
+def examine_physical_drive(device_path, mdadm, timeout, latency=None):
+    """
+    :param str device_path: Drive or partition to examine
+    :param str mdadm: Path to mdadm
+    :param int timeout: mdadm timeout in seconds
+    :param LatencyHistory latency: Latencies of earlier checks, the timeout comes from the drive's history if given
+    :return: Device path, mdadm properties of the drive, empty if mdadm failed, and how long mdadm took compared to
+        earlier checks if latency is given
+    :rtype: tuple[str, dict[str, str], dict[str, Any]]
+    """
+    if latency is not None:
+        timeout = latency.timeout_for(device_path)
+
+    cmd = [mdadm, '--examine', device_path]
+    log.debug("Examining physical drive '%s'" % (' '.join(cmd),))
+
+    res = run_command(cmd, timeout=timeout, quiet=True, io=True)
+
+    if res.timed_out:
+        log.warning("mdadm timeout for %s", device_path)
+        return device_path, {}, None
+
+    timing = latency.observe(device_path, res.duration) if latency is not None else None
+
+    if res.returncode != 0:
+        return device_path, {}, timing
+
+    return device_path, parse_properties(res.stdout.decode().splitlines()), timing
 
 
 class MdReport(RaidReport):
+    """ Linux software RAID. Arrays are read from /proc/mdstat and /sys/block/md*/md/ without running anything, mdadm
+    is only used if those are not available, e.g. with /sys not mounted in a container.
+
+    :type members: list[tuple[str, list[tuple[str, str]]]]
+    :type member_disks: dict[str, str]
+    :type watcher: MdWatcher
+    :type changed_arrays: set[str]
+    :type sync_progress: dict[str, SyncProgress]
+    :type sync_samples: dict[str, list[list[float]]]
+    :type latency: LatencyHistory
+    :type timings: dict[str, dict[str, Any]]
+    """
     raid_manager = 'md'
     executables = ['mdadm']
-    arrays = []
-
-    def __init__(self, timeout=10, concurrency=4):
+    phases = (
+        ('adapters', ()),
+        ('arrays', ()),
+        ('physical_drives', ('arrays',)),
+        ('logical_drives', ('arrays', 'physical_drives')),  # mdadm matches members by the UUID --examine found
+    )
+
+    def __init__(self, timeout=10, concurrency=4, fields=None, executable=None, sysfs=True, watch=True,
+                 slow_sync=0.1, state_path=None, adaptive_timeout=False, min_timeout=2, max_timeout=60,
+                 latency_path=None):
         """
         :param int|str timeout: mdadm timeout in seconds
         :param int|str concurrency: Thread pool size for concurrent checking
+        :param list[str] fields: JSON paths of raw controller data to keep, everything is kept if empty
+        :param str executable: Path to mdadm, searched on PATH if None
+        :param bool sysfs: Read arrays from /proc/mdstat and sysfs if available, always use mdadm if False
+        :param bool watch: Let daemon mode collect arrays as soon as md reports a change, needs sysfs
+        :param float|str slow_sync: Flag syncs slower than this fraction of their speed limit
+        :param str state_path: State file keeping sync progress samples between runs, only kept in memory if None
+        :param bool adaptive_timeout: Take the mdadm timeout of each drive and array from how long it took before
+        :param int|str min_timeout: Shortest adaptive mdadm timeout in seconds
+        :param int|str max_timeout: Longest adaptive mdadm timeout in seconds
+        :param str latency_path: State file keeping the latencies between runs, only kept in memory if None
         """
-        super(MdReport, self).__init__()
+        self.members = self._read_mdstat() if sysfs else None
+        self.sysfs = bool(self.members)
+        self.member_disks = {}
+
+        super(MdReport, self).__init__(fields=fields, executable=executable)
 
         self.timeout = int(timeout)
         self.concurrency = int(concurrency)
+        self.arrays = []
+
+        self.latency = LatencyHistory(timeout, min_timeout, max_timeout, latency_path) if adaptive_timeout else None
+        self.timings = {}  # mdadm latency of each physical drive and array
+
+        self.watch = watch
+        self.watcher = None
+        self.changed_arrays = set()
+        self._changed_lock = threading.Lock()
+
+        self.slow_sync = float(slow_sync)
+        self.state_path = None if capture.replaying else state_path  # Samples describe this system's arrays
+        self.sync_progress = {}
+        self.sync_samples = None
+
+        if self.sysfs:
+            self.arrays = ['/dev/' + name for name, _members in self.members]
+        else:
+            self._check_array_list()
+
+    def collect_data(self):
+        """ Collect only the arrays md reported a change for since the last collection, or everything if there were
+        none
+        """
+        with self._changed_lock:
+            changed, self.changed_arrays = self.changed_arrays, set()
+
+        if changed and self.sysfs and self.adapters:
+            self.collect_arrays(changed)
+        else:
+            self.timings = {}  # Drives and arrays that are gone don't keep their latency
+            self.collect_all_data()
+
+        return self
+
+    def collect_arrays(self, names):
+        """ Collect some arrays again and keep everything else from the last collection
+
+        :param set[str] names: Array names, e.g. md0
+        """
+        log.debug("Collecting arrays %s", ', '.join(sorted(names)))
+
+        self.parse_arrays()
+
+        # Disks with partitions in several arrays are collected from all of their arrays
+        disks = set(self.member_disks[m] for name, members in self.members if name in names for m, _flags in members)
+        arrays = [(name, members) for name, members in self.members
+                  if name in names or any(self.member_disks[m] in disks for m, _flags in members)]
+
+        current = set(self.member_disks.values())
+        self.log_drives = [d for d in self.log_drives if d.drive_id in self.arrays and d.drive_id[5:] not in names]
+        self.phy_drives = dict((disk, d) for disk, d in self.phy_drives.items()
+                               if disk in current and disk not in disks)
+
+        self._sysfs_physical_drives(arrays)
+        self._sysfs_logical_drives([(name, members) for name, members in self.members if name in names])
+
+        # Same order as a full collection
+        order = {}
+        for _name, members in self.members:
+            for member, _flags in members:
+                order.setdefault(self.member_disks[member], len(order))
+        self.phy_drives = dict(sorted(self.phy_drives.items(), key=lambda item: order[item[0]]))
+        self.log_drives.sort(key=lambda d: self.arrays.index(d.drive_id))
+
+        self.post_process()
+        self.connect_data()
+
+    def wait_for_change(self, timeout=None):
+        if not (self.watch and self.sysfs) or capture.replaying:
+            return None
+
+        try:
+            if self.watcher is None:
+                self.watcher = MdWatcher()
+            changed = self.watcher.wait(timeout)
+        except (IOError, OSError, RaidReportException) as e:
+            log.warning("Can't watch md arrays: %s", e)
+            return None
+
+        if changed:
+            log.info("md reported a change of %s", ', '.join(sorted(changed)))
+            with self._changed_lock:
+                self.changed_arrays.update(changed)
+
+        return bool(changed)
+
+    def post_process(self):
+        if self.sysfs:
+            self._collect_sync_progress()
+        if self.latency is not None:
+            self.latency.save()
+
+    def _collect_sync_progress(self):
+        """ Read the progress of every syncing array and measure its throughput over the progress samples of earlier
+        collections
+        """
+        if self.sync_samples is None:
+            self.sync_samples = (load_state(self.state_path) if self.state_path else None) or {}
+
+        now = time.time()
+        saved = bool(self.sync_samples)
+        self.sync_progress = {}
+
+        for name, _members in self.members:
+            progress = self._read_sync_progress(name)
+            if progress is None:
+                continue
 
-        self._check_array_list()
+            # A sample is [time, action, completed, total], a new sync starts with a new list of samples
+            samples = [sample for sample in self.sync_samples.get(name, [])
+                       if sample[1] == progress.action and sample[3] == progress.total and
+                       sample[2] <= progress.completed and sample[0] < now]
+            samples = (samples + [[now, progress.action, progress.completed, progress.total]])[-SYNC_SAMPLES:]
+            self.sync_samples[name] = samples
+
+            first = samples[0]
+            if len(samples) > 1:
+                progress.throughput = round((progress.completed - first[2]) / 2. / (now - first[0]), 1)
+
+            speed = progress.throughput if progress.throughput is not None else progress.speed
+            if speed:
+                progress.eta = round((progress.total - progress.completed) / 2. / speed)
+
+            progress.slow = progress.throughput is not None and \
+                progress.throughput < progress.speed_max * self.slow_sync
+
+            self.sync_progress[name] = progress
+
+        for name in list(self.sync_samples):  # Finished or stopped
+            if name not in self.sync_progress:
+                del self.sync_samples[name]
+
+        if self.state_path and (self.sync_samples or saved):
+            save_state(self.state_path, self.sync_samples)
+
+    @staticmethod
+    def _read_sync_progress(name):
+        """
+        :param str name: Array name, e.g. md0
+        :return: Progress of the running sync, None if the array isn't syncing
+        :rtype: SyncProgress
+        """
+        attr = os.path.join(SYS_BLOCK, name, 'md')
+
+        action = read_attribute(os.path.join(attr, 'sync_action'))
+        if action not in SYNC_ACTIONS:
+            return None
+
+        completed, sep, total = read_attribute(os.path.join(attr, 'sync_completed')).partition('/')
+        if not sep:  # none, or delayed until another array on the same disks finishes
+            return None
+
+        limits = []
+        for limit in ('min', 'max'):
+            value = read_attribute(os.path.join(attr, 'sync_speed_' + limit)) or \
+                read_attribute(SPEED_LIMITS % limit, '0')
+            limits.append(int(value.split()[0]))  # e.g. 1000 (system)
+
+        speed = read_attribute(os.path.join(attr, 'sync_speed'), '0')
+
+        return SyncProgress(name, action, int(completed), int(total), int(speed) if speed.isdigit() else 0, *limits)
+
+    def to_dict(self):
+        data = super(MdReport, self).to_dict()
+
+        for adapter in data['adapters']:
+            for drive in adapter['logical_drives']:
+                progress = self.sync_progress.get(drive['id'][len('/dev/'):])
+                drive['sync'] = progress.to_dict() if progress else None
+                drive['slow'] = self.slow(drive['id'])
+            for drive in adapter['physical_drives']:
+                drive['slow'] = self.slow(drive['id'])
+
+        return data
+
+    def slow(self, drive_id):
+        """ The latency of a drive is sent under _meta, only whether it was slower than usual is sent with the data
+
+        :param str drive_id: Physical drive or array
+        :return: mdadm took much longer than usual for the drive
+        :rtype: bool
+        """
+        timing = self.timings.get(drive_id)
+        return bool(timing and timing['slow'])
+
+    def stdout(self):
+        super(MdReport, self).stdout()
+
+        for name, progress in sorted(self.sync_progress.items()):
+            print('\t/dev/%s: %s' % (name, progress))
+
+    def find_cli_path(self):
+        if self.sysfs:  # mdadm is optional when md can be read from sysfs
+            return which(self.executables)
+        return super(MdReport, self).find_cli_path()
+
+    @staticmethod
+    def _read_mdstat():
+        """
+        :return: Arrays and their members, None if md can't be read from /proc/mdstat and sysfs
+        :rtype: list[tuple[str, list[tuple[str, str]]]]
+        """
+        try:
+            arrays = parse_mdstat(read_file(MDSTAT))
+        except (IOError, OSError) as e:
+            log.debug("Can't read %s, using mdadm: %s", MDSTAT, e)
+            return None
+
+        for name, _members in arrays:
+            if not path_exists(os.path.join(SYS_BLOCK, name, 'md')):
+                log.info("No sysfs attributes for %s, using mdadm", name)
+                return None
+
+        return arrays
 
     def _check_array_list(self):
-        p = subprocess.Popen([self.executable, '--detail', '--scan'], stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command([self.executable, '--detail', '--scan'], timeout=self.timeout)
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise RaidReportException("mdadm could not get list of arrays")
 
-        if not out:
+        if not res.stdout:
             raise RaidReportException("mdadm is not managing any arrays")
 
-        for line in out.decode().splitlines():
-            self.arrays.append(line.split()[1])  # second item is device
+        self.arrays = [line.split()[1] for line in res.stdout.decode().splitlines()]  # second item is device
 
     def parse_adapters(self):
         # No physical adapters present, just the software RAID
@@ -83,29 +665,152 @@ class MdReport(RaidReport):
 
         return self.adapters
 
+    def parse_arrays(self):
+        """ Read /proc/mdstat again, arrays may have been assembled or stopped and members replaced since the last
+        collection
+        """
+        if not self.sysfs:
+            return self.arrays  # Listed by mdadm --detail --scan
+
+        members = self._read_mdstat()
+        if members is None:
+            raise RaidReportException("Could not read md arrays from %s and sysfs" % MDSTAT)
+
+        self.members = members
+        self.arrays = ['/dev/' + name for name, _members in members]
+        self.member_disks = dict((member, member_disk(member))
+                                 for _name, array_members in members for member, _flags in array_members)
+
+        return self.arrays
+
     def parse_physical_drives(self):
+        if self.sysfs:
+            return self._sysfs_physical_drives(self.members)
+        return self._mdadm_physical_drives()
+
+    def parse_logical_drives(self):
+        if self.sysfs:
+            return self._sysfs_logical_drives(self.members)
+        return self._mdadm_logical_drives()
+
+    def _sysfs_physical_drives(self, arrays):
+        """
+        :param list[tuple[str, list[tuple[str, str]]]] arrays: Arrays and their members to collect
+        """
+        for name, members in arrays:
+            for member, flags in members:
+                attr = os.path.join(SYS_BLOCK, name, 'md', 'dev-' + member)
+                state = read_attribute(os.path.join(attr, 'state'))
+                if not state:  # Fall back to the flags in mdstat
+                    state = ','.join([MEMBER_FLAGS[f] for f in flags if f in MEMBER_FLAGS] or ['in_sync'])
+                slot = read_attribute(os.path.join(attr, 'slot'), 'none')
+
+                disk = self.member_disks[member]
+                disk_state = read_attribute(os.path.join(SYS_BLOCK, disk, 'device', 'state'))
+
+                states = state.split(',')
+                if 'faulty' in states or disk_state not in ('', 'running', 'live'):
+                    status = PhysicalDrive.STATUS_FAILED
+                elif 'write_error' in states or 'blocked' in states or 'want_replacement' in states:
+                    status = PhysicalDrive.STATUS_FAILING
+                else:
+                    status = PhysicalDrive.STATUS_GOOD
+
+                data = {
+                    'array': name,
+                    'member': member,
+                    'state': state,
+                    'slot': slot,
+                    'errors': read_attribute(os.path.join(attr, 'errors')),
+                }
+
+                pdrive = self.phy_drives.get(disk)
+                if pdrive is not None:  # Partitions of one disk in several arrays, keep the worst
+                    pdrive.status = max(pdrive.status, status)
+                    pdrive.hotspare = pdrive.hotspare and slot == 'none'
+                    continue
+
+                device_number = read_attribute(os.path.join(SYS_BLOCK, disk, 'dev'))
+                sectors = read_attribute(os.path.join(SYS_BLOCK, disk, 'size'), '0')
+                model = read_attribute(os.path.join(SYS_BLOCK, disk, 'device', 'model'))
+
+                self.phy_drives[disk] = PhysicalDrive(
+                    disk,
+                    state,
+                    human_size(int(sectors) * 512),
+                    device_number,
+                    '_'.join(model.split()),  # Same as lsblk, which escapes spaces
+                    '',  # fru
+                    '',  # temperature
+                    status,
+                    'Linux RAID',
+                    device_number,
+                    slot == 'none' and 'spare' in states,  # hotspare
+                    data
+                )
+
+        return self.phy_drives
+
+    def _sysfs_logical_drives(self, arrays):
+        """
+        :param list[tuple[str, list[tuple[str, str]]]] arrays: Arrays and their members to collect
+        """
+        for name, members in arrays:
+            attr = os.path.join(SYS_BLOCK, name, 'md')
+            data = dict((key, read_attribute(os.path.join(attr, key)))
+                        for key in ('array_state', 'level', 'raid_disks', 'degraded', 'sync_action', 'layout'))
+
+            raid_disks = int(data['raid_disks'] or 0)
+            degraded = int(data['degraded'] or 0)
+
+            state = [data['array_state']]
+            if degraded:
+                state.append('degraded')
+            if data['array_state'] == 'broken' or \
+                    degraded > redundancy(data['level'], raid_disks, int(data['layout'] or 0)):
+                state.append('FAILED')
+            if data['sync_action'] in SYNC_ACTIONS:
+                state.append(SYNC_ACTIONS[data['sync_action']])
+            state = ', '.join(state)
+
+            sectors = int(read_attribute(os.path.join(SYS_BLOCK, name, 'size'), '0'))
+
+            pd_list = [self.member_disks[member] for member, flags in members if 'S' not in flags]  # Without hot spares
+
+            self.log_drives.append(LogicalDrive(
+                '/dev/' + name,
+                data['level'].upper(),
+                '%.1fTB' % (sectors / 2. / 1024 ** 3,),  # 512 byte sectors
+                state,
+                'Linux RAID',
+                pd_list,
+                'FAILED' in state,
+                data
+            ))
+
+        return self.log_drives
+
+    def _mdadm_physical_drives(self):
         # Find OS drive first, so we can exclude it from the list
         os_drives = []
-        with open('/etc/mtab') as mtab:
-            for line in mtab:
-                if line.startswith('/dev/sd'):
-                    partition = line.split()[0]
-                    os_drives.append(re.sub(r'[0-9]', '', partition))
+        for line in read_file('/etc/mtab').splitlines():
+            if line.startswith('/dev/sd'):
+                partition = line.split()[0]
+                os_drives.append(re.sub(r'[0-9]', '', partition))
 
         log.info("Ignoring drives with OS partitions on them: %s" % (', '.join(os_drives),))
 
         cmd = ['lsblk', '--ascii', '--nodeps', '--noheadings', '--raw', '--output', 'NAME,MAJ:MIN,MODEL,SIZE,STATE']
         log.debug("Listing physical drives: '%s'" % (' '.join(cmd), ))
 
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command(cmd, timeout=self.timeout)
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise RaidReportException("Error running lsblk")
 
         devices = {}
 
-        for line in out.decode('ascii').splitlines():
+        for line in res.stdout.decode('ascii').splitlines():
             # noinspection PyTypeChecker
             line = re.sub(r'\\x[0-9]{2}', '_', line)  # Replace all \\x## with underscore
             drive_id, device_number, model, size, state = line.split()
@@ -119,7 +824,7 @@ class MdReport(RaidReport):
             if state != 'running':
                 status = PhysicalDrive.STATUS_FAILED
 
-            if os.path.exists(device_path + '1'):
+            if path_exists(device_path + '1'):
                 # We're using partitions in mdadm
                 device_path += '1'
 
@@ -141,11 +846,12 @@ class MdReport(RaidReport):
 
             self.phy_drives[drive_id] = pdrive
 
-        log.debug("Creating mdadm check thread pool of size %s", self.concurrency)
-        pool = get_pool()(processes=self.concurrency)
-        res = pool.map(partial(examine_physical_drive, mdadm=self.executable, timeout=self.timeout), devices.keys())
-        for device_path, device_out in res:
+        log.debug("Examining drives with %s threads", self.concurrency)
+        res = map_concurrent(partial(examine_physical_drive, mdadm=self.executable, timeout=self.timeout,
+                                     latency=self.latency), devices.keys(), self.concurrency)
+        for device_path, device_out, timing in res:
             pdrive = self.phy_drives[devices[device_path]]  # Map path back to PhysicalDrive
+            self.timings[pdrive.drive_id] = timing
 
             if device_out:
                 pdrive.hotspare = device_out.get('Device Role') == 'spare'
@@ -153,11 +859,9 @@ class MdReport(RaidReport):
             else:  # mdadm timeout occurred
                 pdrive.status = PhysicalDrive.STATUS_FAILING
 
-        pool.close()
-
         return self.phy_drives
 
-    def parse_logical_drives(self):
+    def _mdadm_logical_drives(self):
         pdrives_by_array_uuid = defaultdict(list)
         for drive_id, drive in self.phy_drives.items():
             if not drive.hotspare and 'Array UUID' in drive.data:
@@ -167,18 +871,14 @@ class MdReport(RaidReport):
             cmd = [self.executable, '--detail', arr]
             log.debug("Logical drive %s details: '%s'" % (arr, ' '.join(cmd), ))
 
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            out, _ = p.communicate()
+            res = run_command(cmd, timeout=self.latency.timeout_for(arr) if self.latency else self.timeout)
 
-            if p.returncode != 0:
+            if res.returncode != 0:
                 raise RaidReportException("mdadm could not get array details")
 
-            drive = {}
-            for line in out.decode().splitlines():
-                m = PROP_RE.match(line.strip())
-                if m:
-                    # noinspection PyTypeChecker
-                    drive.update([m.groups()])  # our regex has exactly 2 groups, ignore warning
+            self.timings[arr] = self.latency.observe(arr, res.duration) if self.latency else None
+
+            drive = parse_properties(res.stdout.decode().splitlines())
 
             size = 0
             if 'Array Size' in drive:  # Failed arrays don't report size
@@ -207,12 +907,23 @@ def main():
     # noinspection PyCompatibility
     import argparse
     parser = argparse.ArgumentParser(description='Analyze md raid')
-    _ = parser.parse_args()
+    parser.add_argument('-w', '--watch', default=False, action='store_true',
+                        help='Keep running and print arrays again whenever md reports a change.')
+    args = parser.parse_args()
 
     omreport = MdReport()
     omreport.collect_all_data()
     omreport.stdout()
 
+    while args.watch:
+        changed = omreport.wait_for_change()
+        if changed is None:
+            parser.error("md arrays can't be watched on this system")
+
+        if changed:
+            omreport.collect_data()
+            omreport.stdout()
+
 
 if __name__ == '__main__':
     main()
@@ -1,38 +1,41 @@
 import os
-import re
-import subprocess
+from functools import partial
 
+from ccbr_server.common import stream_command, map_concurrent
+from ccbr_server.kvparse import BlockParser
 from ccbr_server.raid import RaidReport, RaidReportException, Adapter, PhysicalDrive, LogicalDrive
 
-PROP_RE = re.compile(r'(.*?)\s*:\s*(.+)')
+# Records start with the controller header or with the ID of a drive
+CONTROLLERS = BlockParser(starts=[('Controller', None)])
+DRIVES = BlockParser(starts=[('ID', None)])
 
 
 class OmreportReport(RaidReport):
     raid_manager = 'omreport'
     executables = ['omreport']
+    phases = (
+        ('adapters', ()),
+        ('physical_drives', ('adapters',)),  # Drives are listed per controller
+        ('logical_drives', ('adapters',)),
+    )
+
+    def __init__(self, concurrency=4, fields=None, executable=None):
+        """
+        :param int|str concurrency: Number of virtual disks whose members are queried at the same time
+        :param list[str] fields: JSON paths of raw controller data to keep, everything is kept if empty
+        :param str executable: Path to omreport, searched on PATH if None
+        """
+        super(OmreportReport, self).__init__(fields=fields, executable=executable)
+
+        self.concurrency = int(concurrency)
 
     def parse_adapters(self):
-        p = subprocess.Popen([self.executable, 'storage', 'controller'], stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        with stream_command([self.executable, 'storage', 'controller']) as stream:
+            adapters = list(CONTROLLERS.parse(stream))
 
-        if p.returncode != 0:
+        if stream.result.returncode != 0:
             raise RaidReportException("omreport could not get adapter info")
 
-        adapters = []
-        adapter = {}
-
-        for line in out.decode().splitlines():
-            line = line.rstrip()
-
-            if line.startswith('Controller'):  # Begin parsing new adapter
-                adapter = {}
-                adapters.append(adapter)
-            else:  # We are in adapter block, parse the line
-                m = PROP_RE.match(line)
-                if m:
-                    # noinspection PyTypeChecker
-                    adapter.update([m.groups()])  # our regex has exactly 2 groups, ignore warning
-
         # Convert parsed data to a standard model
         for adapter in sorted(adapters, key=lambda a: a['ID']):
             self.adapters.append(Adapter(
@@ -45,93 +48,84 @@ class OmreportReport(RaidReport):
 
         return self.adapters
 
-    def __parse_drives(self, drive_type, adapter):
-        p = subprocess.Popen([self.executable, 'storage', drive_type, 'controller=%s' % adapter],
-                             stdout=subprocess.PIPE)
-        out, _ = p.communicate()
-
-        # Exit code is 255 even if a controller is there but no disk is connected
+    def __stream_drives(self, drive_type, adapter, add):
+        """ List drives of an adapter and convert each drive as soon as it is parsed
 
-        drives = []
-        drive = {}
+        :param str drive_type: pdisk or vdisk
+        :param str adapter: Adapter ID
+        :param callable add: Called with the properties of each drive
+        """
+        with stream_command([self.executable, 'storage', drive_type, 'controller=%s' % adapter],
+                            group='omreport:%s' % adapter) as stream:
+            for drive in DRIVES.parse(stream):
+                drive['adapter_id'] = adapter
+                add(drive)
 
-        for line in out.decode().splitlines():
-            line = line.rstrip()
+        # Exit code is 255 even if a controller is there but no disk is connected
 
-            if line.startswith('ID'):  # Begin parsing new drive
-                drive = {'adapter_id': adapter}
-                drives.append(drive)
+    def __parse_members(self, drive):
+        with stream_command([self.executable, 'storage', 'pdisk', 'controller=%s' % drive['adapter_id'],
+                             'vdisk=%s' % drive['ID']], group='omreport:%s' % drive['adapter_id']) as stream:
+            pdrives = [drive['adapter_id'] + pdrive['ID'] for pdrive in DRIVES.parse(stream)]
 
-            m = PROP_RE.match(line)
-            if m:
-                # noinspection PyTypeChecker
-                drive.update([m.groups()])  # our regex has exactly 2 groups, ignore warning
+        if stream.result.returncode != 0:
+            raise RaidReportException("omreport could not get logical drive info")
 
-        return drives
+        return pdrives
 
     def parse_physical_drives(self):
         if not self.adapters:
             raise RaidReportException("omreport can't get physical drive info w/o controller info")
 
-        drives = []
-
-        for adapter in self.adapters:
-            drives.extend(self.__parse_drives('pdisk', adapter.data['ID']))
-
-        for drive in drives:
-            drive['logical_drive_id'] = drive['ID'].split(':')[1]
-
-            status = PhysicalDrive.STATUS_GOOD
-            if drive['Status'] == 'Critical':
-                status = PhysicalDrive.STATUS_FAILED
-
-            pdrive = PhysicalDrive(
-                drive['ID'],
-                drive['Status'],
-                drive['Capacity'].split('(')[0].strip(),
-                drive['Bus Protocol'],
-                drive['Product ID'],
-                '',  # fru
-                '',  # temperature
-                status,
-                drive['adapter_id'],
-                drive['ID'],
-                drive['Hot Spare'] != 'No',
-                drive
-            )
-
-            self.phy_drives[drive['adapter_id'] + pdrive.drive_id] = pdrive
+        map_concurrent(partial(self.__stream_drives, 'pdisk', add=self._add_physical_drive),
+                       [a.data['ID'] for a in self.adapters], len(self.adapters))
 
         return self.phy_drives
 
+    def _add_physical_drive(self, drive):
+        """
+        :param dict[str, str] drive: Drive properties parsed from pdisk listing
+        """
+        drive['logical_drive_id'] = drive['ID'].split(':')[1]
+
+        status = PhysicalDrive.STATUS_GOOD
+        if drive['Status'] == 'Critical':
+            status = PhysicalDrive.STATUS_FAILED
+
+        pdrive = PhysicalDrive(
+            drive['ID'],
+            drive['Status'],
+            drive['Capacity'].split('(')[0].strip(),
+            drive['Bus Protocol'],
+            drive['Product ID'],
+            '',  # fru
+            '',  # temperature
+            status,
+            drive['adapter_id'],
+            drive['ID'],
+            drive['Hot Spare'] != 'No',
+            drive
+        )
+
+        self.phy_drives[drive['adapter_id'] + pdrive.drive_id] = pdrive
+
     def parse_logical_drives(self):
         if not self.adapters:
             raise RaidReportException("omreport can't get logical drive info w/o controller info")
 
-        drives = []
-
-        for adapter in self.adapters:
-            drives.extend(self.__parse_drives('vdisk', adapter.data['ID']))
-
-        for drive in drives:
-            p = subprocess.Popen(
-                [self.executable, 'storage', 'pdisk', 'controller=%s' % drive['adapter_id'], 'vdisk=%s' % drive['ID']],
-                stdout=subprocess.PIPE)
-            out, _ = p.communicate()
-
-            if p.returncode != 0:
-                raise RaidReportException("omreport could not get logical drive info")
+        # Virtual disks are few, keep them for the member queries. Keep them in adapter order too
+        adapter_ids = [a.data['ID'] for a in self.adapters]
+        vdisks = dict((adapter_id, []) for adapter_id in adapter_ids)
 
-            pdrives = []
+        map_concurrent(lambda adapter_id: self.__stream_drives('vdisk', adapter_id, vdisks[adapter_id].append),
+                       adapter_ids, len(adapter_ids))
 
-            for line in out.decode().splitlines():
-                line = line.rstrip()
+        drives = [drive for adapter_id in adapter_ids for drive in vdisks[adapter_id]]
 
-                if line.startswith('ID'):
-                    m = PROP_RE.match(line)
-                    physical_drive_id = m.group(2)
-                    pdrives.append(drive['adapter_id'] + physical_drive_id)
+        # pdisk listings don't say which virtual disk a drive belongs to, members have to be queried for each vdisk
+        members = map_concurrent(self.__parse_members, drives, self.concurrency)
 
+        for drive, pdrives in zip(drives, members):
             self.log_drives.append(LogicalDrive(
                 drive['ID'],
                 drive['Layout'],
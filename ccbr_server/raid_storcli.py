@@ -1,8 +1,8 @@
 import os
 import re
-import subprocess
 from collections import defaultdict
 
+from ccbr_server.common import run_command, project
 from ccbr_server.raid import RaidReport, RaidReportException, Adapter, PhysicalDrive, LogicalDrive
 
 DRIVE_RE = re.compile(r'Drive /c(\d+)/e(\d+)/s(\d+)')
@@ -12,17 +12,21 @@ VD_RE = re.compile(r'/c(\d+)/v(\d+)')
 class StorCliReport(RaidReport):
     raid_manager = 'storcli'
     executables = ['storcli', 'storcli64']
+    phases = (
+        ('adapters', ()),
+        ('physical_drives', ()),
+        ('logical_drives', ()),
+    )
 
     def parse_adapters(self):
         import json
 
-        p = subprocess.Popen([self.executable, '/call', 'show',  'all', 'j', 'nolog'], stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command([self.executable, '/call', 'show',  'all', 'j', 'nolog'])
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise RaidReportException("StorCli could not get adapter info")
 
-        cliout = json.loads(out.decode())
+        cliout = json.loads(res.stdout.decode())
 
         for controller in cliout.get('Controllers', []):
             ctrl_data = controller.get('Response Data', {})
@@ -31,7 +35,7 @@ class StorCliReport(RaidReport):
                 ctrl_data.get('Basics', {}).get('Model'),
                 ctrl_data.get('Basics', {}).get('Serial Number'),
                 ctrl_data.get('HwCfg', {}).get('ROC temperature(Degree Celsius)'),
-                data=ctrl_data
+                data=project(ctrl_data, self.fields)  # Most of the controller response is never used
             ))
 
         return self.adapters
@@ -74,13 +78,12 @@ class StorCliReport(RaidReport):
 
         import json
 
-        p = subprocess.Popen([self.executable, '/call/eall/sall', 'show', 'all', 'j', 'nolog'], stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command([self.executable, '/call/eall/sall', 'show', 'all', 'j', 'nolog'])
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise RaidReportException("StorCli could not get physical drives info")
 
-        cliout = json.loads(out.decode())
+        cliout = json.loads(res.stdout.decode())
 
         drives = defaultdict(dict)
 
@@ -127,13 +130,12 @@ class StorCliReport(RaidReport):
     def parse_logical_drives(self):
         import json
 
-        p = subprocess.Popen([self.executable, '/call/vall', 'show', 'all', 'j', 'nolog'], stdout=subprocess.PIPE)
-        out, _ = p.communicate()
+        res = run_command([self.executable, '/call/vall', 'show', 'all', 'j', 'nolog'])
 
-        if p.returncode != 0:
+        if res.returncode != 0:
             raise RaidReportException("StorCli could not get logical drives info")
 
-        cliout = json.loads(out.decode())
+        cliout = json.loads(res.stdout.decode())
 
         vds = defaultdict(dict)
 
@@ -1,41 +1,46 @@
-import sys
 import logging
-import subprocess
 from functools import partial
 
-# There is a bug with partial() and Pool.map() for py < 2.7, fixed by using mp.dummy.Pool
-if sys.version_info[0] == 2 and sys.version_info[1] < 7:
-    from multiprocessing.dummy import Pool
-else:
-    from multiprocessing import Pool
-
-from ccbr_server.common import Report, shclr, SHBGRED, SHBGGREEN
+from ccbr_server.common import Report, shclr, SHBGRED, SHBGGREEN, SHBGORANGE, run_command, map_concurrent, read_file, \
+    LatencyHistory
 
 log = logging.getLogger(__file__)
 
 RETURN_CODES = {
     0: 'success',
-    2: 'permission denied',
-    124: 'timeout reached'
+    2: 'permission denied'
 }
 
 
-def check_stale_nfs(path, timeout):
+def check_stale_nfs(path, timeout, latency=None):
     """ The execution function for our pool, checks one NFS if it's stale
     Even if we are root and can't see inside some mounts, if we get permission denied that's fine, it means nfs is
     working but we can't see inside.
     ret == 2 -> permission denied
-    ret >= 124 -> timeout reached
+    timeout reached -> stale
 
     :param str path: NFS mountpoint to check
     :param int timeout: ls timeout in seconds
-    :return: checked path and if it's stale or not
-    :rtype: tuple[str, bool]
+    :param LatencyHistory latency: Latencies of earlier checks, the timeout comes from the path's history if given
+    :return: checked path, if it's stale or not and how long ls took compared to earlier checks if latency is given
+    :rtype: tuple[str, bool, dict[str, Any]]
     """
-    with open('/dev/null', 'wb') as devnull:  # pipe stdout to devnull instead of printing
-        ret = subprocess.call(['timeout', str(timeout), 'ls', path], stdout=devnull, stderr=devnull)
-        log.debug("ls on mount point %s returned: %d (%s)", path, ret, RETURN_CODES.get(ret, 'unknown'))
-        return path, ret >= 124
+    if latency is not None:
+        timeout = latency.timeout_for(path)
+
+    res = run_command(['ls', path], timeout=timeout, capture_output=False, quiet=True)  # we only need the exit code
+
+    if res.timed_out:
+        log.debug("ls on mount point %s timed out", path)
+    else:
+        log.debug("ls on mount point %s returned: %d (%s)", path, res.returncode,
+                  RETURN_CODES.get(res.returncode, 'unknown'))
+
+    timing = None
+    if latency is not None and not res.timed_out:
+        timing = latency.observe(path, res.duration)
+
+    return path, res.timed_out, timing
 
 
 class StaleNFSReport(Report):
@@ -43,49 +48,69 @@ class StaleNFSReport(Report):
 
     :type mounts: dict[str, bool]
     :type groups: dict[str, list[str]]
+    :type latency: LatencyHistory
+    :type timings: dict[str, dict[str, Any]]
     """
     name = 'nfs'
 
-    def __init__(self, timeout=2, concurrency=4):
+    def __init__(self, timeout=2, concurrency=4, adaptive_timeout=False, min_timeout=1, max_timeout=30,
+                 latency_path=None):
         """
         :param int|str timeout: Stale timeout in seconds
         :param int|str concurrency: Thread pool size for NFS checking
+        :param bool adaptive_timeout: Take the stale timeout of each mount point from how long it took before
+        :param int|str min_timeout: Shortest adaptive stale timeout in seconds
+        :param int|str max_timeout: Longest adaptive stale timeout in seconds
+        :param str latency_path: State file keeping the latencies between runs, only kept in memory if None
         """
         self.timeout = int(timeout)
         self.concurrency = int(concurrency)
+        self.latency = LatencyHistory(timeout, min_timeout, max_timeout, latency_path) if adaptive_timeout else None
 
         self.mounts = {}
         self.groups = {}
+        self.timings = {}
 
         self._parse_mounted_nfs()
 
     def _parse_mounted_nfs(self):
         """ Parse current NFS mounts from mtab
         """
-        with open('/etc/mtab') as fio:
-            for mline in fio.readlines():
-                dev, mount_point, fs_type, opts = mline.split()[:4]
+        self.mounts = {}
+
+        for mline in read_file('/etc/mtab').splitlines():
+            dev, mount_point, fs_type, opts = mline.split()[:4]
 
-                if fs_type.startswith('nfs') and fs_type != 'nfsd':
-                    self.mounts[mount_point] = False
-                    log.debug("Adding NFS mount point: %s", mount_point)
+            if fs_type.startswith('nfs') and fs_type != 'nfsd':
+                self.mounts[mount_point] = False
+                log.debug("Adding NFS mount point: %s", mount_point)
 
     def collect_data(self):
         """ Check NFS concurrently to avoid long wait times if there's a lot of stale mounts
         """
-        log.debug("Creating NFS check thread pool of size %d", self.concurrency)
-        pool = Pool(processes=self.concurrency)
-        res = pool.map(partial(check_stale_nfs, timeout=self.timeout), self.mounts.keys())
-        for mount_point, is_stale in res:
+        self._parse_mounted_nfs()  # Mounts may have changed since the last collection
+
+        log.debug("Checking NFS mounts with %d threads", self.concurrency)
+        res = map_concurrent(partial(check_stale_nfs, timeout=self.timeout, latency=self.latency),
+                             self.mounts.keys(), self.concurrency)
+        self.timings = {}
+        for mount_point, is_stale, timing in res:
             self.mounts[mount_point] = is_stale
-        pool.close()
+            self.timings[mount_point] = timing
+
+        if self.latency is not None:
+            self.latency.save()
+
+        return self
 
     def to_dict(self):
         result = []
         for mount_point, is_stale in sorted(self.mounts.items()):
+            timing = self.timings.get(mount_point)  # Different every time, it is sent under _meta
             result.append({
                 'path': mount_point,
-                'is_stale': is_stale
+                'is_stale': is_stale,
+                'slow': bool(timing and timing['slow']),
             })
 
         return {
@@ -96,7 +121,14 @@ class StaleNFSReport(Report):
 
     def stdout(self):
         for nfs_mount, is_stale in sorted(self.mounts.items(), key=lambda x: (x[1], x[0])):
-            print("%s: %s" % (nfs_mount, is_stale and shclr('stale', SHBGRED) or shclr('OK', SHBGGREEN)))
+            timing = self.timings.get(nfs_mount)
+            if is_stale:
+                status = shclr('stale', SHBGRED)
+            elif timing and timing['slow']:
+                status = shclr('slow: %.1fs, usually %.1fs' % (timing['duration'], timing['baseline']), SHBGORANGE)
+            else:
+                status = shclr('OK', SHBGGREEN)
+            print("%s: %s" % (nfs_mount, status))
 
 
 report = StaleNFSReport
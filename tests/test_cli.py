@@ -0,0 +1,123 @@
+""" Daemon mode scheduling and sending, with reports and an outbox standing in for the real ones
+"""
+import threading
+import time
+import unittest
+
+from ccbr_server.cli import Daemon
+from ccbr_server.common import Report
+
+
+class StubReport(Report):
+    """ Reports a fixed value, collection can be held until release is set
+    """
+
+    def __init__(self, name, value=1, release=None):
+        self.name = name
+        self.value = value
+        self.release = release
+        self.collected = 0
+
+    def collect_data(self):
+        if self.release is not None:
+            self.release.wait(5)
+        self.collected += 1
+        return self
+
+    def to_dict(self):
+        return {'ver': 1, 'value': self.value}
+
+
+class StubOutbox(object):
+    """ Keeps payloads instead of spooling them, put raises error while it is set
+    """
+
+    def __init__(self):
+        self.payloads = []
+        self.error = None
+        self.on_drop = None
+
+    def put(self, payload):
+        if self.error is not None:
+            raise self.error
+        self.payloads.append(payload)
+
+    def drain(self):
+        return 0
+
+
+def tick_until(daemon, done, timeout=5):
+    """ Run daemon ticks until done returns True
+
+    :param Daemon daemon:
+    :param () -> bool done:
+    :param float timeout: Fail after this many seconds
+    """
+    end = time.time() + timeout
+    while not done():
+        if time.time() > end:
+            raise AssertionError("Daemon did not get there in %ss" % timeout)
+        daemon.tick()
+
+
+class DaemonTest(unittest.TestCase):
+
+    def daemon(self, reports, interval=0.01, outbox=None):
+        return Daemon(reports, intervals=dict((r.name, interval) for r in reports),
+                      deadlines=dict((r.name, 5) for r in reports), outbox=outbox)
+
+    def sent(self, outbox, name):
+        return [p['reports'][name] for p in outbox.payloads if name in p['reports']]
+
+    def test_unchanged_report_is_sent_once(self):
+        report = StubReport('nfs')
+        outbox = StubOutbox()
+        daemon = self.daemon([report], outbox=outbox)
+
+        tick_until(daemon, lambda: report.collected >= 3)
+        self.assertEqual(len(self.sent(outbox, 'nfs')), 1)
+
+        report.value = 2
+        tick_until(daemon, lambda: len(self.sent(outbox, 'nfs')) == 2)
+        self.assertEqual(self.sent(outbox, 'nfs')[1]['value'], 2)
+
+    def test_dropped_report_is_sent_again(self):
+        report = StubReport('nfs')
+        outbox = StubOutbox()
+        daemon = self.daemon([report], outbox=outbox)
+
+        tick_until(daemon, lambda: len(outbox.payloads) == 1)
+        outbox.on_drop(outbox.payloads[0])  # e.g. evicted by the size cap of the spool
+
+        tick_until(daemon, lambda: len(outbox.payloads) == 2)
+        self.assertEqual(self.sent(outbox, 'nfs')[1]['value'], 1)
+
+    def test_report_due_while_collecting_is_collected_again(self):
+        release = threading.Event()
+        report = StubReport('raid', release=release)
+        daemon = self.daemon([report], interval=60)
+
+        # md reports a change while the first collection is held, which wakes up the tick
+        threading.Timer(0.05, daemon.collector.request, [report]).start()
+        daemon.tick()
+        self.assertEqual(report.collected, 0)
+
+        release.set()
+        tick_until(daemon, lambda: report.collected == 2)
+        self.assertEqual(daemon.overdue, set())
+
+    def test_spool_errors_do_not_stop_the_daemon(self):
+        report = StubReport('nfs')
+        outbox = StubOutbox()
+        outbox.error = OSError(28, 'No space left on device')
+        daemon = self.daemon([report], outbox=outbox)
+
+        tick_until(daemon, lambda: report.collected >= 2)
+        self.assertEqual(outbox.payloads, [])
+
+        outbox.error = None  # The report wasn't spooled, it is sent once the spool works again
+        tick_until(daemon, lambda: len(outbox.payloads) == 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
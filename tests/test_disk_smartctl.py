@@ -0,0 +1,266 @@
+""" smartctl queries reading as little as the cache allows, and incremental SMART error and self-test logs that only
+move on once the monitoring site accepted them
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ccbr_server import bench
+from ccbr_server.common import Capture, ReportException, capture, load_state, project_root
+from ccbr_server.disk_smartctl import SmartReport, QUICK_QUERY, controller_group, new_log_entries
+from tests.test_reports import SMARTCTL, smart_fixture
+
+ERROR_LOG = 'ata_smart_error_log.summary'
+SELF_TEST_LOG = 'ata_smart_self_test_log.standard'
+
+
+def error_log(data, disk=0):
+    return data['disks'][disk]['ata_smart_error_log']['summary']
+
+
+class NewLogEntriesTest(unittest.TestCase):
+
+    def output(self, *numbers):
+        return {'ata_smart_error_log': {'summary': {'table': [{'error_number': n} for n in numbers]}}}
+
+    def test_first_time_everything_is_new(self):
+        trimmed, marks = new_log_entries(self.output(1, 2), {})
+        self.assertEqual(trimmed['ata_smart_error_log']['summary']['new_entries'], 2)
+        self.assertEqual(marks, {ERROR_LOG: [2, 1]})
+
+    def test_only_newer_entries(self):
+        output = self.output(1, 2, 3)
+        trimmed, marks = new_log_entries(output, {ERROR_LOG: [2, 1]})
+        self.assertEqual(trimmed['ata_smart_error_log']['summary']['table'], [{'error_number': 3}])
+        self.assertEqual(len(output['ata_smart_error_log']['summary']['table']), 3)  # Cached output is left alone
+        self.assertEqual(marks, {ERROR_LOG: [3, 1]})
+
+    def test_reset(self):
+        trimmed, marks = new_log_entries(self.output(1), {ERROR_LOG: [5, 1]})
+        self.assertTrue(trimmed['ata_smart_error_log']['summary']['reset'])
+        self.assertEqual(trimmed['ata_smart_error_log']['summary']['new_entries'], 1)
+
+        trimmed, marks = new_log_entries(self.output(), {ERROR_LOG: [5, 1]})
+        self.assertTrue(trimmed['ata_smart_error_log']['summary']['reset'])
+        self.assertEqual(marks, {ERROR_LOG: None})
+
+    def test_no_logs(self):
+        self.assertEqual(new_log_entries({'errors': [-1]}, {ERROR_LOG: [5, 1]})[1], {})
+
+    def self_tests(self, *hours):
+        return {'ata_smart_self_test_log': {'standard': {'table': [
+            {'type': {'string': 'Short offline'}, 'lifetime_hours': h} for h in hours]}}}
+
+    def test_self_tests_in_the_same_hour(self):
+        # Newest first, the second self-test of hour 40 ran after the first one was accepted
+        output = self.self_tests(40, 40, 30)
+        trimmed, marks = new_log_entries(output, {SELF_TEST_LOG: [40, 1]})
+        log = trimmed['ata_smart_self_test_log']['standard']
+        self.assertEqual(log['table'], output['ata_smart_self_test_log']['standard']['table'][:1])
+        self.assertEqual((log['new_entries'], log['reset']), (1, False))
+        self.assertEqual(marks, {SELF_TEST_LOG: [40, 2]})
+
+        trimmed, marks = new_log_entries(output, marks)
+        self.assertEqual(trimmed['ata_smart_self_test_log']['standard']['table'], [])
+
+    def test_self_tests_fewer_in_the_same_hour(self):
+        trimmed, marks = new_log_entries(self.self_tests(40, 30), {SELF_TEST_LOG: [40, 2]})
+        self.assertTrue(trimmed['ata_smart_self_test_log']['standard']['reset'])
+        self.assertEqual(trimmed['ata_smart_self_test_log']['standard']['new_entries'], 2)
+
+
+class AcknowledgedLogsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+        smart_fixture(bench.Fixture(self.directory))
+        capture.configure(self.directory, Capture.REPLAY)
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def test_entries_are_sent_until_acknowledged(self):
+        report = SmartReport(incremental_logs=True)
+
+        for _ in range(2):  # e.g. offline runs, or payloads dropped from the spool
+            data = report.collect().to_dict()
+            self.assertEqual(error_log(data)['new_entries'], 2)
+            self.assertEqual(len(error_log(data)['table']), 2)
+
+        report.acknowledged(data)
+
+        data = report.collect().to_dict()
+        self.assertEqual(error_log(data)['new_entries'], 0)
+        self.assertEqual(error_log(data)['entries'], 2)
+        self.assertEqual(error_log(data)['table'], [])
+        self.assertFalse(error_log(data)['reset'])
+
+    def test_stubs_are_ignored(self):
+        report = SmartReport(incremental_logs=True)
+        report.acknowledged(report.timeout_dict(120))
+
+        self.assertEqual(error_log(report.collect().to_dict())['new_entries'], 2)
+
+
+def quick_fixture(fixture, drives=4, timed_out=()):
+    """ Quick queries of the drives of smart_fixture, which didn't run since their full query
+
+    :param bench.Fixture fixture:
+    :param int drives: Number of drives
+    :param tuple[int] timed_out: Drives whose quick query hangs
+    """
+    for i in range(drives):
+        name = '/dev/sd%s' % chr(ord('a') + i)
+        fixture.command([SMARTCTL, '--json=c', '-n', 'standby'] + QUICK_QUERY + [
+            '-B', '+' + os.path.join(project_root, 'lib/smart/drivedb.h'), name], '' if i in timed_out else json.dumps({
+                'device': {'name': name, 'info_name': name, 'type': 'sat', 'protocol': 'ATA'},
+                'serial_number': 'S%d' % i,
+                'power_on_time': {'hours': 1000 + i},
+                'smart_status': {'passed': True},
+            }), timed_out=i in timed_out)
+
+
+class QuickQueryTest(unittest.TestCase):
+    """ Drives whose logs are still cached only get their identity, health and attributes read
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+        fixture = bench.Fixture(self.directory)
+        smart_fixture(fixture)
+        quick_fixture(fixture, timed_out=(0,))
+        capture.configure(self.directory, Capture.REPLAY)
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def test_logs_come_from_the_cache(self):
+        report = SmartReport(cache_ttl=3600)
+        report.collect()
+
+        data = report.collect().to_dict()
+        self.assertIn('cached', data['disks'][1])
+        self.assertEqual(error_log(data, 1)['count'], 2)
+        self.assertEqual(data['disks'][1]['errors'], [])
+
+    def test_quick_query_timed_out(self):
+        # The full query would only wait for the same hung drive again, and would have read it fine here
+        report = SmartReport(cache_ttl=3600)
+        self.assertEqual(error_log(report.collect().to_dict())['count'], 2)
+
+        disk = report.collect().to_dict()['disks'][0]
+        self.assertEqual(disk['errors'], [-1])
+        self.assertNotIn('ata_smart_error_log', disk)
+
+
+class CachedScanTest(unittest.TestCase):
+    """ The version check and the device scan are kept in the state file while nothing they depend on changes
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+        smart_fixture(bench.Fixture(os.path.join(self.directory, 'capture')))
+        capture.configure(os.path.join(self.directory, 'capture'), Capture.REPLAY)
+
+        self.report = SmartReport()
+        self.report.state_path = os.path.join(self.directory, 'smart.json')  # Not kept while replaying
+        self.report.executable = os.path.join(self.directory, 'smartctl')  # Replayed by its name
+        with open(self.report.executable, 'w'):
+            pass
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def replay_nothing(self):
+        """ Replay the test directory from here on, nothing was recorded there unless the test adds it """
+        capture.configure(self.directory, Capture.REPLAY)
+
+    def test_version(self):
+        self.report._check_version()
+        self.assertEqual(load_state(self.report.state_path)['version']['version'], '7.2')
+
+        self.replay_nothing()
+        self.report._check_version()
+
+        os.utime(self.report.executable, (0, 0))  # smartctl was updated
+        self.assertRaises(ReportException, self.report._check_version)
+
+    def test_scan(self):
+        self.assertEqual(len(self.report._scan()), 4)
+
+        self.replay_nothing()
+        self.assertEqual(len(self.report._scan()), 4)
+
+        self.report.cache['scan']['fingerprint'] = 'other'  # Devices in sysfs changed
+        self.assertRaises(ReportException, self.report._scan)
+
+    def test_scan_after_open_failed(self):
+        self.report.collect()
+        self.assertIn('scan', self.report.cache)
+
+        fixture = bench.Fixture(self.directory)  # Drives can't be opened, e.g. pulled without sysfs telling us yet
+        for device in self.report.cache['scan']['devices']:
+            fixture.command([SMARTCTL, '--json=c', '-n', 'standby', '--all', '-B',
+                             '+' + os.path.join(project_root, 'lib/smart/drivedb.h'), device['name']],
+                            json.dumps({'smartctl': {'exit_status': 2}}), returncode=2)
+        self.replay_nothing()
+        self.report.collect()
+        self.assertNotIn('scan', self.report.cache)
+
+
+class ControllerLanesTest(unittest.TestCase):
+    """ Drives behind each RAID controller are queried by their own pool, next to the directly attached drives
+    """
+    DEVICES = [{'name': '/dev/bus/%d' % bus, 'type': 'megaraid,%d' % slot} for bus in (0, 1) for slot in range(4)] + \
+        [{'name': '/dev/sd%s' % name, 'type': 'sat'} for name in 'ab']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+        smart_fixture(bench.Fixture(self.directory))
+        capture.configure(self.directory, Capture.REPLAY)
+
+        self.lock = threading.Lock()
+        self.running = {}  # controller -> queries running now
+        self.most = {}  # controller -> most queries running at once
+        self.together = 0  # Most queries running at once over all controllers
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def check_device(self, device):
+        group = controller_group(device)
+        with self.lock:
+            self.running[group] = self.running.get(group, 0) + 1
+            self.most[group] = max(self.most.get(group, 0), self.running[group])
+            self.together = max(self.together, sum(self.running.values()))
+        time.sleep(0.05)
+        with self.lock:
+            self.running[group] -= 1
+        return device, {'device': device, 'errors': []}, None
+
+    def check(self, **kwargs):
+        report = SmartReport(**kwargs)
+        report._check_device = self.check_device
+        return report._check_devices(self.DEVICES)
+
+    def test_one_query_per_controller(self):
+        results = self.check()
+        self.assertEqual([device for device, _output, _identity in results], self.DEVICES)
+        self.assertEqual(self.most, {'megaraid:/dev/bus/0': 1, 'megaraid:/dev/bus/1': 1, None: 2})
+        self.assertGreater(self.together, 2)  # Both controllers and the directly attached drives at once
+
+    def test_controller_concurrency(self):
+        self.check(controller_concurrency=2, concurrency=1)
+        self.assertEqual(self.most, {'megaraid:/dev/bus/0': 2, 'megaraid:/dev/bus/1': 2, None: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+""" Parsing of 'key : value' output
+"""
+import unittest
+
+from ccbr_server.kvparse import BlockParser, parse_properties
+
+
+class BlockParserTest(unittest.TestCase):
+
+    def test_unicode_lines(self):
+        """ Decoded command output is unicode on python 2 """
+        lines = [u'Raid Level : raid1', u'State : clean ', u'', u'Name : h\xf6st:0']
+        self.assertEqual(parse_properties(lines), {u'Raid Level': u'raid1', u'State': u'clean', u'Name': u'h\xf6st:0'})
+
+    def test_unicode_records(self):
+        parser = BlockParser(starts=[(u'Slot Number:', u'slot')])
+        lines = [u'Slot Number: 0', u'Firmware state: Online', u'Slot Number: 1', u'Firmware state: Failed']
+        self.assertEqual(list(parser.parse(lines)), [
+            {u'slot': u'0', u'Slot Number': u'0', u'Firmware state': u'Online'},
+            {u'slot': u'1', u'Slot Number': u'1', u'Firmware state': u'Failed'},
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+""" Outbox delivery against a local stand-in for the monitoring site
+"""
+import fcntl
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ccbr_server.outbox import Outbox, LOCK_FILE, REJECTED_FILE, DELETED_KEY, apply_delta, payload_hash
+
+try:
+    # noinspection PyCompatibility
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """ Accepts payloads with the status the test set on the server, and keeps the ones it accepted
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status == 200:
+            self.server.received.append(json.loads(body.decode()))
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), SiteHandler)
+        self.server.statuses = []  # Status of each request from now on, 200 once it runs out
+        self.server.received = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.spool_dir = tempfile.mkdtemp(prefix='ccbr_spool_')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.spool_dir)
+
+    def outbox(self, **kwargs):
+        return Outbox(self.spool_dir, 'http://127.0.0.1:%d/report' % self.server.server_port, timeout=5, **kwargs)
+
+    def test_delivers_oldest_first(self):
+        outbox = self.outbox()
+        for i in range(3):
+            outbox.put({'timestamp': i, 'reports': {}})
+
+        self.assertEqual(outbox.drain(), 3)
+        self.assertEqual([p['timestamp'] for p in self.server.received], [0, 1, 2])
+        self.assertEqual(outbox.pending(), [])
+
+    def test_batches(self):
+        outbox = self.outbox(batch_size=2)
+        for i in range(3):
+            outbox.put({'timestamp': i, 'reports': {}})
+
+        self.assertEqual(outbox.drain(), 2)
+        self.assertEqual(len(outbox.pending()), 1)
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([p['timestamp'] for p in self.server.received], [0, 1, 2])
+
+    def test_keeps_payloads_and_backs_off_while_site_fails(self):
+        outbox = self.outbox(backoff=0)
+        outbox.put({'timestamp': 0, 'reports': {}})
+        outbox.put({'timestamp': 1, 'reports': {}})
+        self.server.statuses = [500]
+
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(len(outbox.pending()), 2)
+        self.assertEqual(outbox._load_backoff()[0], 1)
+
+        self.assertEqual(outbox.drain(), 2)
+        self.assertEqual([p['timestamp'] for p in self.server.received], [0, 1])
+        self.assertEqual(outbox._load_backoff()[0], 0)
+
+    def test_waits_for_backoff(self):
+        outbox = self.outbox(backoff=3600)
+        outbox.put({'timestamp': 0, 'reports': {}})
+        self.server.statuses = [503]
+
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(outbox.drain(), 0)  # Still backing off, the site isn't asked again
+        self.assertEqual(self.server.statuses, [])
+        self.assertEqual(len(outbox.pending()), 1)
+
+    def test_rejected_payload_does_not_block_the_spool(self):
+        dropped = []
+        outbox = self.outbox(backoff=3600, on_drop=dropped.append)
+        outbox.put({'timestamp': 0, 'reports': {}})
+        outbox.put({'timestamp': 1, 'reports': {}})
+        self.server.statuses = [400]
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([p['timestamp'] for p in self.server.received], [1])
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual([p['timestamp'] for p in dropped], [0])
+        with open(os.path.join(self.spool_dir, REJECTED_FILE)) as fio:
+            self.assertEqual(json.load(fio)['timestamp'], 0)
+
+    def test_retries_after_too_many_requests(self):
+        outbox = self.outbox(backoff=0)
+        outbox.put({'timestamp': 0, 'reports': {}})
+        self.server.statuses = [429]
+
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(len(outbox.pending()), 1)
+        self.assertEqual(outbox.drain(), 1)
+
+    def test_site_down(self):
+        outbox = Outbox(self.spool_dir, 'http://127.0.0.1:1/report', timeout=1)
+        outbox.put({'timestamp': 0, 'reports': {}})
+
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(len(outbox.pending()), 1)
+
+    def test_size_cap_drops_oldest(self):
+        outbox = self.outbox(max_bytes=150)  # Two payloads fit
+        for i in range(5):
+            outbox.put({'timestamp': i, 'reports': {'padding': 'x' * 30}})
+
+        outbox.drain()
+        self.assertEqual([p['timestamp'] for p in self.server.received], [3, 4])
+
+    def test_size_cap_reports_dropped_payloads(self):
+        dropped = []
+        outbox = self.outbox(max_bytes=150, on_drop=dropped.append)
+        for i in range(4):
+            outbox.put({'timestamp': i, 'reports': {'padding': 'x' * 30}})
+
+        self.assertEqual([p['timestamp'] for p in dropped], [0, 1])
+
+    def test_gzip(self):
+        outbox = self.outbox(compress=True)
+        outbox.put({'timestamp': 0, 'reports': {'nfs': {'ver': 1}}})
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(self.server.received[0]['reports'], {'nfs': {'ver': 1}})
+
+    def test_locked_spool_is_left_to_its_holder(self):
+        outbox = self.outbox()
+        outbox.put({'timestamp': 0, 'reports': {}})
+
+        with open(os.path.join(self.spool_dir, LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Another run is draining the spool
+            self.assertEqual(outbox.drain(), 0)
+            outbox.put({'timestamp': 1, 'reports': {}})
+
+        self.assertEqual(self.server.received, [])
+        self.assertEqual(outbox.drain(), 2)
+
+    def test_payload_removed_by_another_process(self):
+        outbox = self.outbox()
+        outbox.put({'timestamp': 0, 'reports': {}})
+        gone = outbox.put({'timestamp': 1, 'reports': {}})
+
+        pending = outbox.pending()
+        os.unlink(gone)
+        outbox.pending = lambda: pending  # Listed just before it was removed
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([p['timestamp'] for p in self.server.received], [0])
+
+    def test_delta_against_each_acknowledged_report(self):
+        outbox = self.outbox(delta=True)
+        nfs = {'ver': 1, 'mount_points': [{'path': '/home', 'is_stale': False}]}
+        smart = {'ver': 1, 'disks': [{'serial': 'S1', 'temperature': 30}, {'serial': 'S2', 'temperature': 31}]}
+        raid = {'ver': 1, 'adapters': []}
+
+        outbox.put({'timestamp': 0, 'reports': {'nfs': nfs, 'smartctl': smart, 'raid': raid}})
+        outbox.drain()
+        base = {'reports': {'nfs': nfs, 'smartctl': smart, 'raid': raid}}
+        self.assertEqual(self.server.received[0]['reports'], base['reports'])
+
+        # A daemon tick only holds the report that changed, the others must not be deleted
+        stale = {'ver': 1, 'mount_points': [{'path': '/home', 'is_stale': True}]}
+        outbox.put({'timestamp': 1, 'reports': {'nfs': stale}})
+        outbox.drain()
+        sent = self.server.received[1]
+        self.assertEqual(list(sent['reports']), ['nfs'])
+        self.assertNotIn(DELETED_KEY, sent['reports'])
+        self.assertEqual(sent['delta_base'], payload_hash(base))
+        self.assertEqual(apply_delta(nfs, sent['reports']['nfs']), stale)
+        base['reports']['nfs'] = stale
+
+        # The next report still has its base from the first payload
+        hot = {'ver': 1, 'disks': [{'serial': 'S1', 'temperature': 30}, {'serial': 'S2', 'temperature': 45}]}
+        outbox.put({'timestamp': 2, 'reports': {'smartctl': hot}})
+        outbox.drain()
+        sent = self.server.received[2]
+        self.assertEqual(sent['reports'], {'smartctl': {'disks': {'__items__': {'1': {'temperature': 45}}}}})
+        self.assertEqual(sent['delta_base'], payload_hash(base))
+        self.assertEqual(apply_delta(smart, sent['reports']['smartctl']), hot)
+
+    def test_delta_base_rejected(self):
+        outbox = self.outbox(delta=True)
+        outbox.put({'timestamp': 0, 'reports': {'nfs': {'ver': 1}, 'raid': {'ver': 1}}})
+        outbox.drain()
+
+        self.server.statuses = [409]
+        outbox.put({'timestamp': 1, 'reports': {'nfs': {'ver': 2}}})
+        outbox.drain()
+        self.assertEqual(self.server.received[1]['reports'], {'nfs': {'ver': 2}})
+        self.assertNotIn('delta_base', self.server.received[1])
+
+        # The site only has what it got last, raid is sent whole again
+        outbox.put({'timestamp': 2, 'reports': {'nfs': {'ver': 2}, 'raid': {'ver': 1}}})
+        outbox.drain()
+        self.assertEqual(self.server.received[2]['reports'], {'raid': {'ver': 1}})
+        self.assertEqual(self.server.received[2]['delta_base'], payload_hash({'reports': {'nfs': {'ver': 2}}}))
+
+    def test_on_ack_gets_accepted_payloads(self):
+        acked = []
+        outbox = self.outbox(backoff=0, on_ack=acked.append)
+        outbox.put({'timestamp': 0, 'reports': {'smartctl': {'ver': 1}}})
+        self.server.statuses = [500]
+
+        outbox.drain()
+        self.assertEqual(acked, [])
+
+        outbox.drain()
+        self.assertEqual(acked, [{'timestamp': 0, 'reports': {'smartctl': {'ver': 1}}}])
+
+    def test_failing_on_ack_does_not_resend(self):
+        def on_ack(payload):
+            raise ValueError()
+
+        outbox = self.outbox(on_ack=on_ack)
+        outbox.put({'timestamp': 0, 'reports': {}})
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(outbox.pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
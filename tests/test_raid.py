@@ -0,0 +1,55 @@
+""" Detection of the RAID manager of a system
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from ccbr_server import bench
+from ccbr_server.common import Capture, capture, save_state
+from ccbr_server.raid import RaidReport, RaidReportException
+from ccbr_server.raid_md import MdReport
+from ccbr_server.raid_megacli import MegaCliReport
+from ccbr_server.raid_storcli import StorCliReport
+
+
+class DetectRaidManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def detect(self, *generators):
+        fixture = bench.Fixture(self.directory)
+        for generate in generators:
+            generate(fixture, 1, 8)
+        capture.configure(self.directory, Capture.REPLAY)
+
+        return RaidReport.automatic_cli()
+
+    def test_md_only(self):
+        self.assertIsInstance(self.detect(bench.md_fixture), MdReport)
+
+    def test_megacli_before_md(self):
+        # An md mirror of the boot disks next to a hardware controller
+        self.assertIsInstance(self.detect(bench.md_fixture, bench.megacli_fixture), MegaCliReport)
+
+    def test_storcli_before_md(self):
+        self.assertIsInstance(self.detect(bench.md_fixture, bench.storcli_fixture), StorCliReport)
+
+    def test_nothing_found(self):
+        self.assertRaises(RaidReportException, self.detect)
+
+    def test_cache_from_another_probe_order_is_detected_again(self):
+        # Saved while md was probed first
+        path = os.path.join(self.directory, 'raid_manager.json')
+        save_state(path, {'controllers': 'pci', 'module': 'ccbr_server.raid_md', 'executable': None, 'mtime': None})
+
+        self.assertIsNone(RaidReport._cached_cli(path, 'pci', None, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
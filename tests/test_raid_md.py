@@ -0,0 +1,142 @@
+""" md arrays read from /proc/mdstat and sysfs
+"""
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+from ccbr_server import bench
+from ccbr_server.common import Capture, capture
+from ccbr_server.raid_md import MdReport, mdstat_blocks
+
+MDSTAT = '''Personalities : [raid1] [raid6]
+md1 : active raid1 sdb1[1] sda1[0]
+      1024 blocks super 1.2 [2/2] [UU]
+
+md0 : active raid6 sdd1[1] sdc1[0](F)
+      2048 blocks super 1.2 level 6, 512k chunk, algorithm 2 [4/3] [_UUU]
+      bitmap: 0/30 pages [0KB], 65536KB chunk
+
+unused devices: <none>
+'''
+
+
+class MdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def replay(self, drives=24, **attributes):
+        """ Replay a generated md system instead of this one
+
+        :param int drives: Number of member drives
+        :param attributes: sysfs attributes of md0, e.g. sync_action='recover'
+        """
+        fixture = bench.Fixture(self.directory)
+        bench.md_fixture(fixture, 1, drives)
+        for attribute, value in attributes.items():
+            fixture.file('/sys/block/md0/md/' + attribute, '%s\n' % value)
+        capture.configure(self.directory, Capture.REPLAY)
+
+    @staticmethod
+    def array(data, name):
+        """
+        :param dict[str, Any] data: Dictionary representation of an MdReport
+        :param str name: Array name, e.g. md0
+        :rtype: dict[str, Any]
+        """
+        for adapter in data['adapters']:
+            for drive in adapter['logical_drives']:
+                if drive['id'] == '/dev/' + name:
+                    return drive
+        raise AssertionError("%s not reported" % name)
+
+
+class ChangedArraysTest(MdTestCase):
+    """ Arrays md reported a change for are collected on their own
+    """
+
+    def test_mdstat_blocks(self):
+        blocks = mdstat_blocks(MDSTAT)
+        self.assertEqual(sorted(blocks), ['md0', 'md1'])
+        self.assertEqual(blocks['md1'].splitlines(), ['md1 : active raid1 sdb1[1] sda1[0]',
+                                                      '      1024 blocks super 1.2 [2/2] [UU]'])
+        self.assertEqual(len(blocks['md0'].splitlines()), 3)
+
+    def test_changed_array_same_as_full_collection(self):
+        self.replay()
+        report = MdReport()
+        full = json.dumps(report.collect().to_dict(), sort_keys=True)
+        self.assertGreater(len(report.arrays), 1)
+
+        collected = []
+        report.collect_all_data = lambda: collected.append('all')
+        report.changed_arrays = {'md0'}
+        self.assertEqual(json.dumps(report.collect().to_dict(), sort_keys=True), full)
+        self.assertEqual(collected, [])
+        self.assertEqual(report.changed_arrays, set())
+
+
+class LatencyTest(MdTestCase):
+
+    def test_timings_of_the_last_collection(self):
+        self.replay(drives=8)
+        report = MdReport(sysfs=False, adaptive_timeout=True)
+        report.collect()
+        self.assertIn('/dev/md0', report.timings)
+
+        report.timings['/dev/md9'] = {'slow': True}  # An array that was stopped since
+        report.collect()
+        self.assertNotIn('/dev/md9', report.timings)
+
+
+class SyncProgressTest(MdTestCase):
+    """ Throughput and time left of a recovery, measured over the progress of earlier collections
+    """
+    RECOVERY = dict(sync_action='recover', sync_completed='1000000 / 2000000', sync_speed=5000, sync_speed_min=1000,
+                    sync_speed_max=200000)
+
+    def test_idle(self):
+        self.replay()
+        self.assertIsNone(self.array(MdReport().collect().to_dict(), 'md0')['sync'])
+
+    def test_first_collection(self):
+        # Nothing measured yet, the time left comes from the speed md reports
+        self.replay(**self.RECOVERY)
+        sync = self.array(MdReport().collect().to_dict(), 'md0')['sync']
+
+        self.assertEqual((sync['action'], sync['percent'], sync['speed']), ('recover', 50., 5000))
+        self.assertIsNone(sync['throughput'])
+        self.assertEqual(sync['eta'], 100)
+        self.assertFalse(sync['slow'])
+
+    def test_measured_throughput(self):
+        self.replay(**self.RECOVERY)
+        report = MdReport()
+        report.sync_samples = {'md0': [[time.time() - 100, 'recover', 800000, 2000000]]}
+        sync = self.array(report.collect().to_dict(), 'md0')['sync']
+
+        # 200000 sectors of 512 bytes in 100s, far below the speed limit
+        self.assertAlmostEqual(sync['throughput'], 1000, delta=1)
+        self.assertAlmostEqual(sync['eta'], 500, delta=1)
+        self.assertTrue(sync['slow'])
+        self.assertEqual(len(report.sync_samples['md0']), 2)
+
+    def test_samples_of_another_sync(self):
+        self.replay(**self.RECOVERY)
+        report = MdReport()
+        report.sync_samples = {'md0': [[time.time() - 100, 'check', 800000, 2000000]], 'md1': [[0, 'check', 0, 1]]}
+        sync = self.array(report.collect().to_dict(), 'md0')['sync']
+
+        self.assertIsNone(sync['throughput'])
+        self.assertEqual(sync['eta'], 100)
+        self.assertEqual(list(report.sync_samples), ['md0'])  # md1 finished
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+""" Every report is collected repeatedly from the same recorded output, like daemon mode does. What it reports and the
+memory it holds must not grow with each collection.
+"""
+import gc
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ccbr_server import bench
+from ccbr_server.common import Capture, capture, project_root
+from ccbr_server.disk_hdsentinel import HDSentinelReport
+from ccbr_server.disk_smartctl import SmartReport
+from ccbr_server.disk_usage import UsageReport
+from ccbr_server.raid_md import MdReport
+from ccbr_server.raid_megacli import MegaCliReport
+from ccbr_server.raid_omreport import OmreportReport
+from ccbr_server.raid_storcli import StorCliReport
+from ccbr_server.stale_nfs import StaleNFSReport
+
+try:
+    import tracemalloc
+except ImportError:  # python 2, memory is not measured
+    tracemalloc = None
+
+REPEAT = 5  # Collections after the first two
+MEMORY_GROWTH = 16  # KiB, memory may grow this much over all repeated collections
+
+SMARTCTL = os.path.join(project_root, 'lib/smart/smartctl')
+HDSENTINEL = os.path.join(project_root, 'lib/hdsentinel/hdsentinel-018c-x64')
+
+NFS_MTAB = '''/dev/sda1 / xfs rw,relatime 0 0
+server:/home /home nfs4 rw,relatime,vers=4.1 0 0
+server:/scratch /scratch nfs rw,relatime,vers=3 0 0
+nfsd /proc/fs/nfsd nfsd rw,relatime 0 0
+'''
+
+HDSENTINEL_XML = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+<Hard_Disk_Sentinel>
+  <Physical_Disk_Information_Disk_0>
+    <Hard_Disk_Summary>
+      <Hard_Disk_Device>/dev/sda</Hard_Disk_Device>
+      <Hard_Disk_Serial_Number>S1</Hard_Disk_Serial_Number>
+      <Health>100 %</Health>
+    </Hard_Disk_Summary>
+  </Physical_Disk_Information_Disk_0>
+  <Physical_Disk_Information_Disk_1>
+    <Hard_Disk_Summary>
+      <Hard_Disk_Device>/dev/sdb</Hard_Disk_Device>
+      <Hard_Disk_Serial_Number>S2</Hard_Disk_Serial_Number>
+      <Health>96 %</Health>
+    </Hard_Disk_Summary>
+  </Physical_Disk_Information_Disk_1>
+</Hard_Disk_Sentinel>
+'''
+
+
+def nfs_fixture(fixture):
+    fixture.file('/etc/mtab', NFS_MTAB)
+    fixture.command(['ls', '/home'], '')
+    fixture.command(['ls', '/scratch'], '', returncode=2)
+
+
+def hdsentinel_fixture(fixture):
+    fixture.command([HDSENTINEL, '-xml', '-dump'], HDSENTINEL_XML)
+
+
+def smart_fixture(fixture, drives=4):
+    devices = [{'name': '/dev/sd%s' % chr(ord('a') + i), 'info_name': '/dev/sd%s' % chr(ord('a') + i),
+                'type': 'sat', 'protocol': 'ATA'} for i in range(drives)]
+
+    fixture.command([SMARTCTL, '-V'], 'smartctl 7.2 2020-12-30 r5155 [x86_64-linux] (local build)\n')
+    fixture.command([SMARTCTL, '--json=c', '--scan'], json.dumps({'devices': devices}))
+
+    for i, device in enumerate(devices):
+        fixture.command([SMARTCTL, '--json=c', '-n', 'standby', '--all', '-B',
+                         '+' + os.path.join(project_root, 'lib/smart/drivedb.h'), device['name']], json.dumps({
+                             'device': device,
+                             'serial_number': 'S%d' % i,
+                             'power_on_time': {'hours': 1000 + i},
+                             'smart_status': {'passed': True},
+                             'ata_smart_error_log': {'summary': {'count': 2, 'table': [
+                                 {'error_number': 1, 'lifetime_hours': 10},
+                                 {'error_number': 2, 'lifetime_hours': 20},
+                             ]}},
+                         }))
+
+
+class RepeatedCollectionTest(unittest.TestCase):
+    """ Collect a report from a generated capture again and again
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ccbr_test_')
+
+    def tearDown(self):
+        capture.configure()
+        shutil.rmtree(self.directory)
+
+    def replay(self, generate, *args):
+        """ Write a fixture and replay it instead of the system
+
+        :param (bench.Fixture, ...) -> None generate: Fixture generator
+        """
+        generate(bench.Fixture(self.directory), *args)
+        capture.configure(self.directory, Capture.REPLAY)
+
+    def assertBounded(self, report):
+        """ Data stays the same and memory stays flat over repeated collections
+
+        :param ccbr_server.common.Report report: Report to collect
+        :return: Dictionary representation of the first collection
+        :rtype: dict[str, Any]
+        """
+        first = json.dumps(report.collect().to_dict(), sort_keys=True)
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+        try:
+            report.collect()  # Caches and lazily created state settle on the first collection traced
+            gc.collect()
+            settled = tracemalloc.get_traced_memory()[0] if tracemalloc is not None else 0
+
+            for _ in range(REPEAT):
+                self.assertEqual(json.dumps(report.collect().to_dict(), sort_keys=True), first)
+
+            gc.collect()
+            grown = (tracemalloc.get_traced_memory()[0] - settled) / 1024. if tracemalloc is not None else 0
+        finally:
+            if tracemalloc is not None:
+                tracemalloc.stop()
+
+        self.assertLess(grown, MEMORY_GROWTH, "%s grew by %.1fKiB over %d collections" % (report.name, grown, REPEAT))
+
+        return json.loads(first)
+
+    def test_megacli(self):
+        self.replay(bench.megacli_fixture, 2, 24)
+        data = self.assertBounded(MegaCliReport())
+        self.assertEqual(sum(len(a['physical_drives']) for a in data['adapters']), 24)
+
+    def test_omreport(self):
+        self.replay(bench.omreport_fixture, 2, 24)
+        data = self.assertBounded(OmreportReport())
+        self.assertEqual(sum(len(a['physical_drives']) for a in data['adapters']), 24)
+
+    def test_storcli(self):
+        self.replay(bench.storcli_fixture, 2, 24)
+        data = self.assertBounded(StorCliReport())
+        self.assertEqual(sum(len(a['physical_drives']) for a in data['adapters']), 24)
+
+    def test_md(self):
+        self.replay(bench.md_fixture, 1, 24)
+        data = self.assertBounded(MdReport())
+        self.assertEqual(sum(len(a['physical_drives']) for a in data['adapters']), 24)
+
+    def test_md_mdadm(self):
+        self.replay(bench.md_fixture, 1, 24)
+        data = self.assertBounded(MdReport(sysfs=False))
+        self.assertEqual(sum(len(a['physical_drives']) for a in data['adapters']), 24)
+
+    def test_smartctl(self):
+        self.replay(smart_fixture)
+        data = self.assertBounded(SmartReport())
+        self.assertEqual(len(data['disks']), 4)
+
+    def test_hdsentinel(self):
+        self.replay(hdsentinel_fixture)
+        data = self.assertBounded(HDSentinelReport())
+        self.assertEqual(len(data['disks']), 2)
+
+    def test_nfs(self):
+        self.replay(nfs_fixture)
+        data = self.assertBounded(StaleNFSReport())
+        self.assertEqual([m['path'] for m in data['mount_points']], ['/home', '/scratch'])
+
+    def test_adaptive_timeouts(self):
+        # Latencies differ on every collection, they must stay out of the data so unchanged reports compare equal
+        self.replay(nfs_fixture)
+        report = StaleNFSReport(adaptive_timeout=True)
+        self.assertBounded(report)
+        self.assertEqual(sorted(report.meta.to_dict()['latencies']), ['/home', '/scratch'])
+
+    def test_adaptive_timeouts_md_mdadm(self):
+        self.replay(bench.md_fixture, 1, 8)
+        report = MdReport(sysfs=False, adaptive_timeout=True)
+        self.assertBounded(report)
+        self.assertIn('/dev/md0', report.meta.to_dict()['latencies'])
+
+    def test_adaptive_timeouts_smartctl(self):
+        self.replay(smart_fixture)
+        report = SmartReport(adaptive_timeout=True)
+        self.assertBounded(report)
+        self.assertEqual(len(report.meta.to_dict()['latencies']), 4)
+
+    def test_disk_usage(self):
+        # statvfs can't be replayed, this one reads the mounts of the system running the test
+        report = UsageReport()
+        report.collect()
+        count = len(report.usages)
+
+        for _ in range(REPEAT):
+            self.assertEqual(len(report.collect().usages), count)
+
+
+if __name__ == '__main__':
+    unittest.main()